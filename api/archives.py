@@ -0,0 +1,201 @@
+"""
+Extraction of data files from zip and tar archives, for formats which consist of a directory
+of files. Only the files needed by the Neo IO are extracted, reading the archive as a stream.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import json
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from fastapi import HTTPException, status
+
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz", ".tar.zst", ".tzst")
+
+# files smaller than this are always extracted, since IOs may need metadata files
+# whose extensions are not in their list of extensions
+SMALL_FILE_SIZE = 1024**2
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def get_archive_stem(path):
+    name = os.path.basename(path)
+    for extension in ARCHIVE_EXTENSIONS:
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+    return name
+
+
+def get_record_path(archive_path):
+    """Location of the record of the contents of an archive, and of the files extracted from it."""
+    dir_path, filename = os.path.split(archive_path)
+    return os.path.join(dir_path, f".{filename}.extracted.json")
+
+
+def read_record(archive_path):
+    try:
+        with open(get_record_path(archive_path)) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_record(archive_path, record):
+    record_path = get_record_path(archive_path)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(record_path), prefix=".tmp-")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(record, fp)
+    os.replace(tmp_path, record_path)
+
+
+def is_safe(name):
+    """Check that an archive member would be extracted within the target directory."""
+    parts = posixpath.normpath(name).split("/")
+    return not (name.startswith("/") or ".." in parts or ":" in parts[0])
+
+
+def is_needed(name, size, io_cls=None):
+    """
+    Decide whether an archive member is needed to read the data with the given Neo IO:
+    files with one of the IO's extensions, and small files. All files are needed if the IO is not known.
+    """
+    if io_cls is None or not getattr(io_cls, "extensions", None) or size < SMALL_FILE_SIZE:
+        return True
+    name = name.lower()
+    return any(name.endswith(f".{extension.lower()}") for extension in io_cls.extensions)
+
+
+def get_layout(archive_path, names):
+    """
+    Return the name of the directory containing the files in the archive, within the cache directory,
+    and whether the names of the files in the archive include this directory.
+    If all the files are within a single top-level directory, we use that,
+    otherwise they are placed in a directory named after the archive.
+    """
+    top_level = {name.split("/")[0] for name in names}
+    if len(top_level) == 1 and all("/" in name for name in names):
+        return top_level.pop(), True
+    return get_archive_stem(archive_path), False
+
+
+def get_root(archive_path, cache_dir):
+    """
+    Return the path of the directory containing the files extracted from an archive,
+    or None if it has not been extracted.
+    """
+    record = read_record(archive_path)
+    if record is None:
+        return None
+    root, nested = get_layout(archive_path, [name for name, size in record["members"]])
+    return os.path.join(cache_dir, root)
+
+
+def open_tar(archive_path):
+    """Open a tar archive as a stream, which can only be read sequentially."""
+    if archive_path.lower().endswith((".tar.zst", ".tzst")):
+        try:
+            import zstandard
+        except ImportError:
+            raise HTTPException(
+                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                detail="This server does not have the zstandard module installed.",
+            )
+        fp = open(archive_path, "rb")
+        try:
+            return tarfile.open(fileobj=zstandard.ZstdDecompressor().stream_reader(fp), mode="r|")
+        except BaseException:
+            fp.close()
+            raise
+    return tarfile.open(archive_path, mode="r|*")
+
+
+def iter_members(archive_path):
+    """
+    Yield the name, size and a function returning a file object for the contents
+    of each regular file in an archive, in the order in which they are stored.
+    The file object can only be used before moving on to the next member.
+    """
+    if archive_path.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield info.filename, info.file_size, lambda info=info: zf.open(info)
+    else:
+        with open_tar(archive_path) as tf:
+            for info in tf:
+                if info.isfile():
+                    yield info.name, info.size, lambda info=info: tf.extractfile(info)
+
+
+def list_members(archive_path):
+    """Return the names and sizes of the regular files in an archive."""
+    return [(name, size) for name, size, open_member in iter_members(archive_path)]
+
+
+def extract(archive_path, cache_dir, io_cls=None):
+    """
+    Extract the files needed by the Neo IO `io_cls` (see `is_needed()`) from an archive,
+    which may already have been extracted in part, e.g. for a different IO,
+    and return the path of the directory containing them.
+
+    The archive is read as a stream, and each file is copied to a temporary file,
+    then moved into place, so extracted files are always complete.
+    The names of all the files in the archive, and of those already extracted, are recorded
+    (see `get_record_path()`), so that tar archives, whose contents cannot be listed without
+    reading the whole archive, are only read again if other files are needed.
+    The caller must hold the lock on the archive, see `disk_cache.file_lock()`.
+    """
+    record = read_record(archive_path)
+    if record is None and archive_path.lower().endswith(".zip"):
+        # listing the contents of a zip archive is cheap
+        record = {"members": list_members(archive_path), "extracted": []}
+    if record is not None:
+        names = [name for name, size in record["members"]]
+        extracted = set(record["extracted"])
+        needed = {
+            name for name, size in record["members"]
+            if is_needed(name, size, io_cls) and name not in extracted
+        }
+        if not needed:
+            root, nested = get_layout(archive_path, names)
+            return os.path.join(cache_dir, root)
+    else:
+        extracted, needed = set(), None
+
+    members = []
+    new_files = []
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    try:
+        for name, size, open_member in iter_members(archive_path):
+            members.append((name, size))
+            wanted = name in needed if needed is not None else is_needed(name, size, io_cls)
+            if wanted and name not in extracted:
+                if not is_safe(name):
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Archive member '{name}' would be extracted outside the target directory",
+                    )
+                tmp_path = os.path.join(tmp_dir, str(len(new_files)))
+                with open_member() as source, open(tmp_path, "wb") as target:
+                    shutil.copyfileobj(source, target, 1024**2)
+                new_files.append(name)
+        root, nested = get_layout(archive_path, [name for name, size in members])
+        for i, name in enumerate(new_files):
+            target_path = os.path.join(cache_dir, name) if nested else os.path.join(cache_dir, root, name)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(os.path.join(tmp_dir, str(i)), target_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    write_record(archive_path, {"members": members, "extracted": sorted(extracted | set(new_files))})
+    return os.path.join(cache_dir, root)
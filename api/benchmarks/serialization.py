@@ -0,0 +1,75 @@
+"""
+Benchmark of the serialization of analog signal data to JSON.
+
+Compares the original path (validated pydantic model built from Python lists,
+encoded with FastAPI's `jsonable_encoder` and `JSONResponse`)
+with the fast path (`AnalogSignal.from_data()` and `dump_json()`).
+
+Run from the repository root with:
+
+    python -m api.benchmarks.serialization
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import time
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+import numpy as np
+
+from ..data_models import AnalogSignal, dump_json
+
+
+def make_data(n_samples, n_channels, dtype):
+    rng = np.random.default_rng(seed=1)
+    return {
+        "t_start": 0.0,
+        "t_stop": n_samples * 1e-4,
+        "sampling_period": 1e-4,
+        "name": "benchmark signal",
+        "times_dimensionality": "s",
+        "values_units": "mV",
+        "values": rng.normal(-65.0, 5.0, size=(n_samples, n_channels)).astype(dtype),
+    }
+
+
+def original_path(data):
+    values = data["values"].T
+    if values.shape[0] == 1:
+        values = values[0]
+    model = AnalogSignal(**dict(data, values=values.tolist()))
+    return JSONResponse(content=jsonable_encoder(model)).body
+
+
+def fast_path(data):
+    return dump_json(AnalogSignal.from_data(data))
+
+
+def benchmark(func, data, repeats=3):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        content = func(data)
+        best = min(best, time.perf_counter() - start)
+    return best, len(content)
+
+
+def main():
+    print(f"{'samples x channels':>20} {'dtype':>8} {'path':>9} {'time (s)':>9} {'Msamples/s':>11} {'MB':>7}")
+    for n_samples, n_channels in [(100_000, 1), (1_000_000, 1), (1_000_000, 4), (250_000, 64)]:
+        for dtype in ("float32", "float64"):
+            data = make_data(n_samples, n_channels, dtype)
+            n_values = n_samples * n_channels
+            for name, func in (("original", original_path), ("fast", fast_path)):
+                elapsed, size = benchmark(func, data)
+                print(
+                    f"{n_samples:>11} x {n_channels:<6} {dtype:>8} {name:>9} {elapsed:>9.3f} "
+                    f"{n_values / elapsed / 1e6:>11.2f} {size / 1e6:>7.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
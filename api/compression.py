@@ -0,0 +1,195 @@
+"""
+Middleware for compressing responses with zstd, brotli or gzip, depending on what the client accepts.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import zlib
+
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from . import settings
+
+
+class GzipCompressor:
+    def __init__(self):
+        self._compressor = zlib.compressobj(settings.GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Return compressed output for all the data so far, without ending the stream."""
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=settings.BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self):
+        self._compressor = zstandard.ZstdCompressor(level=settings.ZSTD_LEVEL).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+def available_compressors():
+    """Compressors supported by this server, in order of preference."""
+    compressors = {}
+    if zstandard:
+        compressors["zstd"] = ZstdCompressor
+    if brotli:
+        compressors["br"] = BrotliCompressor
+    compressors["gzip"] = GzipCompressor
+    return compressors
+
+
+def choose_encoding(accept_encoding, compressors):
+    """
+    Choose a content encoding from those listed in the Accept-Encoding header,
+    preferring the encodings with the highest quality value,
+    then the server's order of preference.
+    """
+    accepted = {}
+    for item in accept_encoding.split(","):
+        encoding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        accepted[encoding.lower()] = quality
+    candidates = [
+        (-accepted.get(encoding, accepted.get("*", 0)), position, encoding)
+        for position, encoding in enumerate(compressors)
+    ]
+    candidates = [candidate for candidate in candidates if candidate[0] < 0]
+    if candidates:
+        return min(candidates)[2]
+    return None
+
+
+class CompressionMiddleware:
+    """
+    Compress response bodies larger than `minimum_size` bytes,
+    using the best encoding accepted by the client.
+
+    Streaming responses are compressed incrementally, with each chunk flushed
+    so that the client receives data as soon as it is produced.
+    """
+
+    def __init__(self, app, minimum_size=1000):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.compressors = available_compressors()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            headers = Headers(scope=scope)
+            encoding = choose_encoding(headers.get("Accept-Encoding", ""), self.compressors)
+            if encoding:
+                responder = CompressionResponder(
+                    self.app, encoding, self.compressors[encoding], self.minimum_size
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class CompressionResponder:
+    def __init__(self, app, encoding, compressor_cls, minimum_size):
+        self.app = app
+        self.encoding = encoding
+        self.compressor_cls = compressor_cls
+        self.minimum_size = minimum_size
+        self.send = None
+        self.initial_message = None
+        self.started = False
+        self.passthrough = False
+        self.compressor = None
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message):
+        message_type = message["type"]
+        if message_type == "http.response.start":
+            # we don't send the headers until we know whether to compress the body
+            self.initial_message = message
+            headers = Headers(raw=message["headers"])
+            self.passthrough = "content-encoding" in headers
+        elif message_type == "http.response.body" and self.passthrough:
+            if not self.started:
+                self.started = True
+                await self.send(self.initial_message)
+            await self.send(message)
+        elif message_type == "http.response.body" and not self.started:
+            self.started = True
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if len(body) < self.minimum_size and not more_body:
+                # small responses are not worth compressing
+                await self.send(self.initial_message)
+                await self.send(message)
+                return
+            self.compressor = self.compressor_cls()
+            headers = MutableHeaders(raw=self.initial_message["headers"])
+            headers["Content-Encoding"] = self.encoding
+            if "accept-encoding" not in headers.get("Vary", "").lower():
+                headers.add_vary_header("Accept-Encoding")
+            etag = headers.get("ETag")
+            if etag and etag.endswith('"') and not etag.startswith("W/"):
+                # each encoding is a different representation, with its own strong ETag
+                headers["ETag"] = f'{etag[:-1]}-{self.encoding}"'
+            if more_body:
+                del headers["Content-Length"]
+                message["body"] = self.compressor.compress(body) + self.compressor.flush()
+            else:
+                message["body"] = self.compressor.compress(body) + self.compressor.finish()
+                headers["Content-Length"] = str(len(message["body"]))
+            await self.send(self.initial_message)
+            await self.send(message)
+        elif message_type == "http.response.body":
+            body = message.get("body", b"")
+            if message.get("more_body", False):
+                message["body"] = self.compressor.compress(body) + self.compressor.flush()
+            else:
+                message["body"] = self.compressor.compress(body) + self.compressor.finish()
+            await self.send(message)
+        else:
+            await self.send(message)
@@ -0,0 +1,95 @@
+"""
+Running blocking work (downloading, parsing and serializing data) outside the asyncio event loop.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import functools
+
+import anyio
+
+from . import settings
+
+
+_executor = None
+
+# locks for `single_flight()`, with the number of tasks using each of them
+_flights = {}
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.EXECUTOR_MAX_WORKERS, thread_name_prefix="neo-viewer"
+        )
+    return _executor
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Run a blocking function in the executor, so that other requests
+    can be handled while it is running.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+
+@asynccontextmanager
+async def single_flight(key):
+    """
+    Context manager which lets only one task at a time enter it for a given key.
+
+    This is used around blocking work which would otherwise be serialized by a lock
+    in the executor (e.g. downloading and opening a data file), so that the other tasks
+    wait in the event loop, rather than each occupying a worker thread.
+    """
+    # locks belong to an event loop, and the test client runs one per client
+    flight_key = (asyncio.get_running_loop(), key)
+    flight = _flights.setdefault(flight_key, [asyncio.Lock(), 0])
+    flight[1] += 1
+    try:
+        async with flight[0]:
+            yield
+    finally:
+        flight[1] -= 1
+        if flight[1] == 0:
+            del _flights[flight_key]
+
+
+async def iterate_blocking(iterator):
+    """
+    Iterate over a blocking iterator, such as a generator which reads data from disk,
+    running each step in the executor.
+
+    The iterator is closed at the end, even if iteration is interrupted
+    (e.g. because the client disconnected), once any step in progress has finished.
+    """
+    sentinel = object()
+    future = None
+    try:
+        while True:
+            future = get_executor().submit(next, iterator, sentinel)
+            item = await asyncio.wrap_future(future)
+            if item is sentinel:
+                break
+            yield item
+    finally:
+        if future is not None and not future.done():
+            # a generator cannot be closed while it is running
+            with anyio.CancelScope(shield=True):
+                await asyncio.wait([asyncio.wrap_future(future)])
+        if hasattr(iterator, "close"):
+            iterator.close()
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -8,14 +8,30 @@ Licence: MIT (see LICENSE)
 
 import os.path
 import hashlib
-from urllib.request import urlopen, urlretrieve, HTTPError
+import json
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from email.utils import formatdate
 from urllib.parse import urlparse, urlunparse
-import zipfile
 from fastapi import HTTPException, status
+import httpx
 import neo.io
+import numpy as np
 import quantities as pq
 
 from . import settings
+from .archives import extract, get_record_path, get_root, is_archive
+from .disk_cache import disk_cache, file_lock, get_lock_path, get_data_size
+from .metadata_index import metadata_index
+from .downloader import (
+    download_files, get_client, get_range_validator, get_validators_path, probe,
+    read_record, write_record
+)
+from .remote_file import REMOTE_IOS, RemoteFile, get_block_map_path, get_remote_io_class
 
 
 def get_base_url_and_path(url):
@@ -52,6 +68,71 @@ def get_cache_path(url):
     return dir_path, filename
 
 
+def write_atomically(path, content):
+    """
+    Write text to a file such that other processes never see a partially-written file.
+    """
+    dir_path = os.path.dirname(path)
+    os.makedirs(dir_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def get_resolved_url_record_path(url):
+    url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()
+    return os.path.join(
+        getattr(settings, "DOWNLOADED_FILE_CACHE_DIR", ""), "resolved_urls", url_hash + ".json"
+    )
+
+
+def resolve_url(url):
+    """
+    Follow any redirects for the given URL, to obtain a consistent address for caching.
+
+    The resolved URL is stored in the download cache directory, so that it is shared
+    between worker processes, and is reused for `settings.RESOLVED_URL_TTL` seconds
+    without contacting the remote server. If the remote server cannot be reached,
+    an expired record is used in preference to failing.
+    """
+    record_path = get_resolved_url_record_path(url)
+    record = None
+    if os.path.exists(record_path):
+        try:
+            with open(record_path) as fp:
+                record = json.load(fp)
+        except ValueError:
+            pass
+        else:
+            if time.time() - record["resolved_at"] < settings.RESOLVED_URL_TTL:
+                return record["resolved_url"]
+
+    try:
+        # only the headers are read, the body is downloaded later if needed
+        with get_client().stream("GET", url) as response:
+            response.raise_for_status()
+            resolved_url = str(response.url)
+    except httpx.HTTPStatusError as err:
+        raise HTTPException(
+            status_code=err.response.status_code,
+            detail=f"Error retrieving {url}: {err.response.reason_phrase}"
+        )
+    except httpx.TransportError:
+        if record:
+            return record["resolved_url"]
+        raise
+    write_atomically(
+        record_path,
+        json.dumps({"url": url, "resolved_url": resolved_url, "resolved_at": time.time()})
+    )
+    return resolved_url
+
+
 def list_files_to_download(resolved_url, cache_dir, io_cls=None):
     base_url, main_file = get_base_url_and_path(resolved_url)
     file_list = [(resolved_url, os.path.join(cache_dir, main_file), True)]
@@ -59,7 +140,7 @@ def list_files_to_download(resolved_url, cache_dir, io_cls=None):
         root_path, ext = os.path.splitext(main_file)
         io_mode = getattr(io_cls, "rawmode", None)
         if io_mode == "one-dir":
-            if not resolved_url.endswith(".zip"):
+            if not is_archive(resolved_url):
                 # In general, we don't know the names of the individual files
                 # and have no way to get a directory listing from a URL
                 # so we raise an exception
@@ -121,6 +202,143 @@ def list_files_to_download(resolved_url, cache_dir, io_cls=None):
     return file_list
 
 
+def is_modified(resolved_url, path):
+    """
+    Check whether the file at `resolved_url` has changed since it was downloaded to `path`.
+
+    This uses a conditional request, with the validators (ETag and Last-Modified) recorded when
+    the file was downloaded, or with the time of download for files downloaded before validators
+    were recorded, so the file is not downloaded again if it is unchanged.
+    Files are checked at most once every `settings.DOWNLOAD_CACHE_MAX_AGE` seconds.
+    If the remote server cannot be reached, the file is assumed to be unchanged.
+    """
+    if settings.DOWNLOAD_CACHE_MAX_AGE < 0:
+        return False
+    record_path = get_validators_path(path)
+    record = read_record(record_path) or {}
+    if time.time() - record.get("checked_at", os.path.getmtime(path)) < settings.DOWNLOAD_CACHE_MAX_AGE:
+        return False
+    validators = record.get("validators", {})
+    headers = {
+        "If-Modified-Since": validators.get("Last-Modified")
+        or formatdate(os.path.getmtime(path), usegmt=True)
+    }
+    if "ETag" in validators:
+        headers["If-None-Match"] = validators["ETag"]
+    try:
+        # only the headers are read
+        with get_client().stream("GET", resolved_url, headers=headers) as response:
+            modified = response.status_code == status.HTTP_200_OK
+    except httpx.TransportError:
+        modified = False
+    if not modified:
+        write_record(record_path, dict(record, checked_at=time.time()))
+    return modified
+
+
+def get_file_version(url):
+    """
+    Return information identifying the version of the data file at the given URL which is
+    in the download cache, without opening or downloading it: the resolved URL together with
+    the validators of the file, or with its size and modification time if it has none.
+
+    Returns None if the file is not in the cache, or is due to be checked for changes
+    (see `is_modified()`), in which case the version will only be known once it has been opened.
+    """
+    try:
+        resolved_url = resolve_url(url)
+    except (HTTPException, httpx.HTTPError):
+        return None
+    cache_dir, main_file = get_cache_path(resolved_url)
+    main_path = os.path.join(cache_dir, main_file)
+    try:
+        stat = os.stat(main_path)
+    except FileNotFoundError:
+        return None
+    record = read_record(get_validators_path(main_path)) or {}
+    max_age = settings.DOWNLOAD_CACHE_MAX_AGE
+    if max_age >= 0 and time.time() - record.get("checked_at", stat.st_mtime) >= max_age:
+        return None
+    return {
+        "url": resolved_url,
+        "validators": record.get("validators") or {"size": stat.st_size, "mtime": stat.st_mtime_ns},
+    }
+
+
+def get_index_key(url):
+    """
+    Return the location of the downloaded data file at the given URL and a string identifying
+    its version, together with the version of Neo, for use as a key in `metadata_index`,
+    or None if the version of the file is not known, see `get_file_version()`.
+    """
+    version = get_file_version(url)
+    if version is None:
+        return None
+    cache_dir, main_file = get_cache_path(version["url"])
+    key = json.dumps({"validators": version["validators"], "neo": neo.__version__}, sort_keys=True)
+    return os.path.join(cache_dir, main_file), key
+
+
+def record_cached_access(url):
+    """
+    Record an access to the data file at the given URL in the download cache, when a response
+    concerning it is served from `metadata_index`, from `response_cache.response_cache`
+    or as "Not Modified", without opening the file, so that it is not evicted as unused.
+    """
+    try:
+        resolved_url = resolve_url(url)
+    except (HTTPException, httpx.HTTPError):
+        return
+    cache_dir, main_file = get_cache_path(resolved_url)
+    main_path = os.path.join(cache_dir, main_file)
+    if is_archive(main_path):
+        main_path = get_root(main_path, cache_dir) or main_path
+    disk_cache.touch(main_path)
+
+
+def get_file_key(url, io_class_name=None):
+    """
+    Return a key identifying the data file at the given URL, whatever URL redirects to it,
+    and the IO used to read it, without downloading or opening the file.
+    """
+    return resolve_url(url), io_class_name
+
+
+def invalidate(main_path, downloaded_path):
+    """
+    Delete a data file which has changed on the remote server from the download cache,
+    together with any files derived from it. If it is in use, it is moved out of the way
+    instead, and deleted once it is no longer in use, see `disk_cache.DiskCache.retire()`.
+    Either way, the new version can then be downloaded in its place.
+    `main_path` is the entry in the download cache, e.g. the directory extracted from an archive
+    or the block cache of a file read remotely, `downloaded_path` the downloaded file.
+    """
+    io_cache.discard_path(main_path)
+    metadata_index.discard(downloaded_path)
+    files = disk_cache.get_files(main_path)
+    if files is None:
+        files = [downloaded_path, get_validators_path(downloaded_path)]
+        disk_cache.record_access(main_path, files)
+    if disk_cache.evict(main_path, files) or disk_cache.retire(main_path, files):
+        return
+    if os.path.exists(downloaded_path):
+        # not expected, but if the old file remains in use, it is not checked again at every request
+        record_path = get_validators_path(downloaded_path)
+        write_record(record_path, dict(read_record(record_path) or {}, checked_at=time.time()))
+
+
+def get_downloaded_files(files_to_download):
+    """
+    Return those of the files listed by `list_files_to_download()` which are in the download cache,
+    each followed by the record of its validators, for use as the files of a download cache entry.
+    """
+    downloaded_files = []
+    for file_url, file_path, required in files_to_download:
+        if os.path.exists(file_path):
+            downloaded_files.extend([file_path, get_validators_path(file_path)])
+    return downloaded_files
+
+
 def download_neo_data(url, io_cls=None):
     """
     Download a neo data file from the given URL.
@@ -128,49 +346,135 @@ def download_neo_data(url, io_cls=None):
     We do not at present handle formats that require multiple files,
     for which the URL should probably point to a zip or tar archive.
     """
-    # we first open the url to resolve any redirects and have a consistent
-    # address for caching.
-    try:
-        response = urlopen(url)
-    except HTTPError as err:
-        raise HTTPException(
-            status_code=err.code,
-            detail=f"Error retrieving {url}: {err.msg}"
-        )
-    resolved_url = response.geturl()
+    # we first resolve any redirects to have a consistent address for caching.
+    resolved_url = resolve_url(url)
 
     cache_dir, main_file = get_cache_path(resolved_url)
-    if not os.path.exists(os.path.join(cache_dir, main_file)):
-        files_to_download = list_files_to_download(resolved_url, cache_dir, io_cls)
-        for file_url, file_path, required in files_to_download:
-            try:
-                urlretrieve(file_url, file_path)
-            except HTTPError:
-                if required:
-                    # todo: may not be a 404, could also be a 500 if local disk is full
-                    raise HTTPException(
-                        status_code=status.HTTP_404_NOT_FOUND,  # maybe use 501 Not Implemented?
-                        detail=f"Problem downloading '{file_url}'"
-                    )
-        main_path = files_to_download[0][1]
+    main_path = os.path.join(cache_dir, main_file)
+    downloaded_files = None
+    if os.path.exists(main_path) and is_modified(resolved_url, main_path):
+        # requests already using the cached copy continue to use it
+        if is_archive(main_path):
+            invalidate(get_root(main_path, cache_dir) or main_path, main_path)
+        else:
+            invalidate(main_path, main_path)
+    if not os.path.exists(main_path):
+        # Files only appear in the cache once complete. While one thread or worker process
+        # downloads a file, any others requesting it wait for the download to finish.
+        with file_lock(get_lock_path(main_path)):
+            if not os.path.exists(main_path):
+                files_to_download = list_files_to_download(resolved_url, cache_dir, io_cls)
+                errors = download_files(files_to_download)
+                for (file_url, file_path, required), error in zip(files_to_download, errors):
+                    if error is not None and required:
+                        # todo: may not be a 404, could also be a 500 if local disk is full
+                        raise HTTPException(
+                            status_code=status.HTTP_404_NOT_FOUND,  # maybe use 501 Not Implemented?
+                            detail=f"Problem downloading '{file_url}'"
+                        )
+                downloaded_files = get_downloaded_files(files_to_download)
+    new = downloaded_files is not None
+    if not new and disk_cache.get_files(main_path) is None:
+        # e.g. the index was deleted: the entry must include any companion files
+        downloaded_files = get_downloaded_files(list_files_to_download(resolved_url, cache_dir, io_cls))
+    entry_files = downloaded_files or [main_path]
+    if is_archive(main_path):
+        archive_path = main_path
+        main_path = get_archive_dir(archive_path, cache_dir, io_cls)
+        entry_files.extend([main_path, get_record_path(archive_path)])
+        disk_cache.record_access(main_path, entry_files, new=new)
+        if not new:
+            # further files may have been extracted, for a different IO
+            disk_cache.update_size(main_path)
     else:
-        main_path = os.path.join(cache_dir, main_file)
-    if main_path.endswith(".zip"):
-        main_path = get_archive_dir(main_path, cache_dir)
+        disk_cache.record_access(main_path, entry_files, new=new)
     return main_path
 
 
-def get_archive_dir(archive_path, cache_dir):
-    with zipfile.ZipFile(archive_path) as zf:
-        contents = zf.infolist()
-        dir_name = contents[0].filename.strip("/")
-        main_path = os.path.join(cache_dir, dir_name)
-        if not os.path.exists(main_path):
-            zf.extractall(path=cache_dir)
-    # we are assuming the zipfile unpacks to a single directory
-    # todo: check this is the case, and if not either raise an Exception
-    #       or create our own directory to unpack in to
-    return main_path
+def download_and_pin(url, io_cls=None):
+    """
+    Download the data file at the given URL if necessary, see `download_neo_data()`,
+    and mark it as in use, so that it cannot be deleted from the download cache.
+
+    Returns the location of the file and the pin, which must be closed once the file is no longer needed.
+    """
+    while True:
+        main_path = download_neo_data(url, io_cls=io_cls)
+        pin = disk_cache.pin(main_path)
+        if os.path.exists(main_path):
+            return main_path, pin
+        # deleted by another worker process since we checked
+        pin.close()
+
+
+def get_remote_path(url, io_cls=None):
+    """
+    Decide whether the data file at the given URL should be read remotely, with range requests,
+    rather than downloaded in full, see `remote_file.RemoteFile`. This is the case for large files
+    read with IOs in `remote_file.REMOTE_IOS` which have not already been downloaded,
+    if the server supports range requests.
+
+    Returns the resolved URL and the location of the local block cache, or None.
+    """
+    if io_cls is None or io_cls.__name__ not in REMOTE_IOS:
+        return None
+    resolved_url = resolve_url(url)
+    cache_dir, main_file = get_cache_path(resolved_url)
+    if os.path.exists(os.path.join(cache_dir, main_file)):
+        return None
+    remote_path = os.path.join(cache_dir, f"{main_file}.remote")
+    if not os.path.exists(remote_path):
+        with file_lock(get_lock_path(remote_path)):
+            if not os.path.exists(remote_path):
+                try:
+                    size, accepts_ranges, validators = probe(resolved_url)
+                except httpx.HTTPStatusError:
+                    raise HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail=f"Problem downloading '{resolved_url}'"
+                    )
+                # without a validator, we could not tell if the file changed between reads
+                if not (
+                    accepts_ranges and get_range_validator(validators)
+                    and size and size >= settings.REMOTE_READING_MIN_SIZE
+                ):
+                    return None
+                RemoteFile.create(remote_path, size, validators)
+    return resolved_url, remote_path
+
+
+def pin_remote_file(url, io_cls=None):
+    """
+    If the data file at the given URL should be read remotely (see `get_remote_path()`),
+    mark its block cache as in use, so that it cannot be deleted from the download cache.
+
+    Returns the resolved URL, the location of the block cache and the pin, or None.
+    """
+    while True:
+        remote = get_remote_path(url, io_cls)
+        if remote is None:
+            return None
+        resolved_url, remote_path = remote
+        pin = disk_cache.pin(remote_path)
+        if os.path.exists(remote_path):
+            disk_cache.record_access(
+                remote_path,
+                [remote_path, get_block_map_path(remote_path), get_validators_path(remote_path)]
+            )
+            # blocks may have been downloaded since the last access
+            disk_cache.update_size(remote_path)
+            return resolved_url, remote_path, pin
+        pin.close()
+
+
+def get_archive_dir(archive_path, cache_dir, io_cls=None):
+    """
+    Extract the files needed by the Neo IO `io_cls` from a zip or tar archive,
+    if not already extracted, and return the path of the directory containing them.
+    See `archives.extract()`.
+    """
+    with file_lock(get_lock_path(archive_path)):
+        return extract(archive_path, cache_dir, io_cls)
 
 
 extra_kwargs = {
@@ -179,46 +483,249 @@ extra_kwargs = {
     }
 }
 
-def load_blocks(url, io_class_name=None):
+
+class IOCacheEntry:
     """
-    Load the first block from the data file at the given URL.
+    An opened Neo IO, together with the (lazy) blocks read from it.
 
-    If io_class_name is provided, we use the Neo IO class with that name
-    to open the file, otherwise we use Neo's `get_io()` function to
-    find an appropriate class.
+    The `lock` must be held while accessing `io` or `blocks`,
+    since Neo IOs are not in general thread-safe.
     """
-    assert isinstance(url, str)
-    # todo: handle formats with multiple files, or with a directory
-    if io_class_name:
-        io_cls = getattr(neo.io, io_class_name.value)
-        main_path = download_neo_data(url, io_cls=io_cls)
-        try:
-            if io_cls.mode == "dir":
-                io = io_cls(dirname=main_path)
-            elif io_cls.__name__ == "NestIO":
-                io = io_cls(filenames=main_path)
+
+    def __init__(self, key):
+        self.key = key
+        self.io = None
+        self.blocks = None
+        self.size = 0
+        self.lock = threading.Lock()
+        self.users = 0
+        # prevents the data file being deleted from the download cache, see `disk_cache.pin()`
+        self.pin = None
+        # identifies the version of the data file which was opened, see `get_file_id()`
+        self.file_id = None
+
+    @property
+    def main_path(self):
+        """Location of the data file (or directory) in the download cache."""
+        return self.key[0]
+
+    @property
+    def io_cls(self):
+        return self.key[1]
+
+    def close(self):
+        if hasattr(self.io, "close"):
+            self.io.close()
+        self.io = None
+        self.blocks = None
+        if self.pin is not None:
+            self.pin.close()
+            self.pin = None
+
+
+class IOCache:
+    """
+    Bounded, least-recently-used cache of opened Neo IOs and the blocks read from them,
+    so that the file headers do not need to be parsed again for every request.
+
+    The size of an entry is estimated from the size of the data files on disk.
+    This is exact for IOs which do not support lazy loading, and an upper bound otherwise.
+    Entries which are in use by a request are never evicted.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def total_size(self):
+        return sum(entry.size for entry in self._entries.values())
+
+    def checkout(self, key):
+        """
+        Return the entry for the given key, creating an empty one if needed.
+
+        Each call must be matched by a call to `checkin()`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = IOCacheEntry(key)
+                self._entries[key] = entry
             else:
-                io = io_cls(filename=main_path)
-        except ImportError:
-            raise HTTPException(
-                status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,  # maybe use 501 Not Implemented?
-                detail=f"This server does not have the {io_class_name} module installed.",
-            )
-        except (RuntimeError, TypeError, OSError) as err:  # RuntimeError from NixIO, TypeError from TdtIO, OSError from EDFIO
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f'Error when trying to open file with {io_class_name}: "{err}"',
-            )
-        except FileNotFoundError as err:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f'Associated file not found. More details: "{err}"'
-            )
-    else:
+                self._entries.move_to_end(key)
+            entry.users += 1
+        return entry
+
+    def checkin(self, entry):
+        """Release an entry obtained with `checkout()`, and evict entries if over budget."""
+        to_close = []
+        with self._lock:
+            entry.users -= 1
+            if entry.users == 0 and self._entries.get(entry.key) is not entry:
+                # discarded while in use
+                to_close.append(entry)
+            elif entry.blocks is None and entry.users == 0:
+                # opening the file failed, so we don't keep the entry
+                del self._entries[entry.key]
+            for key, candidate in list(self._entries.items()):
+                if len(self._entries) <= self.max_entries and self.total_size <= self.max_bytes:
+                    break
+                if candidate.users == 0:
+                    del self._entries[key]
+                    to_close.append(candidate)
+        for evicted in to_close:
+            evicted.close()
+
+    def discard(self, key):
+        """
+        Remove an entry, e.g. because the underlying file has changed.
+        Entries which are in use are closed once they are checked in.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry.users > 0:
+                return
+        entry.close()
+
+    def discard_path(self, main_path):
+        """Remove all entries for the data file (or directory) at `main_path`, with any IO class."""
+        with self._lock:
+            keys = [key for key in self._entries if key[0] == main_path]
+        for key in keys:
+            self.discard(key)
+
+    def clear(self):
+        with self._lock:
+            entries = [entry for entry in self._entries.values() if entry.users == 0]
+            for entry in entries:
+                del self._entries[entry.key]
+        for entry in entries:
+            entry.close()
+
+
+io_cache = IOCache(settings.IO_CACHE_MAX_ENTRIES, settings.IO_CACHE_MAX_BYTES)
+
+
+def get_io(main_path, io_cls=None, io_class_name=None):
+    """
+    Create a Neo IO for the file or directory at `main_path`,
+    or for a `remote_file.RemoteFile` if `io_cls` is one of `remote_file.REMOTE_IOS`.
+
+    If `io_cls` is None, we use Neo's `get_io()` function to find an appropriate class.
+    """
+    if io_cls is None:
         # todo: handle IOError, if none of the IO classes work
-        main_path = download_neo_data(url)
-        io = neo.io.get_io(main_path)
+        return neo.io.get_io(main_path)
+    try:
+        if io_cls.mode == "dir":
+            io = io_cls(dirname=main_path)
+        elif io_cls.__name__ == "NestIO":
+            io = io_cls(filenames=main_path)
+        elif isinstance(main_path, RemoteFile):
+            io = get_remote_io_class(io_cls)(main_path)
+        else:
+            io = io_cls(filename=main_path)
+    except ImportError:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,  # maybe use 501 Not Implemented?
+            detail=f"This server does not have the {io_class_name} module installed.",
+        )
+    except (RuntimeError, TypeError, OSError) as err:  # RuntimeError from NixIO, TypeError from TdtIO, OSError from EDFIO
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Error when trying to open file with {io_class_name}: "{err}"',
+        )
+    except FileNotFoundError as err:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Associated file not found. More details: "{err}"'
+        )
+    return io
 
+
+def read_nix_structure(main_path):
+    """
+    Read the blocks and segments in a NIX file, with their metadata, as `NixIO` would,
+    but without reading any data: each signal or spike train is replaced by an empty one,
+    with the same number of channels, units and sampling rate.
+    """
+    from neo.io.nixio import NixIO, create_quantity
+
+    io = NixIO(main_path, mode="ro")
+    try:
+        blocks = []
+        for nix_block in io.nix_file.blocks:
+            block = neo.Block(**NixIO._nix_attr_to_neo(nix_block))
+            block.rec_datetime = datetime.fromtimestamp(nix_block.created_at)
+            for nix_group in nix_block.groups:
+                if nix_group.type != "neo.segment":
+                    continue
+                segment = neo.Segment(**NixIO._nix_attr_to_neo(nix_group))
+                segment.rec_datetime = datetime.fromtimestamp(nix_group.created_at)
+                # each channel of a signal is stored in a separate DataArray
+                for das in NixIO._group_signals(nix_group.data_arrays).values():
+                    empty = np.empty((0, len(das)))
+                    if das[0].type == "neo.analogsignal":
+                        time_dimension = NixIO._get_time_dimension(das[0])
+                        segment.analogsignals.append(
+                            neo.AnalogSignal(
+                                empty, units=create_quantity(1, das[0].unit).units,
+                                sampling_period=create_quantity(
+                                    time_dimension.sampling_interval, time_dimension.unit
+                                ),
+                            )
+                        )
+                    elif das[0].type == "neo.irregularlysampledsignal":
+                        segment.irregularlysampledsignals.append(
+                            neo.IrregularlySampledSignal(
+                                [], empty, units=create_quantity(1, das[0].unit).units, time_units="s"
+                            )
+                        )
+                for multi_tag in nix_group.multi_tags:
+                    if multi_tag.type == "neo.spiketrain":
+                        segment.spiketrains.append(neo.SpikeTrain([], units="s", t_stop=0))
+                block.segments.append(segment)
+            blocks.append(block)
+    finally:
+        io.close()
+    return blocks
+
+
+# Neo IOs which do not support lazy loading, with functions which read the structure
+# of their files (see `read_nix_structure()`) for `BlockContainer.from_neo()`,
+# so that the block metadata can be obtained without reading all the data
+STRUCTURE_READERS = {
+    "NixIO": read_nix_structure,
+}
+
+
+def get_structure_reader(main_path, io_cls=None):
+    """
+    Return the function which can read the structure of the file at `main_path`, or None.
+    If `io_cls` is None, we use the first IO class which `neo.io.get_io()` would try.
+    """
+    if io_cls is None:
+        try:
+            candidates = neo.io.list_candidate_ios(main_path)
+        except ValueError:
+            return None
+        if not candidates:
+            return None
+        io_cls = candidates[0]
+    return STRUCTURE_READERS.get(io_cls.__name__)
+
+
+def read_blocks(io):
+    """Read all blocks from a Neo IO, lazily if the IO supports it."""
     try:
         if io.support_lazy:
             blocks = io.read(lazy=True)
@@ -230,6 +737,147 @@ def load_blocks(url, io_class_name=None):
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f'Error when trying to open file with {io.__class__.__name__}: "{err}"',
         )
-    if hasattr(io, "close"):
-        io.close()
     return blocks
+
+
+def get_file_id(path):
+    """Identify a file or directory in the download cache, which changes when a new version replaces it."""
+    stat = os.stat(path)
+    return stat.st_dev, stat.st_ino
+
+
+def checkout_cache_entry(url, io_class_name=None):
+    """
+    Return the `io_cache` entry for the data file at the given URL,
+    downloading and opening the file if necessary.
+
+    The entry cannot be evicted from the cache until it is released with `io_cache.checkin()`,
+    but it is not locked: the caller must hold `entry.lock` while accessing the IO or blocks.
+    This allows the data to be read in several steps, e.g. while streaming a response.
+
+    See `open_cache_entry()` for the meaning of the arguments.
+    """
+    assert isinstance(url, str)
+    # todo: handle formats with multiple files, or with a directory
+    if io_class_name:
+        io_cls = getattr(neo.io, io_class_name.value)
+    else:
+        io_cls = None
+    remote = pin_remote_file(url, io_cls)
+    if remote:
+        resolved_url, main_path, pin = remote
+    else:
+        main_path, pin = download_and_pin(url, io_cls)
+
+    file_id = None if remote else get_file_id(main_path)
+    entry = io_cache.checkout((main_path, io_cls))
+    if entry.blocks is not None and entry.file_id != file_id:
+        # the file has been replaced by a new version, e.g. by another worker process
+        io_cache.discard(entry.key)
+        io_cache.checkin(entry)
+        entry = io_cache.checkout((main_path, io_cls))
+    try:
+        with entry.lock:
+            if entry.blocks is None:
+                if remote:
+                    # if the file changes on the server, the block cache is replaced
+                    # the next time the file is requested, see `get_remote_path()`
+                    remote_file = RemoteFile(
+                        resolved_url, main_path, on_change=lambda: invalidate(main_path, main_path)
+                    )
+                    try:
+                        io = get_io(remote_file, io_cls, io_class_name)
+                        entry.blocks = read_blocks(io)
+                    except BaseException:
+                        remote_file.close()
+                        raise
+                else:
+                    io = get_io(main_path, io_cls, io_class_name)
+                    entry.blocks = read_blocks(io)
+                entry.io = io
+                entry.file_id = file_id
+                entry.size = get_data_size(main_path)
+                # the data file remains pinned for as long as the entry is in the cache
+                entry.pin, pin = pin, None
+    except BaseException:
+        io_cache.checkin(entry)
+        raise
+    finally:
+        if pin is not None:
+            pin.close()
+    return entry
+
+
+@contextmanager
+def open_cache_entry(url, io_class_name=None):
+    """
+    Context manager giving access to the `io_cache` entry for the data file at the given URL,
+    downloading and opening the file if necessary.
+
+    If io_class_name is provided, we use the Neo IO class with that name
+    to open the file, otherwise we use Neo's `get_io()` function to
+    find an appropriate class.
+
+    Opened IOs are kept in `io_cache`, keyed by the location of the file
+    in the download cache (which is determined by the resolved URL) and by IO class.
+    The cache entry is locked while the context is active, so any lazy loading of data
+    from the blocks should take place within the context.
+    """
+    entry = checkout_cache_entry(url, io_class_name)
+    try:
+        with entry.lock:
+            yield entry
+    finally:
+        io_cache.checkin(entry)
+
+
+@contextmanager
+def open_blocks(url, io_class_name=None):
+    """
+    Context manager giving access to all the blocks in the data file at the given URL.
+
+    See `open_cache_entry()`.
+    """
+    with open_cache_entry(url, io_class_name) as entry:
+        yield entry.blocks
+
+
+def load_block_structure(url, io_class_name=None):
+    """
+    For a data file which would be read with an IO which does not support lazy loading,
+    return the blocks it contains, with their segments, but with empty signals and spike trains,
+    see `STRUCTURE_READERS`. These give the same result as the blocks read by the IO
+    with `BlockContainer.from_neo()`, without reading any data.
+
+    Returns None if the structure cannot be read in this way, or if the file is already open
+    in `io_cache`, in which case the file should be opened with `open_blocks()`.
+    """
+    if io_class_name:
+        io_cls = getattr(neo.io, io_class_name.value)
+        if io_cls.__name__ not in STRUCTURE_READERS:
+            return None
+    else:
+        io_cls = None
+    main_path, pin = download_and_pin(url, io_cls)
+    try:
+        read_structure = get_structure_reader(main_path, io_cls)
+        if read_structure is None or (main_path, io_cls) in io_cache:
+            return None
+        try:
+            return read_structure(main_path)
+        except Exception:
+            # the IO will report the problem, if it cannot read the file either
+            return None
+    finally:
+        pin.close()
+
+
+def load_blocks(url, io_class_name=None):
+    """
+    Load all blocks from the data file at the given URL.
+
+    Note that lazily-loaded data objects should be loaded within `open_blocks()`
+    instead, to avoid concurrent access to the underlying IO.
+    """
+    with open_blocks(url, io_class_name) as blocks:
+        return blocks
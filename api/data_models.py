@@ -6,14 +6,22 @@ Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud
 Licence: MIT (see LICENSE)
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from enum import Enum
+import json
 from pydantic import BaseModel, HttpUrl
 import dateparser
 import numpy as np
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from neo.io import iolist, proxyobjects
 import neo
 
+from . import settings
+from .decimation import get_sample_range, iter_chunks, min_max_decimate
+
 
 def sanitise_annotations(annotations):
     """Ensure that annotation values can be serialized to JSON, by converting them to strings."""
@@ -36,6 +44,123 @@ def parse_datetime(datetime_repr):
         return None
 
 
+def parse_channel_selection(selection, n_channels):
+    """
+    Convert a channel selection such as "0,3,5-7" into a list of channel indices.
+
+    Ranges include both ends. Raises ValueError if the selection cannot be parsed
+    or refers to channels that do not exist.
+    """
+    channel_indexes = []
+    try:
+        for item in selection.split(","):
+            if "-" in item:
+                first, last = item.split("-")
+                channel_indexes.extend(range(int(first), int(last) + 1))
+            else:
+                channel_indexes.append(int(item))
+    except ValueError:
+        raise ValueError(
+            f"Invalid channel selection '{selection}'. "
+            "Please give channel indices and/or ranges, e.g. '0,3,5-7'"
+        )
+    if not channel_indexes:
+        raise ValueError(f"Channel selection '{selection}' is empty")
+    for index in channel_indexes:
+        if index < 0 or index >= n_channels:
+            raise ValueError(
+                f"Channel index {index} is out of range, the signal has {n_channels} channels"
+            )
+    return channel_indexes
+
+
+class ValueDtype(str, Enum):
+    float32 = "float32"
+    float64 = "float64"
+
+
+def reduce_precision(values, dtype=None, precision=None):
+    """
+    Round signal values to `precision` significant digits and/or convert them to `dtype`,
+    to reduce the size of responses. Both JSON (which writes the shortest representation
+    of each number) and the binary formats (once compressed) benefit from this.
+    """
+    if precision:
+        rounded = np.asarray(values, dtype=np.float64)
+        magnitude = np.abs(rounded)
+        # number of decimal places to keep, negative for rounding to tens, hundreds, etc.
+        decimals = precision - 1 - np.floor(np.log10(np.where(magnitude > 0, magnitude, 1)))
+        # values so extreme that the scale factor would overflow are left unchanged
+        unchanged = np.abs(decimals) > 300
+        decimals = np.where(unchanged, 0, decimals)
+        # rounding with a power of ten >= 1 avoids the representation error of e.g. 1e-3
+        scale = 10.0 ** np.abs(decimals)
+        rounded = np.where(
+            unchanged,
+            rounded,
+            np.where(decimals >= 0, np.round(rounded * scale) / scale, np.round(rounded / scale) * scale),
+        )
+        values = rounded.astype(values.dtype if values.dtype.kind == "f" else np.float64)
+    if dtype:
+        values = values.astype(ValueDtype(dtype).value, copy=False)
+    return values
+
+
+def _native_byte_order(value):
+    """
+    Convert numpy arrays in non-native byte order, as returned by many Neo IOs,
+    since orjson serializes arrays from their raw bytes, whatever their byte order.
+    """
+    if isinstance(value, np.ndarray) and not value.dtype.isnative:
+        return value.astype(value.dtype.newbyteorder("="), copy=False)
+    return value
+
+
+def _json_default(obj):
+    """Convert objects which are not natively supported by the JSON encoder."""
+    if isinstance(obj, BaseModel):
+        # nested models and numpy arrays are handled by further calls to this function
+        return {key: _native_byte_order(value) for key, value in obj}
+    if isinstance(obj, np.ndarray):
+        if obj.ndim == 0:
+            return obj.item()
+        if orjson:
+            # orjson serializes C-contiguous arrays of standard dtypes directly
+            if obj.dtype.kind in "fiub" and not obj.flags.c_contiguous:
+                return np.ascontiguousarray(obj)
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, datetime):
+        # as written by pydantic (and by orjson with OPT_UTC_Z), UTC is shown as "Z"
+        text = obj.isoformat()
+        if obj.utcoffset() == timedelta(0):
+            text = text[:-len("+00:00")] + "Z"
+        return text
+    # e.g. pydantic URLs
+    return str(obj)
+
+
+def dump_json(content):
+    """
+    Encode models (or dicts or lists of models) as JSON bytes.
+
+    This is much faster than `model.model_dump_json()` or FastAPI's `jsonable_encoder()`
+    for models containing large numpy arrays, as created by `from_data()`,
+    since the arrays are written directly rather than being converted to Python lists.
+    """
+    if orjson:
+        # arrays in models are converted in _json_default()
+        if isinstance(content, dict):
+            content = {key: _native_byte_order(value) for key, value in content.items()}
+        else:
+            content = _native_byte_order(content)
+        return orjson.dumps(
+            content, default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z
+        )
+    return json.dumps(content, default=_json_default, separators=(",", ":")).encode("utf-8")
+
+
 exclude = ["neo.io.exampleio", "neo.io.nixio_fr", "neo.io.neurosharectypesio"]
 
 IOModule = Enum(
@@ -55,13 +180,29 @@ class SpikeTrain(BaseModel):
 
     @classmethod
     def from_neo(cls, spike_train):
+        return cls.from_data(cls.data_from_neo(spike_train))
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Create the model, without validation, from the output of `data_from_neo()`.
+        The spike times remain as a numpy array, to be serialized with `dump_json()`.
+        """
+        return cls.model_construct(**dict(data, t_stop=float(data["t_stop"])))
+
+    @classmethod
+    def data_from_neo(cls, spike_train):
+        """
+        Extract the metadata and data from a Neo spike train, as a dict with the same fields
+        as the model, except that "times" is a numpy array.
+        """
         if isinstance(spike_train, proxyobjects.BaseProxy):
             spike_train = spike_train.load()
-        return cls(
-            units=str(spike_train.units.dimensionality),
-            t_stop=spike_train.t_stop.magnitude,
-            times=spike_train.times.magnitude.tolist(),
-        )
+        return {
+            "units": str(spike_train.units.dimensionality),
+            "t_stop": spike_train.t_stop.magnitude,
+            "times": spike_train.times.magnitude,
+        }
 
 
 class AnalogSignal(BaseModel):
@@ -81,9 +222,85 @@ class AnalogSignal(BaseModel):
     times: list[float] | None = None
 
     @classmethod
-    def from_neo(cls, signal, down_sample_factor):
+    def get_time_slice(cls, signal, t_start=None, t_stop=None):
+        """
+        Return the time window (t_start, t_stop) as quantities, or None for the entire signal.
+
+        `t_start` and `t_stop` are given in the time units of the signal,
+        and the window is clipped to the extent of the signal.
+        """
+        if t_start is None and t_stop is None:
+            return None
+        if t_start is not None and t_stop is not None and t_start >= t_stop:
+            raise ValueError("t_start must be less than t_stop")
+        time_units = signal.t_start.units
+        sig_t_start = signal.t_start.rescale(time_units)
+        sig_t_stop = signal.t_stop.rescale(time_units)
+        t_start = sig_t_start if t_start is None else max(t_start * time_units, sig_t_start)
+        t_stop = sig_t_stop if t_stop is None else min(t_stop * time_units, sig_t_stop)
+        if t_start >= t_stop:
+            raise ValueError(
+                f"The requested time window does not overlap the signal, "
+                f"which extends from {sig_t_start} to {sig_t_stop}"
+            )
+        return t_start, t_stop
+
+    @classmethod
+    def from_neo(
+        cls, signal, down_sample_factor, t_start=None, t_stop=None, channels=None, max_points=None
+    ):
+        return cls.from_data(
+            cls.data_from_neo(signal, down_sample_factor, t_start, t_stop, channels, max_points)
+        )
+
+    @classmethod
+    def from_data(cls, data):
+        """
+        Create the model, without validation, from the output of `data_from_neo()`
+        or related methods, since these are trusted to produce the correct types.
+        The signal values and times remain as numpy arrays, to be serialized with `dump_json()`.
+        """
+        data = data.copy()
+        data["values"] = cls.format_values(data["values"])
+        for key in ("t_start", "t_stop", "sampling_period"):
+            if data.get(key) is not None:
+                data[key] = float(data[key])
+        return cls.model_construct(**data)
+
+    @classmethod
+    def data_from_neo(
+        cls, signal, down_sample_factor, t_start=None, t_stop=None, channels=None, max_points=None
+    ):
+        """
+        Extract the metadata and data from a Neo signal, as a dict with the same fields as the model,
+        except that "values" is a numpy array with shape (n_samples, n_channels)
+        and "times", if present, is a numpy array.
+
+        See `from_neo()` for the meaning of the arguments.
+        """
+        cls.check_max_points(max_points)
+        time_slice = cls.get_time_slice(signal, t_start, t_stop)
+        if channels:
+            channel_indexes = parse_channel_selection(channels, signal.shape[1])
+        else:
+            channel_indexes = None
+        name = signal.name
+        if max_points and isinstance(signal, (neo.AnalogSignal, proxyobjects.AnalogSignalProxy)):
+            i_start, i_stop = get_sample_range(signal, time_slice)
+            if i_stop - i_start > max_points:
+                return cls.data_from_neo_min_max(
+                    signal, name, i_start, i_stop, max_points, channel_indexes
+                )
         if isinstance(signal, proxyobjects.BaseProxy):
-            signal = signal.load()
+            # only the samples within the time slice, and the selected channels, are read from disk
+            signal = signal.load(
+                time_slice=time_slice, strict_slicing=False, channel_indexes=channel_indexes
+            )
+        else:
+            if time_slice is not None:
+                signal = signal.time_slice(*time_slice)
+            if channel_indexes is not None:
+                signal = signal[:, channel_indexes]
         assert isinstance(signal, neo.AnalogSignal)
         # see https://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
         contains_nan = np.isnan(np.min(signal.magnitude))
@@ -92,7 +309,7 @@ class AnalogSignal(BaseModel):
         data = {
             "t_start": signal.t_start.magnitude,
             "t_stop": signal.t_stop.magnitude,
-            "name": signal.name or "",
+            "name": name or "",
             "times_dimensionality": str(signal.t_start.units.dimensionality),
             "values_units": str(signal.units.dimensionality),
         }
@@ -101,21 +318,145 @@ class AnalogSignal(BaseModel):
         except (ValueError, TypeError):
             down_sample_factor = 1
         if isinstance(signal, neo.AnalogSignal):
+            # all times, including the sampling period, are given in the units of t_start
             data["sampling_period"] = (
-                signal.sampling_period.magnitude * down_sample_factor
+                signal.sampling_period.rescale(signal.t_start.units).magnitude * down_sample_factor
             )
         else:
-            data["times"] = signal.times.magnitude.tolist()
-        n_channels = signal.shape[1]
-        values = []
-        for channel_id in range(n_channels):
-            values.append(
-                signal[::down_sample_factor, channel_id].magnitude.ravel().tolist()
-            )
-        if n_channels == 1:
+            data["times"] = signal.times.magnitude
+        data["values"] = signal.magnitude[::down_sample_factor]
+        return data
+
+    @classmethod
+    def chunks_from_neo(
+        cls, signal, down_sample_factor, t_start=None, t_stop=None, channels=None, max_points=None
+    ):
+        """
+        Prepare to read a Neo signal in chunks, for streaming responses.
+
+        Returns the metadata, as a dict with the same fields as from `data_from_neo()`
+        except "values" and "times", the number of channels, and a function `read_chunks(channel=None)`,
+        which yields (values, times) tuples, where values has shape (n_samples, n_channels),
+        or (n_samples, 1) if a channel (an index within the selected channels) is given,
+        and times is None for regularly-sampled signals.
+
+        For regularly-sampled signals the data are only read from disk by `read_chunks()`,
+        one chunk at a time, so memory use does not depend on the length of the signal.
+        Irregularly-sampled signals, and signals which are reduced to `max_points`
+        (which bounds their size), are read in full before being split into chunks.
+
+        See `from_neo()` for the meaning of the arguments.
+        """
+        chunk_values = settings.STREAMING_CHUNK_VALUES
+        cls.check_max_points(max_points)
+        time_slice = cls.get_time_slice(signal, t_start, t_stop)
+        is_regular = isinstance(signal, (neo.AnalogSignal, proxyobjects.AnalogSignalProxy))
+        if is_regular:
+            i_start, i_stop = get_sample_range(signal, time_slice)
+        if not is_regular or (max_points and i_stop - i_start > max_points):
+            data = cls.data_from_neo(signal, down_sample_factor, t_start, t_stop, channels, max_points)
+            values = data.pop("values")
+            times = data.pop("times", None)
+
+            def read_chunks(channel=None):
+                selected = values if channel is None else values[:, channel:channel + 1]
+                chunk_size = max(1, chunk_values // selected.shape[1])
+                for i in range(0, selected.shape[0], chunk_size):
+                    yield (
+                        selected[i:i + chunk_size],
+                        None if times is None else times[i:i + chunk_size],
+                    )
+
+            return data, values.shape[1], read_chunks
+
+        if channels:
+            channel_indexes = parse_channel_selection(channels, signal.shape[1])
+        else:
+            channel_indexes = list(range(signal.shape[1]))
+        try:
+            down_sample_factor = int(down_sample_factor)
+        except (ValueError, TypeError):
+            down_sample_factor = 1
+        time_units = signal.t_start.units
+        sampling_period = signal.sampling_period.rescale(time_units)
+        sig_t_start = signal.t_start + i_start * sampling_period
+        data = {
+            "t_start": sig_t_start.magnitude,
+            "t_stop": (sig_t_start + (i_stop - i_start) * sampling_period).magnitude,
+            "name": signal.name or "",
+            "times_dimensionality": str(time_units.dimensionality),
+            "values_units": str(signal.units.dimensionality),
+            "sampling_period": sampling_period.magnitude * down_sample_factor,
+        }
+
+        def read_chunks(channel=None):
+            indexes = channel_indexes if channel is None else [channel_indexes[channel]]
+            for offset, values in iter_chunks(signal, i_start, i_stop, indexes, chunk_values):
+                # see https://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
+                if np.isnan(np.min(values)):
+                    raise ValueError("Data contains NaN")
+                # keep every down_sample_factor-th sample, counting from i_start
+                yield values[(i_start - offset) % down_sample_factor::down_sample_factor], None
+
+        return data, len(channel_indexes), read_chunks
+
+    @staticmethod
+    def check_max_points(max_points):
+        """
+        Each time bucket gives two points, the minimum and the maximum, so at least two points
+        are needed, and odd values of `max_points` are rounded down to an even number.
+        """
+        if max_points is not None and max_points < 2:
+            raise ValueError("max_points must be at least 2")
+
+    @classmethod
+    def data_from_neo_min_max(cls, signal, name, i_start, i_stop, max_points, channel_indexes=None):
+        """
+        Represent the samples from i_start to i_stop by the minimum and maximum values
+        within each of max_points // 2 time buckets, which (unlike taking every n-th sample)
+        preserves peaks such as spikes.
+
+        The signal is read in chunks, so the full-resolution data are never held in memory.
+        """
+        values, bucket_size = min_max_decimate(signal, i_start, i_stop, max_points, channel_indexes)
+        time_units = signal.t_start.units
+        sampling_period = signal.sampling_period.rescale(time_units)
+        t_start = signal.t_start + i_start * sampling_period
+        data = {
+            "t_start": t_start.magnitude,
+            "t_stop": (t_start + (i_stop - i_start) * sampling_period).magnitude,
+            # each bucket is represented by two points
+            "sampling_period": (sampling_period * bucket_size / 2).magnitude,
+            "name": name or "",
+            "times_dimensionality": str(time_units.dimensionality),
+            "values_units": str(signal.units.dimensionality),
+            "values": values,
+        }
+        return data
+
+    @classmethod
+    def format_values(cls, values):
+        """
+        Convert a 2D array, with shape (n_samples, n_channels), into an array with one row
+        per channel, or a 1D array if there is only one channel, matching the layout of `values`.
+        """
+        values = np.ascontiguousarray(values.T)
+        if values.shape[0] == 1:
             values = values[0]
-        data["values"] = values
-        return cls(**data)
+        return values
+
+    @classmethod
+    def data_from_pyramid_tile(cls, pyramid, level, values, t_start):
+        sampling_period = pyramid.sampling_period(level)
+        return {
+            "t_start": t_start,
+            "t_stop": t_start + values.shape[0] * sampling_period,
+            "sampling_period": sampling_period,
+            "name": pyramid.metadata["name"],
+            "times_dimensionality": pyramid.metadata["times_dimensionality"],
+            "values_units": pyramid.metadata["values_units"],
+            "values": values,
+        }
 
     model_config = {  # todo: include all fields
         "json_schema_extra": {
@@ -161,6 +502,58 @@ class AnalogSignal(BaseModel):
     }
 
 
+class PyramidLevel(BaseModel):
+    """
+    One level of the multi-resolution representation of an analog signal.
+    """
+
+    level: int
+    sampling_period: float
+    n_points: int
+    n_tiles: int
+
+
+class AnalogSignalPyramid(BaseModel):
+    """
+    Description of the multi-resolution representation of an analog signal.
+
+    Level 0 contains the original samples. Each higher level contains the minimum
+    and maximum values of each channel within successively longer time intervals.
+    Each level is divided into tiles of `tile_size` points.
+    """
+
+    name: str
+    t_start: float
+    t_stop: float
+    times_dimensionality: str
+    values_units: str
+    n_channels: int
+    tile_size: int
+    levels: list[PyramidLevel]
+
+    @classmethod
+    def from_pyramid(cls, pyramid):
+        metadata = pyramid.metadata
+        return cls(
+            name=metadata["name"],
+            t_start=metadata["t_start"],
+            t_stop=metadata["t_start"] + metadata["n_samples"] * metadata["sampling_period"],
+            times_dimensionality=metadata["times_dimensionality"],
+            values_units=metadata["values_units"],
+            n_channels=metadata["n_channels"],
+            tile_size=pyramid.tile_size,
+            levels=[
+                PyramidLevel(
+                    level=level,
+                    sampling_period=pyramid.sampling_period(level),
+                    n_points=pyramid.n_points(level),
+                    n_tiles=pyramid.n_tiles(level),
+                )
+                for level in range(pyramid.n_levels)
+            ],
+        )
+
+
 class Segment(BaseModel):
     """
     A container for data sharing a common time basis.
@@ -0,0 +1,178 @@
+"""
+Functions for reading long analog signals in chunks and reducing them to a bounded
+number of points for plotting.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import numpy as np
+from neo.io import proxyobjects
+
+from . import settings
+
+
+def get_sample_range(signal, time_slice=None):
+    """Return the indices (i_start, i_stop) of the samples of `signal` within the time slice."""
+    if time_slice is None:
+        return 0, signal.shape[0]
+    t_start, t_stop = time_slice
+    sampling_rate = signal.sampling_rate
+    # rounding to the nearest sample, as for AnalogSignalProxy.load()
+    i_start = int(np.rint(((t_start - signal.t_start) * sampling_rate).simplified.magnitude))
+    i_stop = i_start + int(np.rint(((t_stop - t_start) * sampling_rate).simplified.magnitude))
+    return max(i_start, 0), min(i_stop, signal.shape[0])
+
+
+def load_samples(signal, i_start, i_stop, channel_indexes=None):
+    """
+    Return the samples with indices from i_start to i_stop as a Neo AnalogSignal.
+
+    For proxy objects, only these samples (and only the selected channels) are read from disk.
+    """
+    if isinstance(signal, proxyobjects.BaseProxy):
+        sampling_rate = signal.sampling_rate
+        time_slice = (signal.t_start + i_start / sampling_rate, signal.t_start + i_stop / sampling_rate)
+        return signal.load(
+            time_slice=time_slice, strict_slicing=False, channel_indexes=channel_indexes
+        )
+    chunk = signal[i_start:i_stop]
+    if channel_indexes is not None:
+        chunk = chunk[:, channel_indexes]
+    return chunk
+
+
+def iter_chunks(signal, i_start, i_stop, channel_indexes=None, chunk_values=None):
+    """
+    Read the samples with indices from i_start to i_stop in successive chunks.
+
+    The number of samples per chunk is chosen so that each chunk contains
+    approximately `chunk_values` values (by default `settings.SIGNAL_CHUNK_VALUES`),
+    whatever the number of channels.
+
+    Yields (index of first sample, magnitude array with shape (n_samples, n_channels)).
+    """
+    n_channels = signal.shape[1] if channel_indexes is None else len(channel_indexes)
+    chunk_size = max(1, (chunk_values or settings.SIGNAL_CHUNK_VALUES) // n_channels)
+    for i in range(i_start, i_stop, chunk_size):
+        chunk = load_samples(signal, i, min(i + chunk_size, i_stop), channel_indexes)
+        yield i, chunk.magnitude
+
+
+class MinMaxAccumulator:
+    """
+    Compute the minimum and maximum of each channel within successive buckets of samples.
+
+    Data are added chunk by chunk; chunk boundaries do not need to match bucket boundaries.
+    All operations are vectorized across channels.
+    """
+
+    def __init__(self, bucket_size, i_start=0):
+        self.bucket_size = bucket_size
+        self.i_start = i_start
+        self._mins, self._maxs = [], []
+        self._argmins, self._argmaxs = [], []
+        # number of buckets already removed with pop_envelope()
+        self._n_popped = 0
+
+    def add(self, data, offset):
+        """
+        Add a chunk of data, with shape (n_samples, n_channels),
+        whose first sample has index `offset`.
+        """
+        n_samples = data.shape[0]
+        if n_samples == 0:
+            return
+        positions = np.arange(offset, offset + n_samples) - self.i_start
+        bucket_ids = positions // self.bucket_size
+        # start of each bucket within this chunk
+        starts = np.flatnonzero(np.diff(bucket_ids, prepend=-1))
+        lengths = np.diff(starts, append=n_samples)
+        mins = np.minimum.reduceat(data, starts, axis=0)
+        maxs = np.maximum.reduceat(data, starts, axis=0)
+        # position of the first occurrence of the min/max within each bucket
+        no_match = np.iinfo(np.int64).max
+        argmins = np.minimum.reduceat(
+            np.where(data == np.repeat(mins, lengths, axis=0), positions[:, None], no_match),
+            starts,
+            axis=0,
+        )
+        argmaxs = np.minimum.reduceat(
+            np.where(data == np.repeat(maxs, lengths, axis=0), positions[:, None], no_match),
+            starts,
+            axis=0,
+        )
+        if self._mins and bucket_ids[0] == self._n_popped + len(self._mins) - 1:
+            # the first bucket continues the last bucket of the previous chunk
+            self._merge_last(mins[0], maxs[0], argmins[0], argmaxs[0])
+            mins, maxs, argmins, argmaxs = mins[1:], maxs[1:], argmins[1:], argmaxs[1:]
+        self._mins.extend(mins)
+        self._maxs.extend(maxs)
+        self._argmins.extend(argmins)
+        self._argmaxs.extend(argmaxs)
+
+    def _merge_last(self, min_, max_, argmin, argmax):
+        replace_min = min_ < self._mins[-1]
+        self._mins[-1] = np.where(replace_min, min_, self._mins[-1])
+        self._argmins[-1] = np.where(replace_min, argmin, self._argmins[-1])
+        replace_max = max_ > self._maxs[-1]
+        self._maxs[-1] = np.where(replace_max, max_, self._maxs[-1])
+        self._argmaxs[-1] = np.where(replace_max, argmax, self._argmaxs[-1])
+
+    def min_max(self):
+        """Return the per-bucket minima and maxima, each with shape (n_buckets, n_channels)."""
+        return np.array(self._mins), np.array(self._maxs)
+
+    def envelope(self):
+        """
+        Return an array with shape (2 * n_buckets, n_channels) containing, for each bucket,
+        the minimum and maximum in the order in which they occur in the signal,
+        so that a line plot through the points preserves the shape of the signal.
+        """
+        mins, maxs = self.min_max()
+        min_first = np.array(self._argmins) <= np.array(self._argmaxs)
+        envelope = np.empty((2 * mins.shape[0],) + mins.shape[1:], dtype=mins.dtype)
+        envelope[0::2] = np.where(min_first, mins, maxs)
+        envelope[1::2] = np.where(min_first, maxs, mins)
+        return envelope
+
+    def pop_envelope(self, final=False):
+        """
+        Return the envelope (see `envelope()`) of the buckets accumulated so far,
+        and remove them from the accumulator, so that long signals can be processed
+        without keeping the whole envelope in memory.
+
+        Unless `final` is True, the last bucket is retained, since it may not yet be complete.
+        """
+        n_buckets = len(self._mins) if final else max(len(self._mins) - 1, 0)
+        remaining = (
+            self._mins[n_buckets:], self._maxs[n_buckets:],
+            self._argmins[n_buckets:], self._argmaxs[n_buckets:]
+        )
+        del self._mins[n_buckets:], self._maxs[n_buckets:]
+        del self._argmins[n_buckets:], self._argmaxs[n_buckets:]
+        envelope = self.envelope() if n_buckets else None
+        self._mins, self._maxs, self._argmins, self._argmaxs = (list(r) for r in remaining)
+        self._n_popped += n_buckets
+        return envelope
+
+
+def min_max_decimate(signal, i_start, i_stop, max_points, channel_indexes=None):
+    """
+    Reduce the samples from i_start to i_stop to at most `max_points` points per channel,
+    by reading the signal in chunks and taking the minimum and maximum within each bucket,
+    so that an odd `max_points` gives one point fewer.
+
+    Returns the envelope, with shape (n_points, n_channels), and the number of
+    samples per bucket (each bucket gives two points).
+    """
+    n_buckets = max(1, max_points // 2)
+    bucket_size = int(np.ceil((i_stop - i_start) / n_buckets))
+    accumulator = MinMaxAccumulator(bucket_size, i_start)
+    for offset, data in iter_chunks(signal, i_start, i_stop, channel_indexes):
+        # see https://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
+        if np.isnan(np.min(data)):
+            raise ValueError("Data contains NaN")
+        accumulator.add(data, offset)
+    return accumulator.envelope(), bucket_size
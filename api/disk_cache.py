@@ -0,0 +1,317 @@
+"""
+Management of the cache of downloaded data files, whose total size is kept within
+a budget by deleting the least-recently-used entries.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from . import settings
+from .metadata_index import metadata_index
+
+
+def get_file_size(path):
+    """
+    Return the space used by a file, which is less than its length
+    for sparse files, see `remote_file.RemoteFile`.
+    """
+    stat = os.stat(path)
+    if hasattr(stat, "st_blocks"):
+        return min(stat.st_size, stat.st_blocks * 512)
+    return stat.st_size
+
+
+def get_data_size(path):
+    """Return the total size in bytes of a file, or of all the files within a directory."""
+    if os.path.isdir(path):
+        total = 0
+        for dir_path, dir_names, file_names in os.walk(path):
+            for file_name in file_names:
+                total += get_file_size(os.path.join(dir_path, file_name))
+        return total
+    return get_file_size(path)
+
+
+def acquire_file_lock(path, shared=False, blocking=True):
+    """
+    Lock the file at `path` (which is created if needed), to coordinate threads and
+    worker processes sharing the download cache, and return the open file.
+    The lock is released when the file is closed.
+
+    Shared locks are held while a cache entry is in use, exclusive locks
+    while it is being downloaded or deleted.
+    If `blocking` is False, raises BlockingIOError if the lock is not available.
+    """
+    while True:
+        fp = open(path, "a")
+        if not fcntl:
+            return fp
+        operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fp, operation)
+            # the lock file may have been moved away while we waited, see `DiskCache.retire()`
+            if os.fstat(fp.fileno()).st_ino == os.stat(path).st_ino:
+                return fp
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            fp.close()
+            raise
+        fp.close()
+
+
+@contextmanager
+def file_lock(path, shared=False, blocking=True):
+    """Context manager holding a lock on the file at `path`, see `acquire_file_lock()`."""
+    fp = acquire_file_lock(path, shared, blocking)
+    try:
+        yield
+    finally:
+        fp.close()
+
+
+def get_lock_path(path):
+    dir_path, filename = os.path.split(path)
+    return os.path.join(dir_path, f".{filename}.lock")
+
+
+# prefix of the directories holding entries which have been replaced by a new version
+# while in use, see `DiskCache.retire()`
+RETIRED_PREFIX = ".retired-"
+
+
+def get_derived_paths(main_path):
+    """Files computed from a data file, which are deleted together with it, e.g. min/max pyramids."""
+    return [f"{main_path}.pyramid"]
+
+
+def remove_path(path):
+    """Delete a file or a directory. Directories are renamed first, so they disappear at once."""
+    if os.path.isdir(path):
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path), prefix=".tmp-")
+        os.rename(path, os.path.join(tmp_path, os.path.basename(path)))
+        shutil.rmtree(tmp_path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class DiskCache:
+    """
+    Index of the entries in the download cache, with the total size,
+    time of last access and number of hits of each.
+
+    An entry is a data file, or a directory extracted from an archive, as returned by
+    `download_neo_data()`, together with any other files downloaded with it.
+    The index is stored in an SQLite database in the cache directory, shared by all
+    worker processes, so that the cache directory never needs to be scanned.
+    Files which were in the cache before the index existed are added to it when first accessed.
+
+    When the total size exceeds `settings.DOWNLOAD_CACHE_MAX_BYTES`, the least-recently-used
+    entries are deleted, except for those which are in use (see `pin()`).
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def root(self):
+        return getattr(settings, "DOWNLOADED_FILE_CACHE_DIR", "")
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        connections = self._local.__dict__.setdefault("connections", {})
+        db_path = os.path.join(self.root, "index.sqlite")
+        if db_path not in connections:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "path TEXT PRIMARY KEY, files TEXT NOT NULL, size INTEGER NOT NULL, "
+                "last_access REAL NOT NULL, hits INTEGER NOT NULL)"
+            )
+            connections[db_path] = connection
+        return connections[db_path]
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def _entry_size(self, main_path, files):
+        return sum(
+            get_data_size(path)
+            for path in files + get_derived_paths(main_path)
+            if os.path.exists(path)
+        )
+
+    def record_access(self, main_path, files, new=False):
+        """
+        Record an access to the entry whose main file or directory is `main_path`, containing `files`
+        (absolute paths, with the downloaded file first).
+
+        If `new` is True the files have just been downloaded, and entries are deleted
+        if necessary to keep within the budget.
+        """
+        if not new and self.touch(main_path):
+            return
+        self._connection().execute(
+            "INSERT OR REPLACE INTO entries (path, files, size, last_access, hits) VALUES (?, ?, ?, ?, 1)",
+            (
+                self._relative(main_path),
+                json.dumps([self._relative(file_path) for file_path in files]),
+                self._entry_size(main_path, files),
+                time.time(),
+            ),
+        )
+        if new:
+            self.enforce_budget(exclude=main_path)
+
+    def touch(self, main_path):
+        """
+        Record an access to an existing entry, e.g. when a response derived from its files
+        is served from a cache without opening them. Returns False if the entry is not in the index.
+        """
+        cursor = self._connection().execute(
+            "UPDATE entries SET last_access = ?, hits = hits + 1 WHERE path = ?",
+            (time.time(), self._relative(main_path)),
+        )
+        return cursor.rowcount > 0
+
+    def update_size(self, main_path):
+        """Update the size of an entry, e.g. after derived files have been added."""
+        files = self.get_files(main_path)
+        if files:
+            self._connection().execute(
+                "UPDATE entries SET size = ? WHERE path = ?",
+                (self._entry_size(main_path, files), self._relative(main_path)),
+            )
+
+    def get_files(self, main_path):
+        """Return the files of an entry, or None if it is not in the index."""
+        row = self._connection().execute(
+            "SELECT files FROM entries WHERE path = ?", (self._relative(main_path),)
+        ).fetchone()
+        if row:
+            return [os.path.join(self.root, file_path) for file_path in json.loads(row[0])]
+        return None
+
+    def total_size(self):
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def pin(self, main_path):
+        """
+        Mark an entry as in use, so that it cannot be deleted, by any worker process,
+        until the returned object is closed.
+
+        Waits if the entry is being downloaded or deleted, so the caller should check
+        that it still exists afterwards.
+        """
+        return acquire_file_lock(get_lock_path(main_path), shared=True)
+
+    def enforce_budget(self, exclude=None):
+        """
+        Delete any retired entries which are no longer in use (see `retire()`),
+        then least-recently-used entries until the total size is within the budget.
+        """
+        retired = self._connection().execute(
+            "SELECT path, files FROM entries WHERE path LIKE ?", (f"%{RETIRED_PREFIX}%",)
+        ).fetchall()
+        for path, files in retired:
+            self.evict(
+                os.path.join(self.root, path),
+                [os.path.join(self.root, file_path) for file_path in json.loads(files)],
+            )
+        max_bytes = settings.DOWNLOAD_CACHE_MAX_BYTES
+        total = self.total_size()
+        if total <= max_bytes:
+            return
+        rows = self._connection().execute(
+            "SELECT path, files, size FROM entries ORDER BY last_access"
+        ).fetchall()
+        for path, files, size in rows:
+            if total <= max_bytes:
+                break
+            main_path = os.path.join(self.root, path)
+            if main_path == exclude:
+                continue
+            files = [os.path.join(self.root, file_path) for file_path in json.loads(files)]
+            if self.evict(main_path, files):
+                total -= size
+
+    def evict(self, main_path, files):
+        """
+        Delete an entry, unless it is in use or being downloaded. Returns True if it was deleted.
+        """
+        # the downloaded file (e.g. a zip archive) may have a different lock from the main path
+        lock_paths = {get_lock_path(main_path), get_lock_path(files[0])}
+        locks = []
+        try:
+            for lock_path in lock_paths:
+                try:
+                    locks.append(acquire_file_lock(lock_path, blocking=False))
+                except BlockingIOError:
+                    return False
+            # the downloaded file is deleted first, so that it is downloaded again if requested
+            for path in files + [main_path] + get_derived_paths(main_path):
+                remove_path(path)
+            self._connection().execute(
+                "DELETE FROM entries WHERE path = ?", (self._relative(main_path),)
+            )
+            metadata_index.discard(files[0])
+        finally:
+            for lock in locks:
+                lock.close()
+        return True
+
+    def retire(self, main_path, files):
+        """
+        Move an entry which is in use out of the way, e.g. because the file has changed on the server,
+        so that the new version can be downloaded in its place. Readers keep using the old files
+        (and the locks pinning them), and the retired entry is deleted once it is no longer in use,
+        see `enforce_budget()`. Returns False if the entry is not in the index, e.g. because
+        another worker process has already retired it.
+        """
+        dir_path = os.path.dirname(files[0])
+        retired_dir = tempfile.mkdtemp(dir=dir_path, prefix=RETIRED_PREFIX)
+
+        def retired(path):
+            return os.path.join(retired_dir, os.path.relpath(path, dir_path))
+
+        # the directory is deleted last, with the entry
+        retired_files = [retired(path) for path in files] + [retired_dir]
+        cursor = self._connection().execute(
+            "UPDATE entries SET path = ?, files = ?, last_access = 0 WHERE path = ?",
+            (
+                self._relative(retired(main_path)),
+                json.dumps([self._relative(file_path) for file_path in retired_files]),
+                self._relative(main_path),
+            ),
+        )
+        if cursor.rowcount == 0:
+            os.rmdir(retired_dir)
+            return False
+        # the locks are moved first, so that new readers cannot pin the old files
+        lock_paths = list(dict.fromkeys([get_lock_path(main_path), get_lock_path(files[0])]))
+        for path in lock_paths + files + [main_path] + get_derived_paths(main_path):
+            if os.path.lexists(path):
+                os.makedirs(os.path.dirname(retired(path)), exist_ok=True)
+                os.rename(path, retired(path))
+        return True
+
+
+disk_cache = DiskCache()
@@ -0,0 +1,345 @@
+"""
+Downloading of data files, with a connection pool shared between requests,
+with large files fetched over several parallel connections,
+and with interrupted downloads resumed where they stopped.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
+import os
+import threading
+import time
+
+import httpx
+
+from . import settings
+
+
+BLOCK_SIZE = 1024**2
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    Return the HTTP client used for all downloads, whose connections
+    are kept open and reused between requests to the same server.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = httpx.Client(
+                follow_redirects=True,
+                # with compressed responses, the Content-Length and byte ranges would refer
+                # to the compressed representation rather than to the file
+                headers={"Accept-Encoding": "identity"},
+                limits=httpx.Limits(
+                    max_connections=settings.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.HTTP_MAX_CONNECTIONS,
+                ),
+                # downloads wait for a free connection rather than failing
+                timeout=httpx.Timeout(settings.HTTP_TIMEOUT, pool=None),
+            )
+        return _client
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+class RangeNotSupported(Exception):
+    """The server ignored a range request, and returned the whole file."""
+
+
+VALIDATOR_HEADERS = ("ETag", "Last-Modified")
+
+
+def get_validators(headers):
+    """Return the headers of a response which identify the version of a file."""
+    return {name: headers[name] for name in VALIDATOR_HEADERS if name in headers}
+
+
+def get_range_validator(validators):
+    """
+    Return the ETag or, failing that, the Last-Modified date of a file, for use in If-Range headers.
+    Weak ETags cannot be used for this.
+    """
+    etag = validators.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return validators.get("Last-Modified")
+
+
+def probe(url):
+    """
+    Return the size of the file at the given URL, if known, whether the server
+    supports byte-range requests, and the validators of the file (see `get_validators()`),
+    using a HEAD request.
+
+    Raises `httpx.HTTPStatusError` if the file does not exist.
+    """
+    response = get_client().head(url)
+    if response.status_code in (404, 410):
+        response.raise_for_status()
+    if response.is_error:
+        # some servers do not allow HEAD requests, or sign URLs for GET only
+        return None, False, {}
+    size = response.headers.get("Content-Length")
+    accepts_ranges = response.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size else None), accepts_ranges, get_validators(response.headers)
+
+
+def split_into_segments(size, segment_size):
+    """Return (start, end) byte positions, inclusive, for segments covering `size` bytes."""
+    return [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+
+
+def get_partial_paths(path):
+    """
+    Return the location of the partially-downloaded file for `path`,
+    and of the record needed to resume its download.
+    """
+    dir_path, filename = os.path.split(path)
+    partial_path = os.path.join(dir_path, f".{filename}.partial")
+    return partial_path, f"{partial_path}.json"
+
+
+def read_record(record_path):
+    try:
+        with open(record_path) as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_record(record_path, record):
+    tmp_path = f"{record_path}.tmp"
+    with open(tmp_path, "w") as fp:
+        json.dump(record, fp)
+    os.replace(tmp_path, record_path)
+
+
+def download_segment(url, fd, start, end, validator=None):
+    """
+    Download bytes start to end (inclusive) of the file at `url`, writing them at the same position in `fd`.
+
+    If `validator` is given, the server returns the whole file, and `RangeNotSupported`
+    is raised, if the file no longer matches it.
+    """
+    headers = {"Range": f"bytes={start}-{end}"}
+    if validator:
+        headers["If-Range"] = validator
+    with get_client().stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeNotSupported(url)
+        position = start
+        for block in response.iter_bytes(BLOCK_SIZE):
+            position += os.pwrite(fd, block, position)
+    if position != end + 1:
+        raise IOError(f"Incomplete download of bytes {start}-{end} of {url}")
+
+
+def download_in_segments(url, path, size, record=None, record_path=None):
+    """
+    Download the file at `url` in parallel segments, into a file of the given size
+    which is allocated in advance, so that each segment can be written directly in place.
+
+    If `record` is given, segments listed in `record["segments"]` have already been downloaded,
+    and each segment is added to the list, which is saved to `record_path`, once complete.
+    """
+    record = record or {"segments": []}
+    done = {tuple(segment) for segment in record["segments"]}
+    segments = [
+        segment for segment in split_into_segments(size, settings.DOWNLOAD_SEGMENT_SIZE)
+        if segment not in done
+    ]
+    record_lock = threading.Lock()
+
+    def download(start, end):
+        download_segment(url, fd, start, end, get_range_validator(record.get("validators", {})))
+        with record_lock:
+            record["segments"].append([start, end])
+            if record_path:
+                write_record(record_path, record)
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != size:
+            os.ftruncate(fd, 0)
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+        if not segments:
+            return
+        n_connections = min(settings.DOWNLOAD_MAX_CONNECTIONS, len(segments))
+        with ThreadPoolExecutor(max_workers=n_connections, thread_name_prefix="download") as executor:
+            futures = [executor.submit(download, start, end) for start, end in segments]
+            try:
+                for future in futures:
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+
+
+def download_in_one_stream(url, path, size=None, validator=None):
+    """
+    Download the file at `url` to `path`.
+
+    If `validator` is given, any data already at `path` are assumed to be the start of the file,
+    and only the remainder is requested, unless the file no longer matches the validator.
+    """
+    offset = os.path.getsize(path) if validator and os.path.exists(path) else 0
+    if size is not None and offset >= size:
+        # nothing left to download, the size is checked by the caller
+        return
+    headers = {"Range": f"bytes={offset}-", "If-Range": validator} if offset else {}
+    with get_client().stream("GET", url, headers=headers) as response:
+        response.raise_for_status()
+        # the server returns the whole file if it has changed
+        mode = "ab" if response.status_code == 206 else "wb"
+        with open(path, mode) as fp:
+            # data are written as they arrive, so that they are kept if the connection fails
+            for block in response.iter_bytes():
+                fp.write(block)
+
+
+def download_to_partial_file(url, path):
+    """
+    Download the file at `url` to a partial file in the same directory as `path`,
+    from which it can be renamed atomically, and return the location of the partial file.
+
+    Large files are downloaded in segments over several connections if the server
+    supports range requests, otherwise, or if it turns out that the server
+    does not honour range requests, the file is downloaded in a single stream.
+
+    If the download is interrupted, the partial file is kept, with a record of the size
+    and validators (ETag and Last-Modified) of the file, so that the next download of the same
+    file only fetches the missing parts, provided that the file has not changed on the server.
+    The caller must hold the lock on `path`, see `disk_cache.file_lock()`.
+
+    Raises `httpx.HTTPStatusError` if the file cannot be downloaded,
+    and `IOError` if the downloaded file does not have the expected size.
+    """
+    size, accepts_ranges, validators = probe(url)
+    validator = get_range_validator(validators)
+    partial_path, record_path = get_partial_paths(path)
+    segmented = bool(accepts_ranges and size and size > settings.DOWNLOAD_SEGMENT_SIZE)
+    record = {"url": url, "size": size, "validators": validators}
+    if segmented:
+        record["segments"] = []
+    previous = read_record(record_path)
+    if (
+        accepts_ranges and validator and previous and os.path.exists(partial_path)
+        and all(previous.get(key) == value for key, value in record.items() if key != "segments")
+        and ("segments" in previous) == segmented
+    ):
+        record = previous
+    else:
+        for stale_path in (partial_path, record_path):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+    write_record(record_path, record)
+    try:
+        if segmented:
+            try:
+                download_in_segments(url, partial_path, size, record, record_path)
+            except RangeNotSupported:
+                segmented = False
+                os.remove(partial_path)
+        if not segmented:
+            download_in_one_stream(url, partial_path, size, validator if accepts_ranges else None)
+        if size is not None and os.path.getsize(partial_path) != size:
+            os.remove(partial_path)
+            raise IOError(f"Downloaded file {url} does not have the expected size ({size} bytes)")
+    except httpx.HTTPStatusError:
+        for stale_path in (partial_path, record_path):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        raise
+    return partial_path
+
+
+def get_validators_path(path):
+    """
+    Location of the record of the validators (ETag and Last-Modified) of a downloaded file,
+    and of when it was last checked that the file had not changed on the server.
+    """
+    dir_path, filename = os.path.split(path)
+    return os.path.join(dir_path, f".{filename}.validators.json")
+
+
+def move_into_place(path):
+    """
+    Rename the completed partial file for `path` (see `download_to_partial_file()`),
+    and keep its validators, see `get_validators_path()`.
+    """
+    partial_path, record_path = get_partial_paths(path)
+    record = read_record(record_path)
+    write_record(
+        get_validators_path(path),
+        {"url": record["url"], "validators": record["validators"], "checked_at": time.time()}
+    )
+    os.replace(partial_path, path)
+    os.remove(record_path)
+
+
+def download_file(url, path):
+    """
+    Download the file at `url` to `path`.
+
+    The file only appears at `path` once it is complete,
+    so other processes never see a partially-downloaded file,
+    and interrupted downloads are resumed. See `download_to_partial_file()`.
+    """
+    download_to_partial_file(url, path)
+    move_into_place(path)
+
+
+def download_files(files):
+    """
+    Download several files concurrently, e.g. the files making up a multi-file dataset.
+
+    `files` is a list of (url, path, required) tuples. Returns a list containing, for each file,
+    None if it was downloaded or the `httpx.HTTPStatusError` if it was not.
+    Missing files are detected by the initial HEAD request, without downloading anything.
+
+    The files are moved into place once all of the downloads have finished, the first file last,
+    so that if the first file exists, the others are also complete. If a required file cannot
+    be downloaded, none of the files are moved into place, so that an incomplete dataset never
+    appears in the cache. If any download fails, the others are kept as partial files,
+    and are not downloaded again next time.
+    """
+    def download(url, path):
+        try:
+            return download_to_partial_file(url, path), None
+        except httpx.HTTPStatusError as err:
+            return None, err
+
+    with ThreadPoolExecutor(max_workers=len(files), thread_name_prefix="download") as executor:
+        futures = [executor.submit(download, url, path) for url, path, required in files]
+        wait(futures)
+    failures = [future.exception() for future in futures if future.exception()]
+    results = [future.result() for future in futures if not future.exception()]
+    if failures:
+        raise failures[0]
+    errors = [error for partial_path, error in results]
+    if not any(error and required for (url, path, required), error in zip(files, errors)):
+        for (url, path, required), (partial_path, error) in reversed(list(zip(files, results))):
+            if partial_path:
+                move_into_place(path)
+    return errors
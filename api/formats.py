@@ -0,0 +1,267 @@
+"""
+Encoding of signal and spike train data in binary formats, as an alternative to JSON.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+from enum import Enum
+import io
+import json
+import struct
+
+from fastapi import HTTPException, status
+from fastapi.responses import Response
+import numpy as np
+
+
+class ResponseFormat(str, Enum):
+    json = "json"
+    binary = "binary"
+    npy = "npy"
+    arrow = "arrow"
+    ndjson = "ndjson"
+
+
+media_types = {
+    ResponseFormat.json: "application/json",
+    ResponseFormat.binary: "application/octet-stream",
+    ResponseFormat.npy: "application/x-npy",
+    ResponseFormat.arrow: "application/vnd.apache.arrow.stream",
+    ResponseFormat.ndjson: "application/x-ndjson",
+}
+
+# spike trains are sent as a zip archive of .npy files, one per spike train
+NPZ_MEDIA_TYPE = "application/x-npz"
+
+# for .npy files, which cannot contain metadata, it is sent in this response header,
+# which must remain small, since proxies limit the total size of the headers
+METADATA_HEADER = "X-Neo-Viewer-Metadata"
+
+# in .npz archives the metadata is stored as the UTF-8 encoded JSON in this uint8 array
+NPZ_METADATA_NAME = "metadata.json"
+
+
+def negotiate_format(format=None, accept=None):
+    """
+    Choose the response format, from the `format` query parameter if given,
+    otherwise from the media types in the HTTP Accept header. JSON is the default.
+    """
+    if format:
+        return ResponseFormat(format)
+    if accept:
+        formats_by_media_type = {media_type: fmt for fmt, media_type in media_types.items()}
+        formats_by_media_type[NPZ_MEDIA_TYPE] = ResponseFormat.npy
+        candidates = []
+        for position, item in enumerate(accept.split(",")):
+            media_type, *params = [part.strip() for part in item.split(";")]
+            quality = 1.0
+            for param in params:
+                if param.startswith("q="):
+                    try:
+                        quality = float(param[2:])
+                    except ValueError:
+                        pass
+            if media_type in formats_by_media_type and quality > 0:
+                candidates.append((-quality, position, formats_by_media_type[media_type]))
+        if candidates:
+            return min(candidates)[2]
+    return ResponseFormat.json
+
+
+def _to_json_compatible(metadata):
+    """Convert numpy scalars in the metadata to Python types."""
+    return {
+        key: value.item() if isinstance(value, np.ndarray | np.generic) else value
+        for key, value in metadata.items()
+    }
+
+
+def _little_endian(array):
+    return np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+
+
+def encode_binary(metadata, arrays):
+    """
+    Encode metadata and numpy arrays in a simple binary container:
+
+    - a 4-byte little-endian unsigned integer giving the length of the header;
+    - a UTF-8 JSON header, containing the metadata and, under "arrays", a list giving
+      the name, dtype, shape, byte offset (from the start of the body) and length of each array;
+    - the raw little-endian array data, each array starting on an 8-byte boundary.
+    """
+    arrays = {name: _little_endian(array) for name, array in arrays.items()}
+    descriptions = []
+    offset = 0
+    for name, array in arrays.items():
+        descriptions.append(
+            {
+                "name": name,
+                "dtype": array.dtype.str,
+                "shape": array.shape,
+                "offset": offset,
+                "nbytes": array.nbytes,
+            }
+        )
+        offset += array.nbytes + (-array.nbytes % 8)
+    header = json.dumps(dict(_to_json_compatible(metadata), arrays=descriptions)).encode("utf-8")
+    header += b" " * (-(4 + len(header)) % 8)
+    parts = [struct.pack("<I", len(header)), header]
+    for array in arrays.values():
+        parts.append(array.tobytes())
+        parts.append(b"\0" * (-array.nbytes % 8))
+    return b"".join(parts)
+
+
+def encode_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, _little_endian(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def encode_npz(arrays, metadata=None):
+    """
+    Encode numpy arrays as a .npz archive, with the metadata, if given,
+    as JSON in an array named `NPZ_METADATA_NAME`.
+    """
+    arrays = {name: _little_endian(array) for name, array in arrays.items()}
+    if metadata is not None:
+        arrays[NPZ_METADATA_NAME] = np.frombuffer(json.dumps(metadata).encode("utf-8"), dtype=np.uint8)
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise HTTPException(
+            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+            detail="This server does not have the pyarrow module installed.",
+        )
+    return pyarrow
+
+
+def encode_arrow(table, metadata):
+    pa = _import_pyarrow()
+    if metadata:
+        table = table.replace_schema_metadata(
+            {"neo_viewer": json.dumps(_to_json_compatible(metadata))}
+        )
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def signal_response(data, response_format):
+    """
+    Encode analog signal data, as returned by `AnalogSignal.data_from_neo()`, in a binary format.
+
+    The values are sent as an array with shape (n_channels, n_samples),
+    matching the layout of the "values" field in the JSON representation.
+    In the "npy" format, irregularly-sampled signals are sent as a .npz archive
+    containing arrays named "values" and "times".
+    """
+    data = dict(data)
+    values = data.pop("values").T
+    times = data.pop("times", None)
+    metadata = _to_json_compatible(data)
+    media_type = media_types[response_format]
+    if response_format == ResponseFormat.binary:
+        arrays = {"values": values}
+        if times is not None:
+            arrays["times"] = times
+        content = encode_binary(metadata, arrays)
+        headers = {}
+    elif response_format == ResponseFormat.npy:
+        if times is None:
+            content = encode_npy(values)
+        else:
+            content = encode_npz({"values": values, "times": times})
+            media_type = NPZ_MEDIA_TYPE
+        headers = {METADATA_HEADER: json.dumps(metadata)}
+    elif response_format == ResponseFormat.arrow:
+        pa = _import_pyarrow()
+        columns = {f"channel_{i}": channel for i, channel in enumerate(values)}
+        if times is not None:
+            columns["times"] = times
+        content = encode_arrow(pa.table(columns), metadata)
+        headers = {}
+    else:
+        raise ValueError(f"Unsupported format {response_format}")
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def signals_response(signals, response_format):
+    """
+    Encode the data of several analog signals, a dict of outputs from `AnalogSignal.data_from_neo()`
+    keyed by signal selector, in a single binary container or .npz archive.
+
+    The arrays are named "<selector>/values" and, for irregularly-sampled signals, "<selector>/times",
+    and the metadata of each signal is given under "signals", keyed by selector,
+    in the header of the binary container or in the .npz archive (see `encode_npz()`).
+    """
+    metadata = {}
+    arrays = {}
+    for key, data in signals.items():
+        data = dict(data)
+        arrays[f"{key}/values"] = data.pop("values").T
+        times = data.pop("times", None)
+        if times is not None:
+            arrays[f"{key}/times"] = times
+        metadata[key] = _to_json_compatible(data)
+    if response_format == ResponseFormat.binary:
+        content = encode_binary({"signals": metadata}, arrays)
+        media_type = media_types[response_format]
+        headers = {}
+    elif response_format == ResponseFormat.npy:
+        content = encode_npz(arrays, {"signals": metadata})
+        media_type = NPZ_MEDIA_TYPE
+        headers = {}
+    else:
+        raise ValueError(f"Unsupported format {response_format}")
+    return Response(content=content, media_type=media_type, headers=headers)
+
+
+def spike_trains_response(spike_trains, response_format):
+    """
+    Encode spike train data, a dict of outputs from `SpikeTrain.data_from_neo()`
+    keyed by spike train index, in a binary format.
+
+    In the "npy" format the spike trains are sent as a .npz archive, with one array per spike train,
+    and the metadata in the archive, see `encode_npz()`.
+    """
+    metadata = {
+        key: _to_json_compatible({"units": st["units"], "t_stop": st["t_stop"]})
+        for key, st in spike_trains.items()
+    }
+    if response_format == ResponseFormat.binary:
+        content = encode_binary(
+            {"spiketrains": metadata},
+            {key: st["times"] for key, st in spike_trains.items()},
+        )
+        media_type = media_types[response_format]
+        headers = {}
+    elif response_format == ResponseFormat.npy:
+        content = encode_npz({key: st["times"] for key, st in spike_trains.items()}, metadata)
+        media_type = NPZ_MEDIA_TYPE
+        headers = {}
+    elif response_format == ResponseFormat.arrow:
+        pa = _import_pyarrow()
+        table = pa.table(
+            {
+                "id": list(spike_trains.keys()),
+                "units": [st["units"] for st in spike_trains.values()],
+                "t_stop": [float(st["t_stop"]) for st in spike_trains.values()],
+                "times": [st["times"] for st in spike_trains.values()],
+            }
+        )
+        content = encode_arrow(table, {})
+        media_type = media_types[response_format]
+        headers = {}
+    else:
+        raise ValueError(f"Unsupported format {response_format}")
+    return Response(content=content, media_type=media_type, headers=headers)
@@ -0,0 +1,133 @@
+"""
+HTTP caching of API responses: ETag and Cache-Control headers, 304 Not Modified
+responses to conditional requests, which are answered without opening the data file,
+and a server-side cache of responses, see `response_cache.ResponseCache`.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import hashlib
+
+import neo
+from fastapi.responses import Response
+from starlette import status
+
+from . import settings
+from .concurrency import run_blocking
+from .data_handler import get_file_version, record_cached_access
+from .data_models import dump_json
+from .prefetch import wait_for_prefetch
+from .response_cache import response_cache
+
+
+def compute_etag(request, url):
+    """
+    Return a strong ETag for the response to `request`, which concerns the data file at `url`,
+    or None if the version of the file is not yet known (see `data_handler.get_file_version()`).
+
+    The ETag depends on the version of the file, the endpoint, the query parameters,
+    the Accept header (from which the response format may be chosen) and the version of Neo.
+    """
+    version = get_file_version(url)
+    if version is None:
+        return None
+    key = {
+        "file": version,
+        "path": request.url.path,
+        "query": sorted(request.query_params.multi_items()),
+        "accept": request.headers.get("Accept"),
+        "neo": neo.__version__,
+    }
+    return f'"{hashlib.sha1(dump_json(key)).hexdigest()}"'
+
+
+def find_matching_etag(if_none_match, etag):
+    """
+    Return the entity tag in an If-None-Match header which matches `etag`, or None.
+
+    Compressed responses have the encoding appended to the ETag, see `compression.CompressionResponder`,
+    so the client may send any of these variants.
+    """
+    if not if_none_match:
+        return None
+    if if_none_match.strip() == "*":
+        return etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip().removeprefix("W/")
+        if tag == etag or (tag.startswith(etag[:-1] + "-") and tag.endswith('"')):
+            return tag
+    return None
+
+
+# the response format is chosen from the Accept header, and the response may be compressed
+# according to Accept-Encoding (see `compression.CompressionMiddleware`), so shared caches
+# must keep a separate copy for each combination
+VARY = "Accept, Accept-Encoding"
+
+
+def cache_headers(etag, cache_control=None):
+    return {"ETag": etag, "Cache-Control": cache_control or settings.RESPONSE_CACHE_CONTROL, "Vary": VARY}
+
+
+def lookup(request, url):
+    """Return the ETag of the response to `request`, and the cached response, if any."""
+    etag = compute_etag(request, url)
+    if etag is None:
+        return None, None
+    if find_matching_etag(request.headers.get("If-None-Match"), etag):
+        cached = None
+    else:
+        cached = response_cache.get(etag)
+        if cached is None:
+            return etag, None
+    # the response is served without opening the file
+    record_cached_access(url)
+    return etag, cached
+
+
+def store(request, url, response):
+    """Compute the ETag of a response which has just been produced, and add the response to the cache."""
+    # the file has just been downloaded or checked for changes, so its version is known
+    etag = compute_etag(request, url)
+    if etag is not None:
+        headers = {
+            name: value for name, value in response.headers.items() if name != "content-length"
+        }
+        response_cache.put(etag, headers, response.body)
+    return etag
+
+
+async def conditional_response(request, url, get_response, cache_control=None):
+    """
+    Return the response produced by the coroutine function `get_response()`,
+    with ETag, Cache-Control and Vary headers, or a 304 Not Modified response with the same headers,
+    without calling `get_response()`, if the client already has an up-to-date copy.
+    `cache_control` defaults to `settings.RESPONSE_CACHE_CONTROL`.
+
+    Responses are cached on the server, so `get_response()` is only called
+    if the same request has not been made recently, or is being prefetched.
+    Streamed responses are not cached.
+    """
+    url = str(url)
+    await wait_for_prefetch(request)
+    etag, cached = await run_blocking(lookup, request, url)
+    if etag is not None:
+        matching_etag = find_matching_etag(request.headers.get("If-None-Match"), etag)
+        if matching_etag:
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(matching_etag, cache_control)
+            )
+    if cached is not None:
+        headers, body = cached
+        response = Response(content=body, headers=headers)
+    else:
+        response = await get_response()
+        if response.status_code == status.HTTP_200_OK and hasattr(response, "body"):
+            etag = await run_blocking(store, request, url, response)
+        elif etag is None:
+            etag = await run_blocking(compute_etag, request, url)
+    if etag is not None and response.status_code == status.HTTP_200_OK:
+        response.headers.update(cache_headers(etag, cache_control))
+    return response
@@ -18,8 +18,12 @@ from starlette.middleware.cors import CORSMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
 
 from .resources.v1 import router as router_v1
+from . import concurrency, downloader
+from .compression import CompressionMiddleware
+from .data_handler import io_cache
+from .formats import METADATA_HEADER
 from .metadata import title, description
-from .settings import HOMEPAGE_DIR, REACT_DIR
+from .settings import HOMEPAGE_DIR, REACT_DIR, COMPRESSION_MINIMUM_SIZE
 
 
 app = FastAPI(
@@ -37,8 +41,11 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[METADATA_HEADER],
 )
 
+app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MINIMUM_SIZE)
+
 
 @app.exception_handler(StarletteHTTPException)
 async def custom_http_exception_handler(request, exc):
@@ -66,6 +73,14 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content=jsonable_encoder({"detail": error_detail, "error": error_messages}),
     )
 
+
+@app.on_event("shutdown")
+def shutdown():
+    concurrency.shutdown()
+    downloader.close_client()
+    io_cache.clear()
+
+
 app.include_router(router_v1, prefix="/api/v1")
 app.include_router(router_v1, prefix="/api")
 
@@ -0,0 +1,78 @@
+"""
+Persistent index of the metadata of the data files in the download cache,
+so that the structure of a file is only read once, rather than by every worker process
+after every restart.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import os
+import sqlite3
+import threading
+
+from . import settings
+
+
+class MetadataIndex:
+    """
+    Index of metadata computed from the data files in the download cache, e.g. the JSON
+    representation of the blocks in a file, or of a segment, so that these can be returned
+    without opening the file.
+
+    Items are keyed by the downloaded file, the name of the Neo IO class used to read it
+    (empty if Neo chose the IO) and an item name, and are only valid for the version of the file
+    from which they were computed (see `data_handler.get_index_key()`).
+    The index is stored in an SQLite database in the cache directory, shared by all worker processes.
+    Items are deleted when the file is deleted from the download cache, see `disk_cache.DiskCache.evict()`.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    @property
+    def root(self):
+        return getattr(settings, "DOWNLOADED_FILE_CACHE_DIR", "")
+
+    def _connection(self):
+        # sqlite connections cannot be shared between threads
+        connections = self._local.__dict__.setdefault("connections", {})
+        db_path = os.path.join(self.root, "metadata.sqlite")
+        if db_path not in connections:
+            os.makedirs(self.root, exist_ok=True)
+            connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "path TEXT NOT NULL, io TEXT NOT NULL, item TEXT NOT NULL, "
+                "version TEXT NOT NULL, content BLOB NOT NULL, PRIMARY KEY (path, io, item))"
+            )
+            connections[db_path] = connection
+        return connections[db_path]
+
+    def _relative(self, path):
+        return os.path.relpath(path, self.root)
+
+    def get(self, path, version, io_name, item):
+        """Return the content of an item, or None if it is not in the index or is out of date."""
+        row = self._connection().execute(
+            "SELECT content FROM items WHERE path = ? AND io = ? AND item = ? AND version = ?",
+            (self._relative(path), io_name, item, version),
+        ).fetchone()
+        if row:
+            return row[0]
+        return None
+
+    def put(self, path, version, io_name, item, content):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO items (path, io, item, version, content) VALUES (?, ?, ?, ?, ?)",
+            (self._relative(path), io_name, item, version, content),
+        )
+
+    def discard(self, path):
+        """Delete all the items for the downloaded file at `path`."""
+        self._connection().execute("DELETE FROM items WHERE path = ?", (self._relative(path),))
+
+
+metadata_index = MetadataIndex()
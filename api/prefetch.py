@@ -0,0 +1,131 @@
+"""
+Prefetching of the data which viewers request after the block metadata,
+so that the first plot can be shown without waiting for the data file to be read.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import asyncio
+import contextvars
+
+import httpx
+
+from . import settings
+from .concurrency import single_flight
+
+
+# background tasks, which must be referenced until they finish
+_tasks = set()
+# requests being prefetched (see `request_key()`), with events which are set once they are complete
+_in_flight = {}
+# true while making prefetch requests, which must not wait for themselves
+_prefetching = contextvars.ContextVar("prefetching", default=False)
+# `concurrency.single_flight()` key held while making each prefetch request
+_worker_key = "prefetch"
+
+
+def request_key(path, params, accept):
+    """Identify a request by its path, query parameters and Accept header, as the ETag does."""
+    return path, tuple(sorted((name, str(value)) for name, value in params)), accept
+
+
+def follow_up_requests(request):
+    """
+    Return the paths and query parameters of the requests which the viewer makes after a
+    `/blockdata/` request: the first segment, and the first signal and the spike trains in it,
+    with the same parameters as the viewer uses, so that the responses are cached with the same ETags.
+    """
+    base_path = request.url.path.removesuffix("blockdata/")
+    params = {"url": request.query_params["url"]}
+    if "type" in request.query_params:
+        params["type"] = request.query_params["type"]
+    segment = dict(params, segment_id=0)
+    return [
+        (f"{base_path}segmentdata/", segment),
+        (f"{base_path}analogsignaldata/", dict(segment, analog_signal_id=0, down_sample_factor=1)),
+        (f"{base_path}spiketraindata/", segment),
+    ]
+
+
+async def prefetch(app, requests, headers):
+    """
+    Make the given requests to the application, one at a time, so that the responses are
+    in the response cache (see `response_cache.ResponseCache`) when the client requests them.
+    Requests from clients for the same data wait for the prefetch, see `wait_for_prefetch()`.
+
+    Requests which another prefetch is already making are skipped. Only one prefetch request
+    is made at a time, by all prefetches, so that prefetching uses at most one executor worker
+    and requests from clients are not delayed.
+    """
+    _prefetching.set(True)
+    # only the events created here are set and removed here
+    events = {}
+    for path, params in requests:
+        key = request_key(path, params.items(), headers.get("Accept"))
+        if key not in _in_flight:
+            events[key] = _in_flight[key] = asyncio.Event()
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+
+    def done(key):
+        event = events.pop(key)
+        event.set()
+        del _in_flight[key]
+
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://prefetch") as client:
+            for path, params in requests:
+                key = request_key(path, params.items(), headers.get("Accept"))
+                if key not in events:
+                    continue
+                try:
+                    async with single_flight(_worker_key):
+                        await client.get(path, params=params, headers=headers)
+                except Exception:
+                    # prefetching is only an optimization, the request will be repeated by the client
+                    return
+                finally:
+                    done(key)
+    finally:
+        for key in list(events):
+            done(key)
+
+
+async def wait_for_prefetch(request):
+    """
+    If the response to `request` is being prefetched, wait until it is in the response cache,
+    rather than producing it a second time, for at most `settings.PREFETCH_WAIT_TIMEOUT` seconds.
+    """
+    if _prefetching.get():
+        return
+    key = request_key(request.url.path, request.query_params.multi_items(), request.headers.get("Accept"))
+    event = _in_flight.get(key)
+    if event is not None:
+        try:
+            await asyncio.wait_for(event.wait(), settings.PREFETCH_WAIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            # e.g. the prefetch is waiting behind prefetches of other files
+            pass
+
+
+def schedule_prefetch(request):
+    """
+    If prefetching is enabled, start prefetching the data likely to be requested after
+    the `/blockdata/` request `request`, in the background.
+
+    At most `settings.PREFETCH_MAX_TASKS` prefetches run at once, further requests
+    are not prefetched, so that prefetching does not delay requests from clients.
+    """
+    if not settings.PREFETCH_AFTER_BLOCKDATA or len(_tasks) >= settings.PREFETCH_MAX_TASKS:
+        return
+    # the response is not sent anywhere, so there is no point compressing it
+    headers = {"Accept-Encoding": "identity"}
+    if "Accept" in request.headers:
+        # the Accept header determines the response format, and is part of the ETag
+        headers["Accept"] = request.headers["Accept"]
+    task = asyncio.get_running_loop().create_task(
+        prefetch(request.app, follow_up_requests(request), headers)
+    )
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
@@ -0,0 +1,197 @@
+"""
+Multi-resolution min/max pyramids for analog signals, so that zooming and panning
+through long recordings does not require re-reading the data file.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import neo
+from neo.io import proxyobjects
+
+from . import settings
+from .decimation import iter_chunks, load_samples, MinMaxAccumulator
+
+
+def get_pyramid_path(entry, block_id, segment_id, analog_signal_id):
+    """
+    Pyramids are stored alongside the data file in the download cache,
+    with one directory per signal.
+    """
+    io_name = entry.io_cls.__name__ if entry.io_cls else "auto"
+    return os.path.join(
+        f"{entry.main_path}.pyramid",
+        io_name,
+        f"block{block_id}-segment{segment_id}-signal{analog_signal_id}",
+    )
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution representation of an analog signal.
+
+    Level 0 contains the original samples, which are read from the data file when needed.
+    Level k > 0 contains, for successive buckets of `base_bucket_size * factor ** (k - 1)`
+    samples, the minimum and maximum of each channel in the order in which they occur,
+    i.e. two points per bucket. The top level fits within a single tile.
+
+    Levels above 0 are stored as .npy files and memory-mapped when read.
+    All levels are divided into tiles of `tile_size` points.
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self.tile_size = metadata["tile_size"]
+        self.n_levels = metadata["n_levels"]
+
+    @classmethod
+    def load_or_build(cls, signal, path):
+        """Load the pyramid stored at `path`, building it first if it does not exist."""
+        if not isinstance(signal, (neo.AnalogSignal, proxyobjects.AnalogSignalProxy)):
+            raise ValueError("Tiles are only available for regularly-sampled signals")
+        metadata_path = os.path.join(path, "metadata.json")
+        if not os.path.exists(metadata_path):
+            cls.build(signal, path)
+        with open(metadata_path) as fp:
+            metadata = json.load(fp)
+        return cls(path, metadata)
+
+    @classmethod
+    def build(cls, signal, path):
+        """
+        Compute all levels of the pyramid for `signal`, and store them at `path`.
+
+        The signal is read once, in chunks, and each level is computed from the level below,
+        so memory use is bounded by the chunk size. The levels are written to a temporary
+        directory which is then renamed, so a partially-built pyramid is never visible.
+        """
+        n_samples, n_channels = signal.shape
+        base_bucket_size = settings.PYRAMID_BASE_BUCKET_SIZE
+        factor = settings.PYRAMID_FACTOR
+        tile_size = settings.PYRAMID_TILE_SIZE
+        time_units = signal.t_start.units
+        metadata = {
+            "name": signal.name or "",
+            "n_samples": n_samples,
+            "n_channels": n_channels,
+            "t_start": float(signal.t_start.magnitude),
+            "sampling_period": float(signal.sampling_period.rescale(time_units).magnitude),
+            "times_dimensionality": str(time_units.dimensionality),
+            "values_units": str(signal.units.dimensionality),
+            "base_bucket_size": base_bucket_size,
+            "factor": factor,
+            "tile_size": tile_size,
+        }
+
+        parent_dir = os.path.dirname(path)
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=parent_dir, prefix=".tmp-")
+        try:
+            level = 0
+            source = None  # None means the original signal
+            n_points = n_samples
+            while n_points > tile_size:
+                level += 1
+                bucket_size = base_bucket_size if level == 1 else 2 * factor
+                n_points = 2 * int(np.ceil(n_points / bucket_size))
+                level_path = os.path.join(tmp_path, f"level{level}.npy")
+                if source is None:
+                    chunks = iter_chunks(signal, 0, n_samples)
+                    dtype = None
+                else:
+                    chunks = cls._iter_array_chunks(source)
+                    dtype = source.dtype
+                source = cls._build_level(chunks, bucket_size, level_path, n_points, n_channels, dtype)
+            metadata["n_levels"] = level + 1
+            with open(os.path.join(tmp_path, "metadata.json"), "w") as fp:
+                json.dump(metadata, fp)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another worker has built the same pyramid in the meantime
+                if not os.path.exists(os.path.join(path, "metadata.json")):
+                    raise
+                shutil.rmtree(tmp_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def _iter_array_chunks(array):
+        chunk_size = max(1, settings.SIGNAL_CHUNK_VALUES // array.shape[1])
+        for i in range(0, array.shape[0], chunk_size):
+            yield i, np.asarray(array[i:i + chunk_size])
+
+    @staticmethod
+    def _build_level(chunks, bucket_size, level_path, n_points, n_channels, dtype):
+        """Write the min/max envelope of the data from `chunks` to a new .npy file."""
+        accumulator = MinMaxAccumulator(bucket_size)
+        level_data = None
+        cursor = 0
+        for offset, data in chunks:
+            # see https://stackoverflow.com/questions/6736590/fast-check-for-nan-in-numpy
+            if np.isnan(np.min(data)):
+                raise ValueError("Data contains NaN")
+            if level_data is None:
+                level_data = np.lib.format.open_memmap(
+                    level_path, mode="w+", dtype=dtype or data.dtype, shape=(n_points, n_channels)
+                )
+            accumulator.add(data, offset)
+            envelope = accumulator.pop_envelope()
+            if envelope is not None:
+                level_data[cursor:cursor + envelope.shape[0]] = envelope
+                cursor += envelope.shape[0]
+        envelope = accumulator.pop_envelope(final=True)
+        level_data[cursor:cursor + envelope.shape[0]] = envelope
+        level_data.flush()
+        return level_data
+
+    def samples_per_point(self, level):
+        if level == 0:
+            return 1
+        bucket_size = self.metadata["base_bucket_size"] * self.metadata["factor"] ** (level - 1)
+        return bucket_size / 2
+
+    def n_points(self, level):
+        if level == 0:
+            return self.metadata["n_samples"]
+        n_buckets = int(np.ceil(self.metadata["n_samples"] / (2 * self.samples_per_point(level))))
+        return 2 * n_buckets
+
+    def n_tiles(self, level):
+        return int(np.ceil(self.n_points(level) / self.tile_size))
+
+    def sampling_period(self, level):
+        """Time interval between successive points in the given level."""
+        return self.metadata["sampling_period"] * self.samples_per_point(level)
+
+    def get_tile(self, signal, level, tile):
+        """
+        Return the values of the given tile, with shape (n_points, n_channels),
+        and the time of the first point.
+
+        `signal` is only used for level 0, and must be accessed under the IO cache entry lock.
+        """
+        if not 0 <= level < self.n_levels:
+            raise ValueError(f"level must be between 0 and {self.n_levels - 1}")
+        if not 0 <= tile < self.n_tiles(level):
+            raise ValueError(f"tile must be between 0 and {self.n_tiles(level) - 1} for level {level}")
+        i_start = tile * self.tile_size
+        i_stop = min(i_start + self.tile_size, self.n_points(level))
+        if level == 0:
+            values = load_samples(signal, i_start, i_stop).magnitude
+            if np.isnan(np.min(values)):
+                raise ValueError("Data contains NaN")
+        else:
+            level_data = np.load(os.path.join(self.path, f"level{level}.npy"), mmap_mode="r")
+            values = np.array(level_data[i_start:i_stop])
+        t_start = self.metadata["t_start"] + i_start * self.sampling_period(level)
+        return values, t_start
@@ -0,0 +1,209 @@
+"""
+Reading of remote data files with HTTP range requests, so that only the parts of a file
+that are actually needed (e.g. the header and a section of one dataset) are downloaded.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import io
+import os
+import tempfile
+import threading
+
+from . import settings
+from .downloader import (
+    get_client, get_range_validator, get_validators_path, read_record, write_record
+)
+
+
+# Neo IOs whose RawIOs pass their `filename` attribute directly to h5py.File(),
+# and can therefore read from a file-like object, see `get_remote_io_class()`.
+# NWBIO and NixIO are not included, since pynwb and nixio require a path.
+REMOTE_IOS = ("BiocamIO", "MaxwellIO")
+
+_remote_io_classes = {}
+
+
+def get_block_map_path(cache_path):
+    return f"{cache_path}.blocks"
+
+
+def get_remote_io_class(io_cls):
+    """
+    Return a subclass of the Neo IO class `io_cls` (one of `REMOTE_IOS`)
+    which reads from a `RemoteFile` given as its only argument.
+
+    The IOs convert their `filename` argument to a string, so the file object is only
+    given to the RawIO while it parses the header, which opens the file with h5py.
+    The h5py file is kept by the RawIO, and is used for all subsequent reads.
+    """
+    if io_cls not in _remote_io_classes:
+        def __init__(self, file):
+            self._remote_file = file
+            io_cls.__init__(self, filename=file.name)
+
+        def _parse_header(self):
+            self.filename = self._remote_file
+            try:
+                io_cls._parse_header(self)
+            finally:
+                self.filename = self._remote_file.name
+
+        _remote_io_classes[io_cls] = type(
+            io_cls.__name__, (io_cls,), {"__init__": __init__, "_parse_header": _parse_header}
+        )
+    return _remote_io_classes[io_cls]
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    Read-only file-like object giving access to a file on an HTTP server which supports range requests.
+
+    Data are fetched in blocks of `settings.REMOTE_BLOCK_SIZE` bytes, and stored in a sparse local file
+    at `cache_path`, of the same size as the remote file, so each block is only downloaded once.
+    The blocks which have been downloaded are recorded in a block map, with one byte per block,
+    which is shared by all worker processes.
+
+    Blocks are only accepted from the version of the file which was probed when the cache file
+    was created (see `create()`): `OSError` is raised if the file has since changed on the server,
+    after calling `on_change()`, if given, so that the cache file can be replaced.
+    """
+
+    def __init__(self, url, cache_path, on_change=None):
+        self.url = url
+        self.name = url
+        self.cache_path = cache_path
+        self._fd = os.open(cache_path, os.O_RDWR)
+        self.size = os.fstat(self._fd).st_size
+        self.block_size = settings.REMOTE_BLOCK_SIZE
+        self.n_blocks = -(-self.size // self.block_size)
+        self._position = 0
+        self._lock = threading.Lock()
+        self._present = self._read_block_map()
+        record = read_record(get_validators_path(cache_path)) or {}
+        self.validators = record.get("validators", {})
+        self.on_change = on_change
+
+    @classmethod
+    def create(cls, cache_path, size, validators):
+        """
+        Create an empty (sparse) cache file for a remote file of the given size,
+        recording the validators (ETag and Last-Modified) of that version of the file.
+        """
+        dir_path = os.path.dirname(cache_path)
+        write_record(get_validators_path(cache_path), {"validators": validators})
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix=".tmp-")
+        try:
+            os.ftruncate(fd, size)
+            os.close(fd)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def __repr__(self):
+        return f"RemoteFile({self.url!r})"
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        return self._position
+
+    def readinto(self, buffer):
+        n_bytes = min(len(buffer), self.size - self._position)
+        if n_bytes <= 0:
+            return 0
+        with self._lock:
+            self._ensure_present(self._position, self._position + n_bytes)
+            data = os.pread(self._fd, n_bytes, self._position)
+        memoryview(buffer)[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            os.close(self._fd)
+        super().close()
+
+    def _read_block_map(self):
+        try:
+            with open(get_block_map_path(self.cache_path), "rb") as fp:
+                block_map = bytearray(fp.read())
+        except FileNotFoundError:
+            block_map = bytearray()
+        if len(block_map) != self.n_blocks:
+            block_map = bytearray(self.n_blocks)
+        return block_map
+
+    def _write_block_map(self):
+        # merge with any blocks downloaded by other processes in the meantime
+        on_disk = self._read_block_map()
+        self._present = bytearray(a | b for a, b in zip(self._present, on_disk))
+        map_path = get_block_map_path(self.cache_path)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(map_path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(self._present)
+            os.replace(tmp_path, map_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _ensure_present(self, start, stop):
+        """Download any blocks containing the bytes from start to stop which are not yet in the cache."""
+        blocks = range(start // self.block_size, (stop - 1) // self.block_size + 1)
+        if all(self._present[i] for i in blocks):
+            return
+        # another process may have downloaded them
+        self._present = bytearray(a | b for a, b in zip(self._present, self._read_block_map()))
+        missing = [i for i in blocks if not self._present[i]]
+        if not missing:
+            return
+        # consecutive blocks are fetched with a single request
+        run_start = missing[0]
+        for previous, current in zip(missing, missing[1:] + [None]):
+            if current != previous + 1:
+                self._fetch(run_start, previous)
+                run_start = current
+        self._write_block_map()
+
+    def _fetch(self, first_block, last_block):
+        start = first_block * self.block_size
+        end = min((last_block + 1) * self.block_size, self.size) - 1
+        headers = {"Range": f"bytes={start}-{end}"}
+        validator = get_range_validator(self.validators)
+        if validator:
+            headers["If-Range"] = validator
+        with get_client().stream("GET", self.url, headers=headers) as response:
+            response.raise_for_status()
+            etag = self.validators.get("ETag")
+            if response.status_code != 206 or (etag and response.headers.get("ETag", etag) != etag):
+                if self.on_change is not None:
+                    # only once, since by then the cache file may have been replaced by a new one
+                    on_change, self.on_change = self.on_change, None
+                    on_change()
+                raise OSError(f"{self.url} has changed on the server, or does not support range requests")
+            position = start
+            for chunk in response.iter_bytes():
+                position += os.pwrite(self._fd, chunk, position)
+        if position != end + 1:
+            raise OSError(f"Incomplete download of bytes {start}-{end} of {self.url}")
+        self._present[first_block:last_block + 1] = b"\x01" * (last_block + 1 - first_block)
@@ -7,10 +7,12 @@ Licence: MIT (see LICENSE)
 
 """
 
+import os
 from typing import Annotated
 from pydantic import HttpUrl, PositiveInt
 
-from fastapi import Query, HTTPException, APIRouter, status
+from fastapi import Query, Header, HTTPException, APIRouter, Request, status
+from fastapi.responses import Response
 
 from ..metadata import title, description
 from ..data_models import (
@@ -19,12 +21,178 @@ from ..data_models import (
     AnalogSignal,
     SpikeTrain,
     BlockContainer,
+    AnalogSignalPyramid,
+    ValueDtype,
+    dump_json,
+    reduce_precision,
 )
-from ..data_handler import load_blocks
+from ..data_handler import (
+    open_blocks, open_cache_entry, checkout_cache_entry, io_cache, get_index_key, get_file_key,
+    load_block_structure, record_cached_access,
+)
+from ..disk_cache import disk_cache
+from ..metadata_index import metadata_index
+from ..pyramid import MinMaxPyramid, get_pyramid_path
+from ..formats import (
+    ResponseFormat,
+    media_types,
+    negotiate_format,
+    signal_response,
+    signals_response,
+    spike_trains_response,
+)
+from .. import settings
+from ..concurrency import run_blocking, single_flight
+from ..http_caching import conditional_response
+from ..prefetch import schedule_prefetch
+from ..streaming import iter_json, iter_ndjson, streaming_response, with_lock
 
 router = APIRouter()
 
 
+def json_response(content):
+    """
+    Encode the response content as JSON.
+
+    For signal data this is expensive, so it should take place in the executor
+    rather than being left to FastAPI, which would do it in the event loop.
+    """
+    return Response(content=dump_json(content), media_type="application/json")
+
+
+def indexed_json_response(url, io_class_name, item, get_content):
+    """
+    Return a JSON response with the metadata `item` of the data file at `url`, from
+    `metadata_index` if possible, without opening the file.
+    Otherwise, the content is produced by `get_content()`, then added to the index.
+
+    Several URLs can lead to the same file, e.g. through redirects, and the content includes
+    the requested URL (as `file_origin`), so the URL is part of the item name.
+    """
+    io_name = io_class_name.value if io_class_name else ""
+    item = f"{item}:{url}"
+    key = get_index_key(url)
+    if key is not None:
+        content = metadata_index.get(*key, io_name, item)
+        if content is not None:
+            record_cached_access(url)
+            return Response(content=content, media_type="application/json")
+    response = json_response(get_content())
+    # the file has just been downloaded or checked for changes, so its version is known
+    key = get_index_key(url)
+    if key is not None:
+        metadata_index.put(*key, io_name, item, response.body)
+    return response
+
+
+async def run_for_file(url, io_class_name, func):
+    """
+    Run `func()`, which opens the data file at `url`, in the executor.
+
+    Only one request at a time does so for each file and IO, the others wait in the event loop:
+    a request waiting for the file to be downloaded and opened by another would otherwise hold
+    a worker thread, delaying requests for other files.
+    """
+    url = str(url)
+    async with single_flight(url):
+        key = await run_blocking(get_file_key, url, io_class_name)
+    async with single_flight(key):
+        return await run_blocking(func)
+
+
+def get_segment(blocks, block_id, segment_id):
+    """Return the requested segment, or raise an HTTP 400 error if it does not exist."""
+    try:
+        block = blocks[block_id]
+    except IndexError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="IndexError on block_id",  # todo: improve this message in next API version
+        )
+    try:
+        segment = block.segments[segment_id]
+    except IndexError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="IndexError on segment_id",  # todo: improve this message in next API version
+        )
+    return segment
+
+
+def get_signal(segment, analog_signal_id):
+    """Return the requested analog or irregularly-sampled signal from a segment."""
+    if len(segment.analogsignals) > 0:
+        container = segment.analogsignals
+    else:
+        container = segment.irregularlysampledsignals
+    try:
+        signal = container[analog_signal_id]
+    except IndexError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="IndexError on analog_signal_id",  # todo: improve this message in next API version
+        )
+    return signal
+
+
+def select_signals(blocks, selectors):
+    """
+    Return the signals given by selectors of the form "block_id:segment_id:analog_signal_id",
+    keyed by selector, where "*" selects all the segments of a block or all the signals of a segment.
+    """
+    selected = {}
+    for selector in selectors:
+        try:
+            block_id, segment_id, signal_id = selector.split(":")
+            block_id = int(block_id)
+            segment_ids = None if segment_id == "*" else [int(segment_id)]
+            signal_ids = None if signal_id == "*" else [int(signal_id)]
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Invalid signal selector '{selector}', expected 'block_id:segment_id:analog_signal_id'",
+            )
+        if segment_ids is None:
+            try:
+                segment_ids = range(len(blocks[block_id].segments))
+            except IndexError:
+                # get_segment() reports the error
+                segment_ids = [0]
+        for i in segment_ids:
+            segment = get_segment(blocks, block_id, i)
+            n_signals = len(segment.analogsignals) or len(segment.irregularlysampledsignals)
+            for j in range(n_signals) if signal_ids is None else signal_ids:
+                selected[f"{block_id}:{i}:{j}"] = get_signal(segment, j)
+        if len(selected) > settings.BATCH_MAX_SIGNALS:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"At most {settings.BATCH_MAX_SIGNALS} signals can be requested at once",
+            )
+    return selected
+
+
+def get_pyramid(entry, block_id, segment_id, analog_signal_id):
+    """
+    Return the requested signal and its multi-resolution pyramid,
+    building the pyramid if this is the first time it has been requested.
+    """
+    segment = get_segment(entry.blocks, block_id, segment_id)
+    signal = get_signal(segment, analog_signal_id)
+    pyramid_path = get_pyramid_path(entry, block_id, segment_id, analog_signal_id)
+    is_new = not os.path.exists(pyramid_path)
+    try:
+        pyramid = MinMaxPyramid.load_or_build(signal, pyramid_path)
+    except (ValueError, OSError) as err:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(err),
+        )
+    if is_new:
+        # pyramids are stored in the download cache, and count towards its size
+        disk_cache.update_size(entry.main_path)
+    return signal, pyramid
+
+
 @router.get("/")
 async def info():
     """Return information about the API."""
@@ -37,6 +205,7 @@ async def info():
 
 @router.get("/blockdata/")
 async def get_block_data(
+    request: Request,
     url: Annotated[
         HttpUrl, Query(description="Location of a data file that can be read by Neo.")
     ],
@@ -55,13 +224,28 @@ async def get_block_data(
     including metadata about the segments within each block,
     but without any information about the data contained within each segment.
     """
-    # here `url` is a Pydantic object, which we convert to a string
-    blocks = load_blocks(str(url), type)
-    return BlockContainer.from_neo(blocks, url)
+
+    def get_content():
+        # here `url` is a Pydantic object, which we convert to a string
+        blocks = load_block_structure(str(url), type)
+        if blocks is not None:
+            # for IOs which do not support lazy loading, avoid reading all the data
+            return BlockContainer.from_neo(blocks, url)
+        with open_blocks(str(url), type) as blocks:
+            return BlockContainer.from_neo(blocks, url)
+
+    def load():
+        return indexed_json_response(str(url), type, "blocks", get_content)
+
+    response = await conditional_response(request, url, lambda: run_for_file(url, type, load))
+    if response.status_code == status.HTTP_200_OK:
+        schedule_prefetch(request)
+    return response
 
 
 @router.get("/segmentdata/")
 async def get_segment_data(
+    request: Request,
     url: Annotated[
         HttpUrl, Query(description="Location of a data file that can be read by Neo.")
     ],
@@ -92,25 +276,21 @@ async def get_segment_data(
     including metadata about the signals contained in the segment,
     but not the signal data themselves.
     """
-    try:
-        block = load_blocks(str(url), type)[block_id]
-    except IndexError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on block_id",  # todo: improve this message in next API version
-        )
-    try:
-        segment = block.segments[segment_id]
-    except IndexError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on segment_id",  # todo: improve this message in next API version
-        )
-    return Segment.from_neo(segment, url)
+
+    def get_content():
+        with open_blocks(str(url), type) as blocks:
+            segment = get_segment(blocks, block_id, segment_id)
+            return Segment.from_neo(segment, url)
+
+    def load():
+        return indexed_json_response(str(url), type, f"segment:{block_id}:{segment_id}", get_content)
+
+    return await conditional_response(request, url, lambda: run_for_file(url, type, load))
 
 
 @router.get("/analogsignaldata/")
 async def get_analogsignal_data(
+    request: Request,
     url: Annotated[
         HttpUrl, Query(description="Location of a data file that can be read by Neo.")
     ],
@@ -145,45 +325,401 @@ async def get_analogsignal_data(
             )
         ),
     ] = 1,
+    t_start: Annotated[
+        float | None,
+        Query(
+            description=(
+                "Start of the time window to return, in the time units of the signal. "
+                "If not provided, data are returned from the start of the signal."
+            )
+        ),
+    ] = None,
+    t_stop: Annotated[
+        float | None,
+        Query(
+            description=(
+                "End of the time window to return, in the time units of the signal. "
+                "If not provided, data are returned up to the end of the signal."
+            )
+        ),
+    ] = None,
+    channels: Annotated[
+        str | None,
+        Query(
+            description=(
+                "Channels to return, for multi-channel signals, given as a comma-separated list "
+                "of channel indices and/or ranges, e.g. '0,3,5-7'. "
+                "If not provided, all channels are returned."
+            )
+        ),
+    ] = None,
+    max_points: Annotated[
+        PositiveInt | None,
+        Query(
+            description=(
+                "Maximum number of points to return per channel. If the signal contains more samples "
+                "than this, it is represented by the minimum and maximum values within successive "
+                "time intervals, which preserves peaks that simple down-sampling would miss. "
+                "Since each interval gives two points, this must be at least 2, "
+                "and odd values are rounded down to an even number. "
+                "The signal is then read in chunks, so memory use does not depend on its length. "
+                "If provided, down_sample_factor is ignored."
+            )
+        ),
+    ] = None,
+    format: Annotated[
+        ResponseFormat | None,
+        Query(
+            description=(
+                "Format of the response: 'json' (the default), 'binary' (a JSON header followed by "
+                "raw little-endian arrays), 'npy' (NumPy format, with the metadata in the "
+                "X-Neo-Viewer-Metadata response header; for irregularly-sampled signals, a NumPy "
+                ".npz archive with arrays 'values' and 'times'), 'arrow' (Apache Arrow IPC stream) "
+                "or 'ndjson' (streamed newline-delimited JSON: a line containing the metadata, "
+                "then one line per chunk of data). "
+                "If not provided, the format is chosen from the Accept header."
+            )
+        ),
+    ] = None,
+    stream: Annotated[
+        bool,
+        Query(
+            description=(
+                "If true, JSON responses are sent in pieces as the data are read, "
+                "rather than once all the data have been read. This reduces memory use "
+                "and the time to the first byte for long signals, but errors in the data "
+                "(such as NaN values) can then only be signalled by interrupting the response."
+            )
+        ),
+    ] = False,
+    dtype: Annotated[
+        ValueDtype | None,
+        Query(
+            description=(
+                "Floating-point type of the returned values. 'float32' halves the size of the binary "
+                "formats and shortens the JSON representation, with about 7 significant digits. "
+                "If not provided, the values are returned with the type used in the data file."
+            )
+        ),
+    ] = None,
+    precision: Annotated[
+        int | None,
+        Query(
+            ge=1,
+            le=17,
+            description=(
+                "Number of significant digits to which the values are rounded. "
+                "This makes JSON responses shorter and binary responses more compressible."
+            )
+        ),
+    ] = None,
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ) -> AnalogSignal:
-    """Get an analog signal from a given segment, including both data and metadata."""
-    try:
-        block = load_blocks(str(url), type)[block_id]
-    except IndexError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on block_id",  # todo: improve this message in next API version
-        )
-    try:
-        segment = block.segments[segment_id]
-    except IndexError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on segment_id",  # todo: improve this message in next API version
+    """
+    Get an analog signal from a given segment, including both data and metadata.
+
+    If `t_start` and/or `t_stop` are given, only the data within that time window are read,
+    and the `t_start` and `t_stop` of the response give the window actually returned.
+
+    In the binary formats, the values are sent as an array with shape (n_channels, n_samples).
+    """
+    response_format = negotiate_format(format, accept)
+
+    async def stream_response():
+
+        def prepare():
+            # the cache entry is released once the response has been sent, see streaming_response()
+            entry = checkout_cache_entry(str(url), type)
+            try:
+                with entry.lock:
+                    segment = get_segment(entry.blocks, block_id, segment_id)
+                    signal = get_signal(segment, analog_signal_id)
+                    try:
+                        chunks = AnalogSignal.chunks_from_neo(
+                            signal, down_sample_factor, t_start, t_stop, channels, max_points
+                        )
+                    except (ValueError, OSError) as err:
+                        raise HTTPException(
+                            status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=str(err),
+                        )
+            except BaseException:
+                io_cache.checkin(entry)
+                raise
+            return entry, chunks
+
+        entry, (data, n_channels, read_chunks) = await run_for_file(url, type, prepare)
+        encode = iter_ndjson if response_format == ResponseFormat.ndjson else iter_json
+        body = encode(data, n_channels, with_lock(read_chunks, entry.lock), dtype, precision)
+        return streaming_response(
+            body, media_types[response_format], release=lambda: io_cache.checkin(entry)
         )
-    if len(segment.analogsignals) > 0:
-        container = segment.analogsignals
-    else:
-        container = segment.irregularlysampledsignals
-    try:
-        signal = container[analog_signal_id]
-    except IndexError:
+
+    if response_format == ResponseFormat.ndjson or (stream and response_format == ResponseFormat.json):
+        return await conditional_response(request, url, stream_response)
+
+    def load():
+        with open_blocks(str(url), type) as blocks:
+            segment = get_segment(blocks, block_id, segment_id)
+            signal = get_signal(segment, analog_signal_id)
+            try:
+                data = AnalogSignal.data_from_neo(
+                    signal, down_sample_factor, t_start, t_stop, channels, max_points
+                )
+            except (ValueError, OSError) as err:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=str(err),
+                )
+        data["values"] = reduce_precision(data["values"], dtype, precision)
+        if response_format == ResponseFormat.json:
+            return json_response(AnalogSignal.from_data(data))
+        return signal_response(data, response_format)
+
+    return await conditional_response(request, url, lambda: run_for_file(url, type, load))
+
+
+@router.get("/analogsignalbatch/")
+async def get_analogsignal_batch(
+    request: Request,
+    url: Annotated[
+        HttpUrl, Query(description="Location of a data file that can be read by Neo.")
+    ],
+    signals: Annotated[
+        list[str],
+        Query(
+            description=(
+                "Signals to return, each given as 'block_id:segment_id:analog_signal_id'. "
+                "'*' may be used for the segment or signal index, e.g. '0:3:*' selects all signals "
+                "in segment 3 of block 0 and '0:*:0' the first signal of every segment. "
+                "The parameter may be repeated."
+            )
+        ),
+    ],
+    type: Annotated[
+        IOModule,
+        Query(
+            description=(
+                "Specify a specific Neo IO module that should be used to open the data file."
+                "If not provided, Neo will try to determine which module to use."
+            )
+        ),
+    ] = None,
+    down_sample_factor: Annotated[
+        PositiveInt | None | str,
+        Query(description="Factor by which data should be downsampled prior to loading."),
+    ] = 1,
+    t_start: Annotated[
+        float | None,
+        Query(description="Start of the time window to return, in the time units of each signal."),
+    ] = None,
+    t_stop: Annotated[
+        float | None,
+        Query(description="End of the time window to return, in the time units of each signal."),
+    ] = None,
+    channels: Annotated[
+        str | None,
+        Query(description="Channels to return for each signal, e.g. '0,3,5-7'."),
+    ] = None,
+    max_points: Annotated[
+        PositiveInt | None,
+        Query(description="Maximum number of points to return per channel, see `/analogsignaldata/`."),
+    ] = None,
+    format: Annotated[
+        ResponseFormat | None,
+        Query(
+            description=(
+                "Format of the response: 'json' (the default), 'binary' (a single binary container "
+                "with arrays named '<selector>/values') or 'npy' (a NumPy .npz archive with the same "
+                "array names, with the metadata as JSON in a uint8 array named 'metadata.json'). "
+                "If not provided, the format is chosen from the Accept header."
+            )
+        ),
+    ] = None,
+    dtype: Annotated[
+        ValueDtype | None,
+        Query(description="Floating-point type of the returned values, see `/analogsignaldata/`."),
+    ] = None,
+    precision: Annotated[
+        int | None,
+        Query(ge=1, le=17, description="Number of significant digits to which the values are rounded."),
+    ] = None,
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
+) -> dict[str, AnalogSignal]:
+    """
+    Get several analog signals from a data file in a single request, keyed by selector,
+    for example all the signals in a segment, or the same signal in all segments.
+
+    The data file is opened once, and the parameters apply to all of the signals,
+    which are returned in the same form as from `/analogsignaldata/`.
+    """
+    response_format = negotiate_format(format, accept)
+    if response_format not in (ResponseFormat.json, ResponseFormat.binary, ResponseFormat.npy):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on analog_signal_id",  # todo: improve this message in next API version
+            detail=f"The {response_format.value} format is not available for batches of signals",
         )
-    try:
-        asig = AnalogSignal.from_neo(signal, down_sample_factor)
-    except (ValueError, OSError) as err:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=str(err),
+
+    def load():
+        with open_blocks(str(url), type) as blocks:
+            selected = {}
+            for key, signal in select_signals(blocks, signals).items():
+                try:
+                    data = AnalogSignal.data_from_neo(
+                        signal, down_sample_factor, t_start, t_stop, channels, max_points
+                    )
+                except (ValueError, OSError) as err:
+                    raise HTTPException(
+                        status_code=status.HTTP_400_BAD_REQUEST,
+                        detail=f"Signal {key}: {err}",
+                    )
+                data["values"] = reduce_precision(data["values"], dtype, precision)
+                selected[key] = data
+        if response_format == ResponseFormat.json:
+            return json_response({key: AnalogSignal.from_data(data) for key, data in selected.items()})
+        return signals_response(selected, response_format)
+
+    return await conditional_response(request, url, lambda: run_for_file(url, type, load))
+
+
+@router.get("/analogsignalpyramid/")
+async def get_analogsignal_pyramid(
+    request: Request,
+    url: Annotated[
+        HttpUrl, Query(description="Location of a data file that can be read by Neo.")
+    ],
+    segment_id: Annotated[
+        int,
+        Query(description="Index of the segment in which the analog signal is found."),
+    ],
+    analog_signal_id: Annotated[
+        int, Query(description="Index of the signal within the segment.")
+    ],
+    block_id: Annotated[
+        int,
+        Query(
+            description="Index of the block for which metadata should be returned."
+        ),
+    ] = 0,
+    type: Annotated[
+        IOModule,
+        Query(
+            description=(
+                "Specify a specific Neo IO module that should be used to open the data file."
+                "If not provided, Neo will try to determine which module to use."
+            )
+        ),
+    ] = None,
+) -> AnalogSignalPyramid:
+    """
+    Return the resolution levels, and the number of tiles in each level,
+    available from `/analogsignaltile/` for a given analog signal.
+
+    The first request for a given signal reads the entire signal to compute the levels,
+    subsequent requests are fast.
+    """
+
+    def load():
+        with open_cache_entry(str(url), type) as entry:
+            signal, pyramid = get_pyramid(entry, block_id, segment_id, analog_signal_id)
+        return json_response(AnalogSignalPyramid.from_pyramid(pyramid))
+
+    return await conditional_response(request, url, lambda: run_for_file(url, type, load))
+
+
+@router.get("/analogsignaltile/")
+async def get_analogsignal_tile(
+    request: Request,
+    url: Annotated[
+        HttpUrl, Query(description="Location of a data file that can be read by Neo.")
+    ],
+    segment_id: Annotated[
+        int,
+        Query(description="Index of the segment in which the analog signal is found."),
+    ],
+    analog_signal_id: Annotated[
+        int, Query(description="Index of the signal within the segment.")
+    ],
+    level: Annotated[
+        int,
+        Query(
+            description=(
+                "Resolution level. Level 0 contains the original samples, "
+                "higher levels contain the minimum and maximum values within successively longer intervals."
+            )
+        ),
+    ],
+    tile: Annotated[
+        int, Query(description="Index of the tile within the level.")
+    ],
+    block_id: Annotated[
+        int,
+        Query(
+            description="Index of the block for which metadata should be returned."
+        ),
+    ] = 0,
+    type: Annotated[
+        IOModule,
+        Query(
+            description=(
+                "Specify a specific Neo IO module that should be used to open the data file."
+                "If not provided, Neo will try to determine which module to use."
+            )
+        ),
+    ] = None,
+    dtype: Annotated[
+        ValueDtype | None,
+        Query(
+            description=(
+                "Floating-point type of the returned values. 'float32' halves the size of the binary "
+                "formats and shortens the JSON representation, with about 7 significant digits. "
+                "If not provided, the values are returned with the type used in the data file."
+            )
+        ),
+    ] = None,
+    precision: Annotated[
+        int | None,
+        Query(
+            ge=1,
+            le=17,
+            description=(
+                "Number of significant digits to which the values are rounded. "
+                "This makes JSON responses shorter and binary responses more compressible."
+            )
+        ),
+    ] = None,
+) -> AnalogSignal:
+    """
+    Get a fixed-size section of an analog signal at a given resolution level,
+    for fast zooming and panning through long recordings.
+    See `/analogsignalpyramid/` for the available levels and tiles.
+    """
+
+    def load():
+        with open_cache_entry(str(url), type) as entry:
+            signal, pyramid = get_pyramid(entry, block_id, segment_id, analog_signal_id)
+            try:
+                values, t_start = pyramid.get_tile(signal, level, tile)
+            except (ValueError, OSError) as err:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=str(err),
+                )
+        values = reduce_precision(values, dtype, precision)
+        return json_response(
+            AnalogSignal.from_data(AnalogSignal.data_from_pyramid_tile(pyramid, level, values, t_start))
         )
-    return asig
+
+    # tiles never change for a given version of the file
+    return await conditional_response(
+        request, url, lambda: run_for_file(url, type, load),
+        cache_control=f"public, max-age={settings.TILE_CACHE_MAX_AGE}",
+    )
 
 
 @router.get("/spiketraindata/")
 async def get_spiketrain_data(
+    request: Request,
     url: Annotated[
         HttpUrl, Query(description="Location of a data file that can be read by Neo.")
     ],
@@ -208,20 +744,37 @@ async def get_spiketrain_data(
             )
         ),
     ] = None,
+    format: Annotated[
+        ResponseFormat | None,
+        Query(
+            description=(
+                "Format of the response: 'json' (the default), 'binary' (a JSON header followed by "
+                "raw little-endian arrays), 'npy' (a NumPy .npz archive with one array per spike train, with the metadata "
+                "as JSON in a uint8 array named 'metadata.json') or 'arrow' (Apache Arrow IPC stream). "
+                "If not provided, the format is chosen from the Accept header."
+            )
+        ),
+    ] = None,
+    accept: Annotated[str | None, Header(include_in_schema=False)] = None,
 ) -> dict[str, SpikeTrain]:
     """Get the spike trains from a given segment, including both data and metadata."""
-    try:
-        block = load_blocks(str(url), type)[block_id]
-    except IndexError:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on block_id",  # todo: improve this message in next API version
-        )
-    try:
-        segment = block.segments[segment_id]
-    except IndexError:
+    response_format = negotiate_format(format, accept)
+    if response_format == ResponseFormat.ndjson:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail="IndexError on segment_id",  # todo: improve this message in next API version
+            detail="The ndjson format is only available for analog signals",
         )
-    return {str(i): SpikeTrain.from_neo(st) for i, st in enumerate(segment.spiketrains)}
+
+    def load():
+        with open_blocks(str(url), type) as blocks:
+            segment = get_segment(blocks, block_id, segment_id)
+            spike_trains = {
+                str(i): SpikeTrain.data_from_neo(st) for i, st in enumerate(segment.spiketrains)
+            }
+        if response_format == ResponseFormat.json:
+            return json_response(
+                {key: SpikeTrain.from_data(data) for key, data in spike_trains.items()}
+            )
+        return spike_trains_response(spike_trains, response_format)
+
+    return await conditional_response(request, url, lambda: run_for_file(url, type, load))
@@ -0,0 +1,133 @@
+"""
+Server-side cache of encoded API responses, so that repeated requests with the same parameters
+do not need to read and serialize the data again.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from . import settings
+
+
+class ResponseCache:
+    """
+    Two-tier cache of response bodies and headers, keyed by the ETag of the response
+    (see `http_caching.compute_etag()`), which changes whenever the data file changes,
+    so that entries for an old version of a file are never used, and are eventually evicted.
+
+    The first tier is a least-recently-used cache in memory, limited to
+    `settings.RESPONSE_CACHE_MEMORY_MAX_BYTES`, the second is a directory in the download cache,
+    shared by all worker processes, limited to `settings.RESPONSE_CACHE_DISK_MAX_BYTES`,
+    from which the least-recently-used files are deleted.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        # bytes written to disk since the size of the directory was last checked
+        self._written = None
+
+    @property
+    def root(self):
+        return os.path.join(getattr(settings, "DOWNLOADED_FILE_CACHE_DIR", ""), "responses")
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.root, digest[:2], digest)
+
+    def get(self, key):
+        """Return the headers and body stored for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        try:
+            with open(self._path(key), "rb") as fp:
+                headers = json.loads(fp.readline())
+                body = fp.read()
+            # the modification time records the last access, see `enforce_disk_budget()`
+            os.utime(self._path(key))
+        except (FileNotFoundError, ValueError):
+            return None
+        self._store_in_memory(key, headers, body)
+        return headers, body
+
+    def put(self, key, headers, body):
+        """Store the headers (a dict) and body (bytes) of a response."""
+        self._store_in_memory(key, headers, body)
+        if len(body) > settings.RESPONSE_CACHE_DISK_MAX_BYTES:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(json.dumps(headers).encode("utf-8") + b"\n")
+                fp.write(body)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._written is not None:
+                self._written += len(body)
+            check = self._written is None or self._written > settings.RESPONSE_CACHE_DISK_MAX_BYTES / 10
+            if check:
+                self._written = 0
+        if check:
+            self.enforce_disk_budget()
+
+    def _store_in_memory(self, key, headers, body):
+        # large responses would evict many smaller ones, so they are only stored on disk
+        max_bytes = settings.RESPONSE_CACHE_MEMORY_MAX_BYTES
+        if len(body) > max_bytes / 16:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._memory_size -= len(previous[1])
+            self._entries[key] = (headers, body)
+            self._memory_size += len(body)
+            while self._memory_size > max_bytes:
+                evicted_key, (evicted_headers, evicted_body) = self._entries.popitem(last=False)
+                self._memory_size -= len(evicted_body)
+
+    def enforce_disk_budget(self):
+        """Delete the least-recently-used files until the directory is within its budget."""
+        files = []
+        for dir_entry in os.scandir(self.root):
+            if dir_entry.is_dir():
+                for file_entry in os.scandir(dir_entry.path):
+                    if not file_entry.name.startswith(".tmp-"):
+                        try:
+                            stat = file_entry.stat()
+                        except FileNotFoundError:
+                            continue
+                        files.append((stat.st_mtime, stat.st_size, file_entry.path))
+        total = sum(size for mtime, size, path in files)
+        for mtime, size, path in sorted(files):
+            if total <= settings.RESPONSE_CACHE_DISK_MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+            self._memory_size = 0
+
+
+response_cache = ResponseCache()
@@ -4,6 +4,83 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # todo: specify this as an environment variable, rather than relative to the code?
 DOWNLOADED_FILE_CACHE_DIR = os.path.join(BASE_DIR, "download_cache")
+# When the files in the download cache exceed this size, the least-recently-used are deleted
+DOWNLOAD_CACHE_MAX_BYTES = int(os.environ.get("DOWNLOAD_CACHE_MAX_BYTES", 100 * 1024**3))
+# Time in seconds after which a cached data file is checked, with a conditional request,
+# to see whether it has changed on the remote server. A negative value disables these checks
+DOWNLOAD_CACHE_MAX_AGE = int(os.environ.get("DOWNLOAD_CACHE_MAX_AGE", 24 * 3600))
 
 HOMEPAGE_DIR = os.environ.get("HOMEPAGE_DIR", os.path.join(BASE_DIR, "..", "homepage"))
 REACT_DIR    = os.environ.get("REACT_DIR",    os.path.join(BASE_DIR, "..", "js", "react", "demo", "build"))
+
+# Opened Neo IOs, and the lazily-loaded blocks read from them, are kept in memory between requests.
+# The byte budget is compared against the size on disk of the data files.
+IO_CACHE_MAX_ENTRIES = int(os.environ.get("IO_CACHE_MAX_ENTRIES", 32))
+IO_CACHE_MAX_BYTES = int(os.environ.get("IO_CACHE_MAX_BYTES", 4 * 1024**3))
+
+# Maximum number of threads used for downloading, parsing and serializing data,
+# which would otherwise block the event loop
+EXECUTOR_MAX_WORKERS = int(os.environ.get("EXECUTOR_MAX_WORKERS", 8))
+
+# Time in seconds for which the result of following redirects from a data file URL is reused
+RESOLVED_URL_TTL = int(os.environ.get("RESOLVED_URL_TTL", 24 * 3600))
+
+# Approximate number of values (samples x channels) read at a time when processing long signals
+SIGNAL_CHUNK_VALUES = int(os.environ.get("SIGNAL_CHUNK_VALUES", 4 * 1024**2))
+
+# Multi-resolution pyramids for analog signals: level 1 has one min/max pair per
+# PYRAMID_BASE_BUCKET_SIZE samples, each higher level covers PYRAMID_FACTOR times as many,
+# and every level is served in tiles of PYRAMID_TILE_SIZE points
+PYRAMID_BASE_BUCKET_SIZE = int(os.environ.get("PYRAMID_BASE_BUCKET_SIZE", 16))
+PYRAMID_FACTOR = int(os.environ.get("PYRAMID_FACTOR", 4))
+PYRAMID_TILE_SIZE = int(os.environ.get("PYRAMID_TILE_SIZE", 4096))
+# max-age, in seconds, of the Cache-Control header for tiles
+TILE_CACHE_MAX_AGE = int(os.environ.get("TILE_CACHE_MAX_AGE", 7 * 24 * 3600))
+# Cache-Control header for other responses concerning a data file, which also have an ETag,
+# so that browsers and proxies such as nginx can cache them, and revalidate them cheaply
+RESPONSE_CACHE_CONTROL = os.environ.get("RESPONSE_CACHE_CONTROL", "public, max-age=3600")
+
+# Encoded responses are cached in memory, up to RESPONSE_CACHE_MEMORY_MAX_BYTES in each worker process,
+# and on disk, in the download cache directory, up to RESPONSE_CACHE_DISK_MAX_BYTES shared by all workers
+RESPONSE_CACHE_MEMORY_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MEMORY_MAX_BYTES", 256 * 1024**2))
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", 4 * 1024**3))
+
+# Responses smaller than COMPRESSION_MINIMUM_SIZE bytes are sent uncompressed.
+# Otherwise they are compressed with zstd, brotli or gzip, depending on the Accept-Encoding header
+# and on whether the zstandard and brotli modules are installed
+COMPRESSION_MINIMUM_SIZE = int(os.environ.get("COMPRESSION_MINIMUM_SIZE", 8 * 1024))
+GZIP_LEVEL = int(os.environ.get("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.environ.get("BROTLI_QUALITY", 4))
+ZSTD_LEVEL = int(os.environ.get("ZSTD_LEVEL", 3))
+
+# Maximum number of signals which can be requested at once from /analogsignalbatch/
+BATCH_MAX_SIGNALS = int(os.environ.get("BATCH_MAX_SIGNALS", 256))
+
+# Approximate number of values (samples x channels) sent in each piece of a streamed response
+STREAMING_CHUNK_VALUES = int(os.environ.get("STREAMING_CHUNK_VALUES", 256 * 1024))
+
+# Files larger than DOWNLOAD_SEGMENT_SIZE bytes are downloaded in segments of this size,
+# over up to DOWNLOAD_MAX_CONNECTIONS parallel connections, if the server supports range requests
+DOWNLOAD_SEGMENT_SIZE = int(os.environ.get("DOWNLOAD_SEGMENT_SIZE", 32 * 1024**2))
+DOWNLOAD_MAX_CONNECTIONS = int(os.environ.get("DOWNLOAD_MAX_CONNECTIONS", 4))
+
+# Limits for the HTTP client used to download data files, which keeps connections open
+# between requests: the maximum number of simultaneous connections, and the timeout in seconds
+# for connecting to a server or waiting for data
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 32))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 60))
+
+# HDF5-based files (see `remote_file.REMOTE_IOS`) larger than REMOTE_READING_MIN_SIZE bytes are not
+# downloaded in full if the server supports range requests: only the blocks of REMOTE_BLOCK_SIZE bytes
+# which are actually read are downloaded, and kept in a sparse file in the download cache
+REMOTE_READING_MIN_SIZE = int(os.environ.get("REMOTE_READING_MIN_SIZE", 256 * 1024**2))
+REMOTE_BLOCK_SIZE = int(os.environ.get("REMOTE_BLOCK_SIZE", 1024**2))
+
+# If PREFETCH_AFTER_BLOCKDATA is 1, the first segment, and the first signal and spike trains in it,
+# are read in the background after each /blockdata/ request, and their responses cached,
+# with at most PREFETCH_MAX_TASKS prefetches at a time
+PREFETCH_AFTER_BLOCKDATA = bool(int(os.environ.get("PREFETCH_AFTER_BLOCKDATA", 0)))
+PREFETCH_MAX_TASKS = int(os.environ.get("PREFETCH_MAX_TASKS", 2))
+# requests for data which is being prefetched wait for the prefetch for at most
+# PREFETCH_WAIT_TIMEOUT seconds, then read the data themselves
+PREFETCH_WAIT_TIMEOUT = float(os.environ.get("PREFETCH_WAIT_TIMEOUT", 10))
@@ -0,0 +1,174 @@
+"""
+Streaming of signal data in chunked responses, so that long signals can be sent
+without holding all of the data, or its JSON representation, in memory.
+
+Copyright CNRS 2023
+Authors: Andrew P. Davison, Onur Ates, Shailesh Appukuttan, Hélissande Fragnaud and Corentin Fragnaud
+Licence: MIT (see LICENSE)
+"""
+
+import tempfile
+
+import numpy as np
+from starlette.background import BackgroundTask
+from starlette.responses import StreamingResponse
+
+from .concurrency import iterate_blocking
+from .data_models import AnalogSignal, dump_json, reduce_precision
+
+
+# memory used for the JSON representation of the channels of a signal before it is
+# written to temporary files, see `_spool_channels()`
+SPOOL_MEMORY = 64 * 1024**2
+SPOOL_READ_SIZE = 1024**2
+
+def with_lock(read_chunks, lock):
+    """Wrap a `read_chunks()` function so that `lock` is held while each chunk is read."""
+
+    def read_locked_chunks(channel=None):
+        chunks = read_chunks(channel)
+        while True:
+            with lock:
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            yield chunk
+
+    return read_locked_chunks
+
+
+def _header(data):
+    """
+    The metadata fields of the AnalogSignal model, in the same order
+    and with the same types as in the non-streamed JSON response.
+    """
+    fields = dict(AnalogSignal.from_data(dict(data, values=np.empty((0, 1)))))
+    del fields["values"], fields["times"]
+    return fields
+
+
+def _join_arrays(arrays):
+    """Yield the JSON representation of the concatenation of a sequence of 1D arrays."""
+    yield b"["
+    first = True
+    for array in arrays:
+        if array.size:
+            # strip the brackets from each piece
+            yield (b"" if first else b",") + dump_json(array)[1:-1]
+            first = False
+    yield b"]"
+
+
+def _spool_channels(read_chunks, n_channels, dtype=None, precision=None):
+    """
+    Read a signal once, one chunk of all channels at a time, and write the JSON representation
+    of the values of each channel, without brackets, to a separate temporary file.
+    The channels can then be sent one after the other, without reading the data once per channel.
+    """
+    max_size = max(1, SPOOL_MEMORY // n_channels)
+    spools = [tempfile.SpooledTemporaryFile(max_size=max_size) for channel in range(n_channels)]
+    try:
+        for values, times in read_chunks():
+            if not values.shape[0]:
+                continue
+            # one row per channel, so that each row is contiguous
+            rows = np.ascontiguousarray(reduce_precision(values, dtype, precision).T)
+            for row, spool in zip(rows, spools):
+                spool.write((b"," if spool.tell() else b"") + dump_json(row)[1:-1])
+    except BaseException:
+        for spool in spools:
+            spool.close()
+        raise
+    return spools
+
+
+def iter_json(data, n_channels, read_chunks, dtype=None, precision=None):
+    """
+    Yield the JSON representation of an analog signal in pieces.
+
+    The result is the same as for `AnalogSignal.from_data()`. Since the values are
+    arranged by channel, signals with several channels are read in full, one chunk
+    at a time, and each channel is kept in a temporary file until it can be sent.
+    See `AnalogSignal.chunks_from_neo()` for the arguments.
+    """
+    yield dump_json(_header(data))[:-1] + b',"values":'
+    if n_channels > 1:
+        spools = _spool_channels(read_chunks, n_channels, dtype, precision)
+        try:
+            yield b"["
+            for channel, spool in enumerate(spools):
+                yield b",[" if channel > 0 else b"["
+                spool.seek(0)
+                while piece := spool.read(SPOOL_READ_SIZE):
+                    yield piece
+                yield b"]"
+            yield b"]"
+        finally:
+            for spool in spools:
+                spool.close()
+    else:
+        yield from _join_arrays(
+            reduce_precision(values[:, 0], dtype, precision) for values, times in read_chunks()
+        )
+    if data.get("sampling_period") is None:
+        # irregularly-sampled signal, which is held in memory
+        yield b',"times":'
+        yield from _join_arrays(times for values, times in read_chunks(0))
+    else:
+        yield b',"times":null'
+    yield b"}"
+
+
+def iter_ndjson(data, n_channels, read_chunks, dtype=None, precision=None):
+    """
+    Yield newline-delimited JSON: a first line containing the metadata of the signal,
+    followed by one line per chunk, containing the index of the first point in the chunk
+    ("offset"), the values, with the same layout as in the JSON response, and, for
+    irregularly-sampled signals, the times.
+
+    Since the headers have already been sent, errors while reading the data
+    are reported in a final line containing only an "error" field.
+    """
+    yield dump_json(dict(_header(data), n_channels=n_channels)) + b"\n"
+    offset = 0
+    try:
+        for values, times in read_chunks():
+            line = {
+                "offset": offset,
+                "values": AnalogSignal.format_values(reduce_precision(values, dtype, precision)),
+            }
+            if times is not None:
+                line["times"] = times
+            yield dump_json(line) + b"\n"
+            offset += values.shape[0]
+    except ValueError as err:
+        yield dump_json({"error": str(err)}) + b"\n"
+
+
+def streaming_response(body, media_type, release):
+    """
+    Send the pieces produced by the blocking iterator `body` as a chunked response.
+
+    `release()` is called once the response is finished or interrupted,
+    to free any resources used by `body`.
+    """
+    released = False
+
+    def release_once():
+        nonlocal released
+        if not released:
+            released = True
+            release()
+
+    async def body_iterator():
+        try:
+            async for piece in iterate_blocking(body):
+                yield piece
+        finally:
+            release_once()
+
+    # the background task covers the case where the client disconnects
+    # before the body iterator has started
+    return StreamingResponse(
+        body_iterator(), media_type=media_type, background=BackgroundTask(release_once)
+    )
@@ -0,0 +1,36 @@
+"""
+
+"""
+
+import os
+import neo
+import pytest
+from .. import settings, data_handler
+
+
+@pytest.fixture
+def offline_cache(monkeypatch, tmp_path):
+    """
+    Use an empty download cache in a temporary directory, in which URLs are used as they are,
+    without resolving redirects, and cached files are never checked for changes.
+    """
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_AGE", -1)
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: url)
+    return str(tmp_path)
+
+
+@pytest.fixture
+def write_cached_file(offline_cache):
+    """
+    Return a function which writes a Neo block with PickleIO into the download cache,
+    as if it had been downloaded from the given URL, and returns the location of the file.
+    """
+
+    def write(url, block):
+        cache_dir, main_file = data_handler.get_cache_path(url)
+        path = os.path.join(cache_dir, main_file)
+        neo.io.PickleIO(path).write_block(block)
+        return path
+
+    return write
@@ -5,6 +5,10 @@
 import os.path
 import urllib.parse
 
+import neo
+import numpy as np
+import pytest
+import quantities as pq
 from fastapi.testclient import TestClient
 
 from ..main import app
@@ -246,3 +250,39 @@ class TestGetData:
         response = test_client.get(f"/api/spiketraindata/?{params}")
         assert response.status_code == 400
         assert response.json()["error"] == "IndexError on segment_id"
+
+
+class TestTimeWindow:
+    url = "https://example.invalid/data/window.pkl"
+
+    @pytest.fixture(autouse=True)
+    def cached_file(self, write_cached_file):
+        block = neo.Block()
+        segment = neo.Segment()
+        segment.analogsignals.append(
+            neo.AnalogSignal(np.arange(100.0).reshape(100, 1), units="mV", sampling_rate=1 * pq.kHz)
+        )
+        block.segments.append(segment)
+        write_cached_file(self.url, block)
+
+    def get(self, **params):
+        params = dict(url=self.url, type="PickleIO", segment_id=0, analog_signal_id=0, **params)
+        return test_client.get("/api/analogsignaldata/", params=params)
+
+    def test_window_is_clipped(self):
+        response = self.get(t_start=-1.0, t_stop=0.05)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["t_start"] == 0.0
+        assert data["t_stop"] == pytest.approx(0.05)
+        assert data["values"] == list(np.arange(50.0))
+
+    def test_inverted_window(self):
+        response = self.get(t_start=0.05, t_stop=0.01)
+        assert response.status_code == 400
+        assert response.json()["error"] == "t_start must be less than t_stop"
+
+    def test_window_outside_signal(self):
+        response = self.get(t_start=1.0, t_stop=2.0)
+        assert response.status_code == 400
+        assert "does not overlap" in response.json()["error"]
@@ -0,0 +1,93 @@
+"""
+
+"""
+
+import io
+import os
+import tarfile
+import zipfile
+import pytest
+from fastapi import HTTPException
+from ..archives import extract, get_root, is_archive, list_members, read_record, SMALL_FILE_SIZE
+from ..data_handler import get_archive_dir
+
+
+class DataIO:
+    extensions = ["dat"]
+
+
+LARGE = b"x" * SMALL_FILE_SIZE
+CONTENTS = {
+    "session/signals.dat": LARGE,
+    "session/video.avi": LARGE,
+    "session/info.txt": b"metadata",
+}
+
+
+def write_zip(path, contents):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, data in contents.items():
+            zf.writestr(name, data)
+
+
+def write_tar(path, contents, mode="w:gz", fileobj=None):
+    with tarfile.open(path, mode, fileobj=fileobj) as tf:
+        for name, data in contents.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+def test_is_archive():
+    assert is_archive("data.zip")
+    assert is_archive("data.tar.gz")
+    assert is_archive("DATA.TZST")
+    assert not is_archive("data.gz")
+    assert not is_archive("data.nix")
+
+
+@pytest.mark.parametrize("filename", ["session.zip", "session.tar", "session.tar.gz", "session.tar.zst"])
+def test_extract_selected_members(tmp_path, filename):
+    archive_path = str(tmp_path / filename)
+    if filename.endswith(".zip"):
+        write_zip(archive_path, CONTENTS)
+    elif filename.endswith(".zst"):
+        zstandard = pytest.importorskip("zstandard")
+        tar_data = io.BytesIO()
+        write_tar(None, CONTENTS, "w", fileobj=tar_data)
+        with open(archive_path, "wb") as fp:
+            fp.write(zstandard.ZstdCompressor().compress(tar_data.getvalue()))
+    else:
+        write_tar(archive_path, CONTENTS, "w" if filename.endswith(".tar") else "w:gz")
+
+    main_path = get_archive_dir(archive_path, str(tmp_path), DataIO)
+    assert main_path == str(tmp_path / "session")
+    assert sorted(os.listdir(main_path)) == ["info.txt", "signals.dat"]
+    with open(os.path.join(main_path, "signals.dat"), "rb") as fp:
+        assert fp.read() == LARGE
+    assert get_root(archive_path, str(tmp_path)) == main_path
+    assert sorted(read_record(archive_path)["extracted"]) == ["session/info.txt", "session/signals.dat"]
+
+    # the remaining files are extracted if another IO needs them
+    assert get_archive_dir(archive_path, str(tmp_path)) == main_path
+    assert sorted(os.listdir(main_path)) == ["info.txt", "signals.dat", "video.avi"]
+    assert [name for name, size in list_members(archive_path)] == list(CONTENTS)
+
+
+def test_archive_without_top_level_directory(tmp_path):
+    archive_path = str(tmp_path / "recording.tar.gz")
+    write_tar(archive_path, {"a.dat": b"1", "sub/b.dat": b"2"})
+    main_path = extract(archive_path, str(tmp_path))
+    assert main_path == str(tmp_path / "recording")
+    assert os.path.exists(os.path.join(main_path, "a.dat"))
+    assert os.path.exists(os.path.join(main_path, "sub", "b.dat"))
+
+
+def test_unsafe_member_is_rejected(tmp_path):
+    archive_path = str(tmp_path / "evil.zip")
+    write_zip(archive_path, {"../outside.txt": b"oops"})
+    cache_dir = tmp_path / "cache"
+    cache_dir.mkdir()
+    with pytest.raises(HTTPException):
+        extract(archive_path, str(cache_dir))
+    assert not os.path.exists(tmp_path / "outside.txt")
@@ -0,0 +1,90 @@
+"""
+
+"""
+
+import io
+import json
+import struct
+import numpy as np
+import quantities as pq
+import neo
+import pytest
+from fastapi.testclient import TestClient
+from ..main import app
+from ..formats import METADATA_HEADER, NPZ_METADATA_NAME
+from .. import settings
+
+
+URL = "https://example.invalid/data/trials.pkl"
+
+test_client = TestClient(app)
+
+
+@pytest.fixture
+def cached_file(write_cached_file):
+    block = neo.Block()
+    for i in range(2):
+        segment = neo.Segment()
+        for j in range(2):
+            segment.analogsignals.append(
+                neo.AnalogSignal([[10.0 * i + j], [1.0]], units="mV", sampling_rate=1 * pq.kHz)
+            )
+        block.segments.append(segment)
+    return write_cached_file(URL, block)
+
+
+def test_batch_json(cached_file):
+    response = test_client.get(
+        "/api/analogsignalbatch/", params={"url": URL, "type": "PickleIO", "signals": ["0:*:1", "0:0:0"]}
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert list(data) == ["0:0:1", "0:1:1", "0:0:0"]
+    assert data["0:1:1"]["values"] == [11.0, 1.0]
+    assert data["0:0:0"]["sampling_period"] == 0.001
+
+
+def test_batch_binary(cached_file):
+    response = test_client.get(
+        "/api/analogsignalbatch/",
+        params={"url": URL, "type": "PickleIO", "signals": "0:1:*", "format": "binary"},
+    )
+    body = response.content
+    header_length = struct.unpack("<I", body[:4])[0]
+    header = json.loads(body[4:4 + header_length])
+    assert list(header["signals"]) == ["0:1:0", "0:1:1"]
+    start = 4 + header_length
+    arrays = {
+        array["name"]: np.frombuffer(
+            body[start + array["offset"]:start + array["offset"] + array["nbytes"]], dtype=array["dtype"]
+        )
+        for array in header["arrays"]
+    }
+    np.testing.assert_array_equal(arrays["0:1:1/values"], [11.0, 1.0])
+
+
+def test_batch_npz(cached_file):
+    response = test_client.get(
+        "/api/analogsignalbatch/",
+        params={"url": URL, "type": "PickleIO", "signals": "0:*:*", "format": "npy"},
+    )
+    arrays = np.load(io.BytesIO(response.content))
+    assert sorted(arrays.files) == [
+        "0:0:0/values", "0:0:1/values", "0:1:0/values", "0:1:1/values", NPZ_METADATA_NAME
+    ]
+    assert METADATA_HEADER not in response.headers
+    metadata = json.loads(arrays[NPZ_METADATA_NAME].tobytes())
+    assert list(metadata["signals"]) == ["0:0:0", "0:0:1", "0:1:0", "0:1:1"]
+
+
+def test_batch_errors(cached_file, monkeypatch):
+    params = {"url": URL, "type": "PickleIO"}
+    response = test_client.get("/api/analogsignalbatch/", params=dict(params, signals="0:0"))
+    assert response.status_code == 400
+    response = test_client.get("/api/analogsignalbatch/", params=dict(params, signals="0:5:0"))
+    assert response.json()["error"] == "IndexError on segment_id"
+    response = test_client.get("/api/analogsignalbatch/", params=dict(params, signals="0:0:0", max_points=1))
+    assert response.status_code == 400
+    monkeypatch.setattr(settings, "BATCH_MAX_SIGNALS", 3)
+    response = test_client.get("/api/analogsignalbatch/", params=dict(params, signals="0:*:*"))
+    assert response.status_code == 400
@@ -0,0 +1,88 @@
+"""
+
+"""
+
+import gzip
+import brotli
+import zstandard
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from ..compression import CompressionMiddleware, choose_encoding, available_compressors
+
+
+BODY = b"0123456789" * 1000
+
+
+def large(request):
+    return Response(BODY, media_type="text/plain")
+
+
+def small(request):
+    return Response(b"small", media_type="text/plain")
+
+
+def streaming(request):
+    return StreamingResponse((BODY for i in range(3)), media_type="text/plain")
+
+
+def already_encoded(request):
+    return Response(gzip.compress(BODY), headers={"Content-Encoding": "gzip"})
+
+
+app = Starlette(
+    routes=[
+        Route("/large", large),
+        Route("/small", small),
+        Route("/streaming", streaming),
+        Route("/already_encoded", already_encoded),
+    ]
+)
+app.add_middleware(CompressionMiddleware, minimum_size=1000)
+client = TestClient(app)
+
+
+def get(path, accept_encoding):
+    # the raw stream is read so that the body is not decoded by the test client
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+def test_choose_encoding():
+    compressors = available_compressors()
+    assert choose_encoding("gzip, deflate, br, zstd", compressors) == "zstd"
+    assert choose_encoding("gzip, br;q=0.9", compressors) == "gzip"
+    assert choose_encoding("identity", compressors) is None
+    assert choose_encoding("*;q=0.5, zstd;q=0", compressors) == "br"
+    assert choose_encoding("", compressors) is None
+
+
+def test_compression():
+    response, body = get("/large", "gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) == len(body)
+    assert gzip.decompress(body) == BODY
+
+    response, body = get("/large", "br")
+    assert brotli.decompress(body) == BODY
+
+    response, body = get("/small", "gzip, br, zstd")
+    assert "content-encoding" not in response.headers
+    assert body == b"small"
+
+    response, body = get("/already_encoded", "br")
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body) == BODY
+
+
+def test_streaming_compression():
+    response, body = get("/streaming", "zstd")
+    assert response.headers["content-encoding"] == "zstd"
+    assert "content-length" not in response.headers
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    assert decompressor.decompress(body) == BODY * 3
+
+    response, body = get("/streaming", "gzip")
+    assert gzip.decompress(body) == BODY * 3
@@ -0,0 +1,114 @@
+"""
+
+"""
+
+import asyncio
+import threading
+import time
+import httpx
+import neo
+from ..main import app
+from .. import concurrency, data_handler, settings
+
+
+class SlowReader:
+    """Wraps `read_blocks()`, taking at least `delay` seconds and recording how many reads overlap."""
+
+    def __init__(self, read_blocks, delay):
+        self.read_blocks = read_blocks
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.calls = 0
+
+    def __call__(self, io):
+        with self.lock:
+            self.running += 1
+            self.calls += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            return self.read_blocks(io)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+def test_slow_loads_do_not_block_event_loop(write_cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "EXECUTOR_MAX_WORKERS", 2)
+    monkeypatch.setattr(concurrency, "_executor", None)
+    reader = SlowReader(data_handler.read_blocks, delay=0.3)
+    monkeypatch.setattr(data_handler, "read_blocks", reader)
+    urls = [f"https://example.invalid/data/file{i}.pkl" for i in range(4)]
+    block = neo.Block()
+    block.segments.append(neo.Segment())
+    for url in urls:
+        write_cached_file(url, block)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            loads = [
+                asyncio.create_task(client.get("/api/blockdata/", params={"url": url, "type": "PickleIO"}))
+                for url in urls
+            ]
+            await asyncio.sleep(0.1)
+            # requests which do not need the executor are answered while the files are being read
+            start = time.monotonic()
+            info = await client.get("/api/")
+            info_time = time.monotonic() - start
+            responses = await asyncio.gather(*loads)
+        return info, info_time, responses
+
+    try:
+        start = time.monotonic()
+        info, info_time, responses = asyncio.run(run())
+        total_time = time.monotonic() - start
+    finally:
+        concurrency.shutdown()
+    assert info.status_code == 200
+    assert info_time < 0.2
+    assert all(response.status_code == 200 for response in responses)
+    # at most EXECUTOR_MAX_WORKERS files are read at once, so four reads take two rounds
+    assert reader.max_running == 2
+    assert total_time >= 0.6
+
+
+def test_requests_for_one_file_do_not_hold_workers(write_cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "EXECUTOR_MAX_WORKERS", 2)
+    monkeypatch.setattr(concurrency, "_executor", None)
+    reader = SlowReader(data_handler.read_blocks, delay=0.5)
+    monkeypatch.setattr(data_handler, "read_blocks", reader)
+    popular_url = "https://example.invalid/data/popular.pkl"
+    other_url = "https://example.invalid/data/other.pkl"
+    block = neo.Block()
+    block.segments.append(neo.Segment())
+    for url in (popular_url, other_url):
+        write_cached_file(url, block)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            loads = [
+                asyncio.create_task(
+                    client.get("/api/segmentdata/", params={"url": popular_url, "type": "PickleIO", "segment_id": 0})
+                )
+                for i in range(6)
+            ]
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            other = await client.get("/api/segmentdata/", params={"url": other_url, "type": "PickleIO", "segment_id": 0})
+            other_time = time.monotonic() - start
+            responses = await asyncio.gather(*loads)
+        return other, other_time, responses
+
+    try:
+        other, other_time, responses = asyncio.run(run())
+    finally:
+        concurrency.shutdown()
+    assert other.status_code == 200
+    assert all(response.status_code == 200 for response in responses)
+    # the popular file is read once, by one worker, leaving the other free for the other file
+    assert reader.calls == 2
+    assert other_time < 0.8
@@ -2,17 +2,35 @@
 
 """
 
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import os.path
 import shutil
 import tempfile
+import threading
+import time
+from datetime import datetime
 from urllib.request import urlretrieve
+import neo
+import numpy as np
+import pytest
+import quantities as pq
 from neo.io import BrainVisionIO
+from pydantic import HttpUrl
 from ..data_handler import (
     get_base_url_and_path,
     get_cache_path,
     list_files_to_download,
     get_archive_dir,
+    IOCache,
+    get_resolved_url_record_path,
+    resolve_url,
+    download_neo_data,
+    load_block_structure,
 )
+from ..data_models import BlockContainer, IOModule
+from ..disk_cache import disk_cache
+from .. import settings, data_handler
 
 
 def test_get_base_url_and_path():
@@ -64,3 +82,268 @@ def test_download_neo_data_zip():
     main_path = get_archive_dir(archive_path, cache_dir)
     assert main_path == os.path.join(cache_dir, "original_data")
     shutil.rmtree(cache_dir)
+
+
+class MockIO:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def _add_to_cache(io_cache, key, size):
+    entry = io_cache.checkout(key)
+    entry.io = MockIO()
+    entry.blocks = []
+    entry.size = size
+    io_cache.checkin(entry)
+    return entry
+
+
+def test_io_cache_lru_eviction():
+    io_cache = IOCache(max_entries=2, max_bytes=1000)
+    entry_a = _add_to_cache(io_cache, "a", 10)
+    _add_to_cache(io_cache, "b", 10)
+    # using "a" makes "b" the least recently used entry
+    io_cache.checkin(io_cache.checkout("a"))
+    entry_c = _add_to_cache(io_cache, "c", 10)
+    assert "b" not in io_cache
+    assert "a" in io_cache and "c" in io_cache
+    assert not entry_a.io.closed
+
+    # exceeding the byte budget evicts older entries, and closes their IOs
+    entry_a_io = entry_a.io
+    _add_to_cache(io_cache, "d", 995)
+    assert list(io_cache._entries) == ["d"]
+    assert entry_a_io.closed
+    assert entry_c.io is None
+
+
+def test_io_cache_entries_in_use_not_evicted():
+    io_cache = IOCache(max_entries=1, max_bytes=1000)
+    entry_a = io_cache.checkout("a")
+    entry_a.io = MockIO()
+    entry_a.blocks = []
+    _add_to_cache(io_cache, "b", 10)
+    assert "a" in io_cache
+    io_cache.checkin(entry_a)
+    _add_to_cache(io_cache, "c", 10)
+    assert "a" not in io_cache
+
+
+def test_io_cache_failed_open_not_kept():
+    io_cache = IOCache(max_entries=2, max_bytes=1000)
+    io_cache.checkin(io_cache.checkout("a"))
+    assert len(io_cache) == 0
+
+
+def test_io_cache_entry_discarded_in_use_is_closed_on_checkin():
+    io_cache = IOCache(max_entries=2, max_bytes=1000)
+    entry_a = io_cache.checkout("a")
+    entry_a.io = io = MockIO()
+    entry_a.blocks = []
+    io_cache.discard("a")
+    assert "a" not in io_cache
+    assert not io.closed
+    # a new entry for the same key is independent of the old one
+    entry_new = _add_to_cache(io_cache, "a", 10)
+    io_cache.checkin(entry_a)
+    assert io.closed
+    assert io_cache._entries["a"] is entry_new and not entry_new.io.closed
+
+
+def test_resolve_url_uses_cached_record(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    # the ".invalid" top-level domain can never be reached,
+    # so this checks that the network is not used
+    url = "https://example.invalid/data/File_axon_1.abf"
+    resolved_url = "https://mirror.example.invalid/data/File_axon_1.abf"
+    record_path = get_resolved_url_record_path(url)
+    os.makedirs(os.path.dirname(record_path))
+    with open(record_path, "w") as fp:
+        json.dump({"url": url, "resolved_url": resolved_url, "resolved_at": time.time()}, fp)
+    assert resolve_url(url) == resolved_url
+
+    # an expired record is used if the server cannot be reached
+    with open(record_path, "w") as fp:
+        json.dump({"url": url, "resolved_url": resolved_url, "resolved_at": 0}, fp)
+    assert resolve_url(url) == resolved_url
+
+
+def test_concurrent_downloads_of_same_file_are_deduplicated(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: url)
+    calls = []
+
+    def fake_download_files(files):
+        calls.append(files)
+        time.sleep(0.2)
+        for url, path, required in files:
+            with open(path, "w") as fp:
+                fp.write("data")
+        return [None] * len(files)
+
+    monkeypatch.setattr(data_handler, "download_files", fake_download_files)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(download_neo_data("https://example.invalid/data/file.abf"))
+        )
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert len(set(results)) == 1 and len(results) == 4
+
+
+def test_companion_files_are_in_disk_cache_entry(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_AGE", -1)
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: url)
+
+    def fake_download_files(files):
+        for url, path, required in files:
+            with open(path, "w") as fp:
+                fp.write("data")
+        return [None] * len(files)
+
+    monkeypatch.setattr(data_handler, "download_files", fake_download_files)
+    url = "https://example.invalid/data/recording.vhdr"
+    main_path = download_neo_data(url, io_cls=BrainVisionIO)
+    expected = {
+        os.path.join(os.path.dirname(main_path), f"recording.{extension}")
+        for extension in ("vhdr", "eeg", "vmrk")
+    }
+    assert expected <= set(disk_cache.get_files(main_path))
+    # files downloaded before the entry was recorded, e.g. if the index was deleted
+    disk_cache._connection().execute("DELETE FROM entries")
+    assert download_neo_data(url, io_cls=BrainVisionIO) == main_path
+    assert expected <= set(disk_cache.get_files(main_path))
+
+
+class VersionedFileHandler(BaseHTTPRequestHandler):
+    content = b"version 1"
+    etag = '"v1"'
+    requests = []
+
+    def do_HEAD(self):
+        self.send_headers(200, len(self.content))
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("If-None-Match"))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_headers(304, 0)
+        else:
+            self.send_headers(200, len(self.content))
+            self.wfile.write(self.content)
+
+    def send_headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cached_file_is_revalidated(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_AGE", 0)
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: url)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), VersionedFileHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_port}/data/file.abf"
+    try:
+        path = download_neo_data(url)
+        with open(f"{path}.pyramid", "w") as fp:
+            fp.write("derived")
+        # unchanged: the cached file and derived files are kept
+        assert download_neo_data(url) == path
+        assert VersionedFileHandler.requests == [None, '"v1"']
+        assert os.path.exists(f"{path}.pyramid")
+
+        VersionedFileHandler.content = b"version 2"
+        VersionedFileHandler.etag = '"v2"'
+        assert download_neo_data(url) == path
+        with open(path, "rb") as fp:
+            assert fp.read() == b"version 2"
+        assert not os.path.exists(f"{path}.pyramid")
+    finally:
+        httpd.shutdown()
+
+
+def test_changed_file_in_use_is_replaced(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_AGE", 0)
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: url)
+    VersionedFileHandler.content = b"version 1"
+    VersionedFileHandler.etag = '"v1"'
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), VersionedFileHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_port}/data/file.abf"
+    try:
+        path = download_neo_data(url)
+        pin = disk_cache.pin(path)
+        fp = open(path, "rb")
+        VersionedFileHandler.content = b"version 2"
+        VersionedFileHandler.etag = '"v2"'
+        # the new version is downloaded beside the old one, which remains readable
+        assert download_neo_data(url) == path
+        with open(path, "rb") as new_fp:
+            assert new_fp.read() == b"version 2"
+        assert fp.read() == b"version 1"
+        assert data_handler.read_record(data_handler.get_validators_path(path))["validators"]["ETag"] == '"v2"'
+        # the new version can be pinned while the old one is in use
+        disk_cache.pin(path).close()
+        fp.close()
+        disk_cache.enforce_budget()
+        assert any(name.startswith(".retired-") for name in os.listdir(os.path.dirname(path)))
+        pin.close()
+        disk_cache.enforce_budget()
+        assert not any(name.startswith(".retired-") for name in os.listdir(os.path.dirname(path)))
+        with open(path, "rb") as new_fp:
+            assert new_fp.read() == b"version 2"
+    finally:
+        httpd.shutdown()
+
+
+
+def make_nix_block():
+    block = neo.Block(name="session", description="test", rec_datetime=datetime(2020, 1, 2, 3, 4, 5), rat="R1")
+    for i in range(2):
+        segment = neo.Segment(name=f"trial {i}", description=f"trial {i}", trial=i)
+        segment.analogsignals.append(
+            neo.AnalogSignal(np.zeros((100, 3)), units="mV", sampling_rate=1 * pq.kHz, name="Vm")
+        )
+        segment.analogsignals.append(neo.AnalogSignal(np.zeros((50, 3)), units="nA", sampling_rate=2 * pq.kHz))
+        segment.irregularlysampledsignals.append(
+            neo.IrregularlySampledSignal([0.1, 0.3], np.zeros((2, 1)), units="mV", time_units="s")
+        )
+        segment.spiketrains.append(neo.SpikeTrain([1, 2] * pq.s, t_stop=10 * pq.s))
+        block.segments.append(segment)
+    return block
+
+
+def test_nix_structure_is_read_without_data(offline_cache, monkeypatch):
+    nixio = pytest.importorskip("nixio")
+    url = "https://example.invalid/data/session.nix"
+    cache_dir, main_file = get_cache_path(url)
+    path = os.path.join(cache_dir, main_file)
+    with neo.io.NixIO(path, "ow") as io:
+        io.write_block(make_nix_block())
+    with neo.io.NixIO(path, "ro") as io:
+        expected = BlockContainer.from_neo(io.read_all_blocks(), HttpUrl(url))
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data should not be read")
+
+    for name in ("__getitem__", "read_direct", "__array__"):
+        monkeypatch.setattr(nixio.DataArray, name, fail, raising=False)
+    for io_class_name in (IOModule.NixIO, None):
+        blocks = load_block_structure(url, io_class_name)
+        assert BlockContainer.from_neo(blocks, HttpUrl(url)) == expected
+    assert load_block_structure(url, IOModule.PickleIO) is None
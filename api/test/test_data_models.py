@@ -0,0 +1,156 @@
+"""
+
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+from fastapi.encoders import jsonable_encoder
+import numpy as np
+import quantities as pq
+import neo
+import pytest
+from .. import data_models
+from ..data_models import parse_channel_selection, reduce_precision, AnalogSignal, Segment, dump_json
+
+
+def test_parse_channel_selection():
+    assert parse_channel_selection("3", 8) == [3]
+    assert parse_channel_selection("0,3,5-7", 8) == [0, 3, 5, 6, 7]
+    with pytest.raises(ValueError, match="out of range"):
+        parse_channel_selection("5-8", 8)
+    with pytest.raises(ValueError, match="Invalid channel selection"):
+        parse_channel_selection("0;1", 8)
+
+
+def test_dump_json_matches_validated_model():
+    data = {
+        "t_start": np.array(0.0),
+        "t_stop": np.float64(0.004),
+        "sampling_period": 0.001,
+        "name": "signal",
+        "times_dimensionality": "s",
+        "values_units": "mV",
+        "values": np.array([[0.5, -1.0], [1.25, 2.0], [3.0, 4.0], [-65.125, 0.0]]),
+    }
+    validated = AnalogSignal(
+        **dict(data, t_start=0.0, t_stop=0.004, values=data["values"].T.tolist())
+    )
+    fast = AnalogSignal.from_data(data)
+    assert json.loads(dump_json(fast)) == json.loads(validated.model_dump_json())
+    # single channel
+    single_channel = dict(data, values=data["values"][:, :1])
+    assert json.loads(dump_json(AnalogSignal.from_data(single_channel)))["values"] == [
+        0.5, 1.25, 3.0, -65.125
+    ]
+
+
+def test_dump_json_big_endian_arrays():
+    values = np.arange(3, dtype=">f4")
+    assert json.loads(dump_json(values)) == [0.0, 1.0, 2.0]
+    assert json.loads(dump_json({"values": np.arange(3, dtype=">i2")})) == {"values": [0, 1, 2]}
+    data = {
+        "t_start": 0.0,
+        "t_stop": 0.003,
+        "sampling_period": 0.001,
+        "name": "signal",
+        "times_dimensionality": "s",
+        "values_units": "mV",
+        "values": np.arange(6, dtype=">f4").reshape(3, 2),
+    }
+    assert json.loads(dump_json(AnalogSignal.from_data(data)))["values"] == [[0.0, 2.0, 4.0], [1.0, 3.0, 5.0]]
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_dump_json_datetimes(use_orjson, monkeypatch):
+    if not use_orjson:
+        monkeypatch.setattr(data_models, "orjson", None)
+    for rec_datetime in (
+        datetime(2023, 5, 4, 12, 30, 15, 250, tzinfo=timezone.utc),
+        datetime(2023, 5, 4, 12, 30, 15, tzinfo=timezone(timedelta(hours=2))),
+        datetime(2023, 5, 4, 12, 30, 15),
+    ):
+        segment = Segment.from_neo(
+            neo.Segment(rec_datetime=rec_datetime), "https://example.com/data.nwb", metadata_only=True
+        )
+        # as encoded by FastAPI
+        assert json.loads(dump_json(segment)) == jsonable_encoder(segment)
+
+
+def test_reduce_precision():
+    values = np.array([[-65.123456, 0.0], [1234567.0, 0.000123456], [1e-320, np.pi]])
+    rounded = reduce_precision(values, precision=3)
+    assert rounded.dtype == np.float64
+    assert json.loads(dump_json(rounded.tolist())) == [
+        [-65.1, 0.0], [1230000.0, 0.000123], [1e-320, 3.14]
+    ]
+    as_float32 = reduce_precision(values.astype(np.float32), dtype="float32", precision=4)
+    assert as_float32.dtype == np.float32
+    assert as_float32[0, 0] == np.float32(-65.12)
+    assert reduce_precision(np.array([1, 2], dtype=np.int16), dtype="float64").dtype == np.float64
+
+
+def test_get_time_slice():
+    signal = neo.AnalogSignal(
+        np.zeros((1000, 1)), units="mV", sampling_rate=1 * pq.kHz, t_start=0.5 * pq.s
+    )
+    assert AnalogSignal.get_time_slice(signal) is None
+    t_start, t_stop = AnalogSignal.get_time_slice(signal, 0.7, 0.9)
+    assert (t_start, t_stop) == (0.7 * pq.s, 0.9 * pq.s)
+    # the window is clipped to the extent of the signal
+    t_start, t_stop = AnalogSignal.get_time_slice(signal, 0.0, 10.0)
+    assert (t_start, t_stop) == (0.5 * pq.s, 1.5 * pq.s)
+    t_start, t_stop = AnalogSignal.get_time_slice(signal, t_stop=1.0)
+    assert (t_start, t_stop) == (0.5 * pq.s, 1.0 * pq.s)
+    with pytest.raises(ValueError, match="t_start must be less than t_stop"):
+        AnalogSignal.get_time_slice(signal, 1.0, 0.8)
+    with pytest.raises(ValueError, match="t_start must be less than t_stop"):
+        AnalogSignal.get_time_slice(signal, 1.0, 1.0)
+    with pytest.raises(ValueError, match="does not overlap"):
+        AnalogSignal.get_time_slice(signal, 2.0, 3.0)
+
+
+def test_data_from_neo_time_window():
+    signal = neo.AnalogSignal(
+        np.arange(1000.0).reshape(1000, 1), units="mV", sampling_rate=1 * pq.kHz, t_start=0.5 * pq.s
+    )
+    data = AnalogSignal.data_from_neo(signal, None, t_start=0.7, t_stop=0.75)
+    assert data["t_start"] == pytest.approx(0.7)
+    assert data["t_stop"] == pytest.approx(0.75)
+    assert data["values"][:, 0].tolist() == list(np.arange(200.0, 250.0))
+    data = AnalogSignal.data_from_neo(signal, None, t_start=1.49, t_stop=5.0)
+    assert data["t_stop"] == pytest.approx(1.5)
+    assert data["values"].shape == (10, 1)
+
+
+def test_sampling_period_in_units_of_t_start():
+    # the sampling period is 1 (1/kHz), while times are in seconds
+    signal = neo.AnalogSignal(
+        np.arange(1000.0).reshape(500, 2), units="mV", sampling_rate=1 * pq.kHz, t_start=0.5 * pq.s
+    )
+    assert signal.sampling_period.magnitude == 1.0
+    full = AnalogSignal.data_from_neo(signal, None)
+    assert full["times_dimensionality"] == "s"
+    assert full["sampling_period"] == pytest.approx(0.001)
+    assert AnalogSignal.data_from_neo(signal, 5)["sampling_period"] == pytest.approx(0.005)
+    metadata, n_channels, read_chunks = AnalogSignal.chunks_from_neo(signal, 5)
+    assert metadata["sampling_period"] == pytest.approx(0.005)
+    # when reduced with max_points, each pair of points covers 10 samples
+    reduced = AnalogSignal.data_from_neo(signal, None, max_points=100)
+    assert reduced["sampling_period"] == pytest.approx(0.005)
+    metadata, n_channels, read_chunks = AnalogSignal.chunks_from_neo(signal, None, max_points=100)
+    assert metadata["sampling_period"] == pytest.approx(0.005)
+    for data in (full, reduced):
+        n_points = data["values"].shape[0]
+        assert data["t_start"] + n_points * data["sampling_period"] == pytest.approx(data["t_stop"])
+
+
+def test_max_points():
+    signal = neo.AnalogSignal(np.arange(200.0).reshape(100, 2), units="mV", sampling_rate=1 * pq.kHz)
+    assert AnalogSignal.data_from_neo(signal, None, max_points=41)["values"].shape == (40, 2)
+    assert AnalogSignal.data_from_neo(signal, None, max_points=2)["values"].shape == (2, 2)
+    for max_points in (0, 1):
+        with pytest.raises(ValueError, match="max_points must be at least 2"):
+            AnalogSignal.data_from_neo(signal, None, max_points=max_points)
+        with pytest.raises(ValueError, match="max_points must be at least 2"):
+            AnalogSignal.chunks_from_neo(signal, None, max_points=max_points)
+
@@ -0,0 +1,94 @@
+"""
+
+"""
+
+import numpy as np
+import neo
+import pytest
+import quantities as pq
+from .. import settings
+from ..data_models import AnalogSignal
+from ..decimation import MinMaxAccumulator, min_max_decimate
+from ..pyramid import MinMaxPyramid
+
+
+def test_min_max_accumulator_chunks():
+    rng = np.random.default_rng(seed=42)
+    data = rng.normal(size=(1000, 3))
+    expected = MinMaxAccumulator(bucket_size=30)
+    expected.add(data, 0)
+    # chunk boundaries that don't match the bucket boundaries
+    accumulator = MinMaxAccumulator(bucket_size=30)
+    for start in range(0, 1000, 47):
+        accumulator.add(data[start:start + 47], start)
+    mins, maxs = accumulator.min_max()
+    assert mins.shape == (34, 3)
+    assert np.array_equal(mins[0], data[:30].min(axis=0))
+    assert np.array_equal(maxs[-1], data[990:].max(axis=0))
+    assert np.array_equal(accumulator.envelope(), expected.envelope())
+
+
+def test_min_max_envelope_order():
+    data = np.array([[0.0], [5.0], [-5.0], [0.0], [-3.0], [4.0]])
+    accumulator = MinMaxAccumulator(bucket_size=3)
+    accumulator.add(data, 0)
+    assert accumulator.envelope()[:, 0].tolist() == [5.0, -5.0, -3.0, 4.0]
+
+
+def test_min_max_decimate(monkeypatch):
+    monkeypatch.setattr(settings, "SIGNAL_CHUNK_VALUES", 100)
+    signal = neo.AnalogSignal(
+        np.sin(np.arange(2000) / 10.0).reshape(1000, 2), units="mV", sampling_rate=1 * pq.kHz
+    )
+    values, bucket_size = min_max_decimate(signal, 100, 900, max_points=40)
+    assert bucket_size == 40
+    assert values.shape == (40, 2)
+    assert values.max() == signal.magnitude[100:900].max()
+
+
+def test_min_max_pyramid(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "SIGNAL_CHUNK_VALUES", 1000)
+    monkeypatch.setattr(settings, "PYRAMID_BASE_BUCKET_SIZE", 4)
+    monkeypatch.setattr(settings, "PYRAMID_FACTOR", 2)
+    monkeypatch.setattr(settings, "PYRAMID_TILE_SIZE", 100)
+    rng = np.random.default_rng(seed=42)
+    signal = neo.AnalogSignal(rng.normal(size=(3000, 2)), units="mV", sampling_rate=1 * pq.kHz)
+    pyramid = MinMaxPyramid.load_or_build(signal, str(tmp_path / "pyramid"))
+    # 3000 samples -> 1500 points -> 750 -> 376 -> 188 -> 94
+    assert pyramid.n_levels == 6
+    assert [pyramid.n_points(level) for level in range(6)] == [3000, 1500, 750, 376, 188, 94]
+
+    values, t_start = pyramid.get_tile(signal, 2, 1)
+    expected = MinMaxAccumulator(bucket_size=8)
+    expected.add(signal.magnitude, 0)
+    assert np.array_equal(values, expected.envelope()[100:200])
+    assert t_start == 100 * 0.004
+
+    values, t_start = pyramid.get_tile(signal, 5, 0)
+    assert values.shape == (94, 2)
+    assert np.array_equal(values.max(axis=0), signal.magnitude.max(axis=0))
+
+
+def test_pyramid_tile_times(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "PYRAMID_BASE_BUCKET_SIZE", 4)
+    monkeypatch.setattr(settings, "PYRAMID_FACTOR", 2)
+    monkeypatch.setattr(settings, "PYRAMID_TILE_SIZE", 100)
+    # the sampling period is in 1/kHz, t_start in seconds
+    signal = neo.AnalogSignal(
+        np.arange(3000.0).reshape(1500, 2), units="mV", sampling_rate=1 * pq.kHz, t_start=0.5 * pq.s
+    )
+    pyramid = MinMaxPyramid.load_or_build(signal, str(tmp_path / "pyramid"))
+    full = AnalogSignal.data_from_neo(signal, None)
+    values, t_start = pyramid.get_tile(signal, 0, 1)
+    tile = AnalogSignal.data_from_pyramid_tile(pyramid, 0, values, t_start)
+    # tiles use the same time units as the other endpoints
+    assert tile["times_dimensionality"] == full["times_dimensionality"] == "s"
+    assert tile["sampling_period"] == full["sampling_period"] == 0.001
+    assert tile["t_start"] == pytest.approx(0.6)
+    # each pair of points in level 2 covers 8 samples, as for min/max reduction of the whole signal
+    reduced = AnalogSignal.data_from_neo(signal, None, max_points=376)
+    values, t_start = pyramid.get_tile(signal, 2, 0)
+    tile = AnalogSignal.data_from_pyramid_tile(pyramid, 2, values, t_start)
+    assert tile["sampling_period"] == reduced["sampling_period"] == pytest.approx(0.004)
+    assert tile["t_start"] == reduced["t_start"] == 0.5
+    assert np.array_equal(tile["values"], reduced["values"][:100])
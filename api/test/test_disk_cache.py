@@ -0,0 +1,62 @@
+"""
+
+"""
+
+import os
+import time
+from .. import settings
+from ..disk_cache import DiskCache
+
+
+def add_entry(cache, root, name, size, files=None):
+    path = os.path.join(root, "abc", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fp:
+        fp.write(b"x" * size)
+    cache.record_access(path, files or [path], new=True)
+    time.sleep(0.01)
+    return path
+
+
+def test_lru_eviction(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_BYTES", 3000)
+    cache = DiskCache()
+    first = add_entry(cache, tmp_path, "first.dat", 1000)
+    second = add_entry(cache, tmp_path, "second.dat", 1000)
+    third = add_entry(cache, tmp_path, "third.dat", 1000)
+    assert cache.total_size() == 3000
+    # accessing the first entry makes the second the least recently used
+    cache.record_access(first, [first])
+    time.sleep(0.01)
+    fourth = add_entry(cache, tmp_path, "fourth.dat", 1000)
+    assert not os.path.exists(second)
+    assert all(os.path.exists(path) for path in (first, third, fourth))
+    assert cache.total_size() == 3000
+
+
+def test_pinned_entries_are_not_evicted(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "DOWNLOAD_CACHE_MAX_BYTES", 1500)
+    cache = DiskCache()
+    first = add_entry(cache, tmp_path, "first.dat", 1000)
+    pin = cache.pin(first)
+    second = add_entry(cache, tmp_path, "second.dat", 1000)
+    assert os.path.exists(first) and os.path.exists(second)
+    pin.close()
+    add_entry(cache, tmp_path, "third.dat", 100)
+    assert not os.path.exists(first)
+
+
+def test_derived_files_are_counted_and_evicted(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    cache = DiskCache()
+    first = add_entry(cache, tmp_path, "first.dat", 1000)
+    os.makedirs(f"{first}.pyramid/auto")
+    with open(f"{first}.pyramid/auto/level1.npy", "wb") as fp:
+        fp.write(b"x" * 500)
+    cache.update_size(first)
+    assert cache.total_size() == 1500
+    assert cache.evict(first, [first])
+    assert not os.path.exists(f"{first}.pyramid")
+    assert cache.total_size() == 0
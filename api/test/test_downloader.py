@@ -0,0 +1,195 @@
+"""
+
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gzip
+import json
+import os
+import re
+import threading
+import httpx
+import pytest
+from .. import settings
+from ..downloader import download_file, download_files, get_partial_paths, split_into_segments
+
+
+CONTENT = os.urandom(100_000)
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    supports_ranges = True
+    requests = []
+    etag = '"v1"'
+    # if set, the connection is closed after sending this many bytes, to simulate a failure
+    fail_after = None
+    # if set, the whole file is sent compressed to clients which accept gzip encoding
+    compress = False
+
+    def accepts_gzip(self):
+        return self.compress and "gzip" in self.headers.get("Accept-Encoding", "")
+
+    def do_HEAD(self):
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+        elif self.accepts_gzip():
+            self.send_headers(200, len(gzip.compress(CONTENT)), {"Content-Encoding": "gzip"})
+        else:
+            self.send_headers(200, len(CONTENT))
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("Range"))
+        if self.path.startswith("/missing"):
+            self.send_error(404)
+            return
+        if self.accepts_gzip():
+            body = gzip.compress(CONTENT)
+            self.send_headers(200, len(body), {"Content-Encoding": "gzip"})
+            self.send_body(body)
+            return
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if_range = self.headers.get("If-Range")
+        if match and self.supports_ranges and if_range in (None, self.etag):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(CONTENT) - 1
+            self.send_headers(206, end + 1 - start)
+            self.send_body(CONTENT[start:end + 1])
+        else:
+            self.send_headers(200, len(CONTENT))
+            self.send_body(CONTENT)
+
+    def send_headers(self, status, length, extra_headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.etag)
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def send_body(self, body):
+        if self.fail_after is not None:
+            self.wfile.write(body[:self.fail_after])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    RangeRequestHandler.requests = []
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    RangeRequestHandler.supports_ranges = True
+    RangeRequestHandler.etag = '"v1"'
+    RangeRequestHandler.fail_after = None
+    RangeRequestHandler.compress = False
+
+
+def test_split_into_segments():
+    assert split_into_segments(10, 4) == [(0, 3), (4, 7), (8, 9)]
+    assert split_into_segments(8, 4) == [(0, 3), (4, 7)]
+
+
+def test_download_in_segments(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 30_000)
+    path = tmp_path / "data.bin"
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+    assert sorted(RangeRequestHandler.requests) == [
+        "bytes=0-29999", "bytes=30000-59999", "bytes=60000-89999", "bytes=90000-99999"
+    ]
+
+
+def test_download_falls_back_to_single_stream(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 30_000)
+    RangeRequestHandler.supports_ranges = False
+    path = tmp_path / "data.bin"
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+    assert RangeRequestHandler.requests[-1] is None
+
+
+def test_download_from_compressing_server(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 30_000)
+    RangeRequestHandler.compress = True
+    path = tmp_path / "data.bin"
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+
+
+def test_download_files(server, tmp_path):
+    errors = download_files([
+        (f"{server}/data.bin", str(tmp_path / "data.bin"), True),
+        (f"{server}/missing.txt", str(tmp_path / "missing.txt"), False),
+    ])
+    assert errors[0] is None
+    assert isinstance(errors[1], httpx.HTTPStatusError)
+    assert (tmp_path / "data.bin").read_bytes() == CONTENT
+    assert not (tmp_path / "missing.txt").exists()
+    # the missing file was detected by the HEAD request
+    assert RangeRequestHandler.requests == [None]
+
+
+def test_download_files_with_missing_required_file(server, tmp_path):
+    errors = download_files([
+        (f"{server}/data.bin", str(tmp_path / "data.bin"), True),
+        (f"{server}/missing.txt", str(tmp_path / "missing.txt"), True),
+    ])
+    assert errors[0] is None
+    assert isinstance(errors[1], httpx.HTTPStatusError)
+    # an incomplete dataset is not moved into place, but the download can be reused
+    assert not (tmp_path / "data.bin").exists()
+    partial_path, record_path = get_partial_paths(str(tmp_path / "data.bin"))
+    assert os.path.getsize(partial_path) == len(CONTENT)
+
+
+def test_interrupted_download_is_resumed(server, tmp_path):
+    path = tmp_path / "data.bin"
+    RangeRequestHandler.fail_after = 40_000
+    with pytest.raises(httpx.TransportError):
+        download_file(f"{server}/data.bin", str(path))
+    assert not path.exists()
+    partial_path, record_path = get_partial_paths(str(path))
+    assert os.path.getsize(partial_path) == 40_000
+
+    RangeRequestHandler.fail_after = None
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+    assert RangeRequestHandler.requests[-1] == "bytes=40000-"
+    assert not os.path.exists(partial_path)
+    assert not os.path.exists(record_path)
+
+
+def test_interrupted_segmented_download_is_resumed(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "DOWNLOAD_SEGMENT_SIZE", 30_000)
+    path = tmp_path / "data.bin"
+    RangeRequestHandler.fail_after = 20_000
+    with pytest.raises(httpx.TransportError):
+        download_file(f"{server}/data.bin", str(path))
+    partial_path, record_path = get_partial_paths(str(path))
+    with open(record_path) as fp:
+        completed = [f"bytes={start}-{end}" for start, end in json.load(fp)["segments"]]
+    RangeRequestHandler.fail_after = None
+    RangeRequestHandler.requests = []
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+    assert not set(completed) & set(RangeRequestHandler.requests)
+
+
+def test_download_restarts_if_file_changed(server, tmp_path):
+    path = tmp_path / "data.bin"
+    RangeRequestHandler.fail_after = 40_000
+    with pytest.raises(httpx.TransportError):
+        download_file(f"{server}/data.bin", str(path))
+    RangeRequestHandler.fail_after = None
+    RangeRequestHandler.etag = '"v2"'
+    download_file(f"{server}/data.bin", str(path))
+    assert path.read_bytes() == CONTENT
+    assert RangeRequestHandler.requests[-1] is None
@@ -0,0 +1,71 @@
+"""
+
+"""
+
+import io
+import json
+import struct
+import numpy as np
+from ..formats import (
+    ResponseFormat,
+    negotiate_format,
+    encode_binary,
+    signal_response,
+    spike_trains_response,
+    METADATA_HEADER,
+    NPZ_MEDIA_TYPE,
+    NPZ_METADATA_NAME,
+)
+
+
+def test_negotiate_format():
+    assert negotiate_format() == ResponseFormat.json
+    assert negotiate_format("npy", "application/json") == ResponseFormat.npy
+    assert negotiate_format(None, "text/html,*/*;q=0.8") == ResponseFormat.json
+    assert negotiate_format(None, "application/octet-stream") == ResponseFormat.binary
+    assert (
+        negotiate_format(None, "application/json;q=0.5, application/vnd.apache.arrow.stream")
+        == ResponseFormat.arrow
+    )
+
+
+def test_encode_binary():
+    values = np.arange(12, dtype=np.float32).reshape(3, 4)
+    times = np.linspace(0, 1, 5)
+    content = encode_binary({"name": "sig", "t_start": np.float64(0.5)}, {"values": values, "times": times})
+    header_length = struct.unpack("<I", content[:4])[0]
+    assert (4 + header_length) % 8 == 0
+    header = json.loads(content[4:4 + header_length])
+    assert header["name"] == "sig"
+    assert header["t_start"] == 0.5
+    body = content[4 + header_length:]
+    for description, expected in zip(header["arrays"], (values, times)):
+        start = description["offset"]
+        array = np.frombuffer(
+            body[start:start + description["nbytes"]], dtype=description["dtype"]
+        ).reshape(description["shape"])
+        assert np.array_equal(array, expected)
+
+
+def test_npy_irregular_signal_times_in_body():
+    times = np.linspace(0, 10, 10000)
+    data = {"name": "sig", "values_units": "mV", "values": np.ones((10000, 1)), "times": times}
+    response = signal_response(data, ResponseFormat.npy)
+    assert response.media_type == NPZ_MEDIA_TYPE
+    # the header only contains the scalar metadata
+    assert json.loads(response.headers[METADATA_HEADER]) == {"name": "sig", "values_units": "mV"}
+    arrays = np.load(io.BytesIO(response.body))
+    assert arrays["values"].shape == (1, 10000)
+    np.testing.assert_array_equal(arrays["times"], times)
+
+
+def test_npz_spike_trains_metadata_in_body():
+    spike_trains = {
+        str(i): {"units": "s", "t_stop": np.float64(10.0), "times": np.arange(3.0)} for i in range(500)
+    }
+    response = spike_trains_response(spike_trains, ResponseFormat.npy)
+    assert METADATA_HEADER not in response.headers
+    arrays = np.load(io.BytesIO(response.body))
+    metadata = json.loads(arrays[NPZ_METADATA_NAME].tobytes())
+    assert metadata["499"] == {"units": "s", "t_stop": 10.0}
+    np.testing.assert_array_equal(arrays["499"], np.arange(3.0))
@@ -0,0 +1,296 @@
+"""
+
+"""
+
+import asyncio
+import os
+import threading
+import time
+import quantities as pq
+import neo
+import pytest
+from fastapi.testclient import TestClient
+from ..main import app
+from ..formats import METADATA_HEADER
+from ..disk_cache import disk_cache
+from ..http_caching import find_matching_etag
+from ..response_cache import ResponseCache, response_cache
+from ..resources import v1
+from .. import settings, prefetch
+
+
+URL = "https://example.invalid/data/file.pkl"
+
+test_client = TestClient(app)
+
+
+@pytest.fixture
+def cached_file(write_cached_file):
+    block = neo.Block()
+    segment = neo.Segment()
+    segment.analogsignals.append(neo.AnalogSignal([[1.0], [2.0], [3.0]], units="mV", sampling_rate=1 * pq.kHz))
+    block.segments.append(segment)
+    return write_cached_file(URL, block)
+
+
+def test_find_matching_etag():
+    assert find_matching_etag(None, '"abc"') is None
+    assert find_matching_etag('"abc"', '"abc"') == '"abc"'
+    assert find_matching_etag('"xyz", W/"abc"', '"abc"') == '"abc"'
+    assert find_matching_etag('"abc-gzip"', '"abc"') == '"abc-gzip"'
+    assert find_matching_etag('"abcd"', '"abc"') is None
+    assert find_matching_etag("*", '"abc"') == '"abc"'
+
+
+def test_conditional_request_is_answered_without_opening_file(cached_file, monkeypatch):
+    params = {"url": URL, "type": "PickleIO", "segment_id": 0, "analog_signal_id": 0}
+    response = test_client.get("/api/analogsignaldata/", params=params)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == settings.RESPONSE_CACHE_CONTROL
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data file should not be opened")
+
+    open_blocks = v1.open_blocks
+    monkeypatch.setattr(v1, "open_blocks", fail)
+    response = test_client.get("/api/analogsignaldata/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+    # different parameters give a different ETag
+    monkeypatch.setattr(v1, "open_blocks", open_blocks)
+    response = test_client.get("/api/analogsignaldata/", params=dict(params, down_sample_factor=2))
+    assert response.headers["ETag"] != etag
+
+
+def test_negotiated_responses_vary_on_accept(cached_file):
+    params = {"url": URL, "type": "PickleIO", "segment_id": 0, "analog_signal_id": 0}
+    for headers in ({"Accept": "application/x-npy"}, {"Accept": "application/json"}):
+        response = test_client.get("/api/analogsignaldata/", params=params, headers=headers)
+        assert response.status_code == 200
+        assert response.headers["Vary"] == "Accept, Accept-Encoding"
+        response = test_client.get(
+            "/api/analogsignaldata/", params=params, headers=dict(headers, **{"If-None-Match": response.headers["ETag"]})
+        )
+        assert response.status_code == 304
+        assert response.headers["Vary"] == "Accept, Accept-Encoding"
+
+
+def test_revalidated_tile_keeps_cache_control(cached_file):
+    params = {"url": URL, "type": "PickleIO", "segment_id": 0, "analog_signal_id": 0, "level": 0, "tile": 0}
+    response = test_client.get("/api/analogsignaltile/", params=params)
+    assert response.status_code == 200
+    cache_control = f"public, max-age={settings.TILE_CACHE_MAX_AGE}"
+    assert response.headers["Cache-Control"] == cache_control
+    response = test_client.get("/api/analogsignaltile/", params=params, headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 304
+    assert response.headers["Cache-Control"] == cache_control
+
+
+def test_etag_changes_with_file(cached_file):
+    params = {"url": URL, "type": "PickleIO"}
+    etag = test_client.get("/api/blockdata/", params=params).headers["ETag"]
+    os.utime(cached_file, ns=(0, 0))
+    response = test_client.get("/api/blockdata/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_responses_are_cached(cached_file, monkeypatch):
+    response_cache.clear_memory()
+    params = {"url": URL, "type": "PickleIO", "segment_id": 0, "analog_signal_id": 0, "format": "npy"}
+    expected = test_client.get("/api/analogsignaldata/", params=params)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data file should not be opened")
+
+    monkeypatch.setattr(v1, "open_blocks", fail)
+    response = test_client.get("/api/analogsignaldata/", params=params)
+    assert response.content == expected.content
+    assert response.headers["Content-Type"] == expected.headers["Content-Type"]
+    assert response.headers[METADATA_HEADER] == expected.headers[METADATA_HEADER]
+    # the disk tier is shared with other worker processes
+    response_cache.clear_memory()
+    assert test_client.get("/api/analogsignaldata/", params=params).content == expected.content
+
+
+def test_cached_responses_count_as_accesses(cached_file, monkeypatch):
+    response_cache.clear_memory()
+    params = {"url": URL, "type": "PickleIO"}
+    response = test_client.get("/api/blockdata/", params=params)
+    assert response.status_code == 200
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data file should not be opened")
+
+    monkeypatch.setattr(v1, "open_blocks", fail)
+
+    def get_hits():
+        return disk_cache._connection().execute(
+            "SELECT hits FROM entries WHERE path = ?", (disk_cache._relative(cached_file),)
+        ).fetchone()[0]
+
+    hits = get_hits()
+    # from the response cache
+    assert test_client.get("/api/blockdata/", params=params).status_code == 200
+    assert get_hits() == hits + 1
+    # not modified
+    headers = {"If-None-Match": response.headers["ETag"]}
+    assert test_client.get("/api/blockdata/", params=params, headers=headers).status_code == 304
+    assert get_hits() == hits + 2
+    # from the metadata index, since the Accept header gives a new ETag
+    headers = {"Accept": "application/json"}
+    assert test_client.get("/api/blockdata/", params=params, headers=headers).status_code == 200
+    assert get_hits() == hits + 3
+
+
+def test_response_cache_budgets(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_MEMORY_MAX_BYTES", 1600)
+    monkeypatch.setattr(settings, "RESPONSE_CACHE_DISK_MAX_BYTES", 250)
+    cache = ResponseCache()
+    cache.put("a", {}, b"a" * 100)
+    os.utime(cache._path("a"), (0, 0))
+    cache.put("b", {}, b"b" * 100)
+    cache.put("c", {}, b"c" * 100)
+    # the least-recently-used file is deleted from disk
+    assert not os.path.exists(cache._path("a"))
+    assert os.path.exists(cache._path("b"))
+    for i in range(15):
+        cache.put(str(i), {}, b"x" * 100)
+    # memory holds 16 entries
+    assert list(cache._entries) == ["c"] + [str(i) for i in range(15)]
+    assert cache.get("a") is None
+    cache.clear_memory()
+    assert cache.get("14") == ({}, b"x" * 100)
+
+
+def test_prefetch_after_blockdata(cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "PREFETCH_AFTER_BLOCKDATA", True)
+    response_cache.clear_memory()
+    headers = {"Accept": "application/json, text/plain, */*"}
+    with TestClient(app) as client:
+        assert client.get("/api/blockdata/", params={"url": URL}, headers=headers).status_code == 200
+        for i in range(100):
+            if not prefetch._tasks:
+                break
+            time.sleep(0.05)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("the data file should not be opened")
+
+        monkeypatch.setattr(v1, "open_blocks", fail)
+        # the requests made by the viewer are answered from the response cache
+        params = {"url": URL, "segment_id": 0}
+        assert client.get("/api/segmentdata/", params=params, headers=headers).status_code == 200
+        response = client.get(
+            "/api/analogsignaldata/", params=dict(params, analog_signal_id=0, down_sample_factor=1), headers=headers
+        )
+        assert response.json()["values"] == [1.0, 2.0, 3.0]
+
+
+def test_requests_wait_for_prefetch(cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "PREFETCH_AFTER_BLOCKDATA", True)
+    response_cache.clear_memory()
+    open_blocks = v1.open_blocks
+    calls = []
+
+    def slow_open_blocks(*args, **kwargs):
+        calls.append(args)
+        time.sleep(0.2)
+        return open_blocks(*args, **kwargs)
+
+    monkeypatch.setattr(v1, "open_blocks", slow_open_blocks)
+    headers = {"Accept": "application/json"}
+    with TestClient(app) as client:
+        assert client.get("/api/blockdata/", params={"url": URL}, headers=headers).status_code == 200
+        # requested while it is being prefetched
+        params = {"url": URL, "segment_id": 0}
+        assert client.get("/api/segmentdata/", params=params, headers=headers).status_code == 200
+        for i in range(100):
+            if not prefetch._tasks:
+                break
+            time.sleep(0.05)
+    # the first segment was only read once, by the prefetch
+    assert len(calls) == 4
+    assert not prefetch._in_flight
+
+
+def test_prefetch_leaves_other_prefetches_alone(cached_file):
+    headers = {"Accept": "application/json"}
+    requests = [("/api/segmentdata/", {"url": URL, "type": "PickleIO", "segment_id": 0})]
+    key = prefetch.request_key("/api/segmentdata/", requests[0][1].items(), headers["Accept"])
+    # already being prefetched by another batch
+    event = prefetch._in_flight[key] = asyncio.Event()
+    try:
+        asyncio.run(prefetch.prefetch(app, requests, headers))
+        assert prefetch._in_flight[key] is event
+        assert not event.is_set()
+    finally:
+        del prefetch._in_flight[key]
+
+
+def test_wait_for_prefetch_times_out(cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "PREFETCH_WAIT_TIMEOUT", 0.2)
+    headers = {"Accept": "application/json"}
+    params = {"url": URL, "type": "PickleIO", "segment_id": 0}
+    key = prefetch.request_key("/api/segmentdata/", params.items(), headers["Accept"])
+    # a prefetch which never finishes
+    prefetch._in_flight[key] = asyncio.Event()
+    try:
+        start = time.monotonic()
+        assert test_client.get("/api/segmentdata/", params=params, headers=headers).status_code == 200
+        assert 0.2 <= time.monotonic() - start < 2
+    finally:
+        del prefetch._in_flight[key]
+
+
+def test_prefetches_use_one_worker(write_cached_file, monkeypatch):
+    urls = [f"https://example.invalid/data/prefetch{i}.pkl" for i in range(2)]
+    block = neo.Block()
+    block.segments.append(neo.Segment())
+    for url in urls:
+        write_cached_file(url, block)
+    response_cache.clear_memory()
+    open_blocks = v1.open_blocks
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def slow_open_blocks(*args, **kwargs):
+        with lock:
+            running.append(args)
+            max_running.append(len(running))
+        try:
+            time.sleep(0.1)
+            return open_blocks(*args, **kwargs)
+        finally:
+            with lock:
+                running.remove(args)
+
+    monkeypatch.setattr(v1, "open_blocks", slow_open_blocks)
+    headers = {"Accept": "application/json", "Accept-Encoding": "identity"}
+
+    async def run():
+        await asyncio.gather(*(
+            prefetch.prefetch(app, [("/api/segmentdata/", {"url": url, "type": "PickleIO", "segment_id": 0})], headers)
+            for url in urls
+        ))
+
+    asyncio.run(run())
+    assert len(max_running) == 2
+    assert max(max_running) == 1
+
+
+def test_prefetch_requests_identity_encoding(cached_file, monkeypatch):
+    monkeypatch.setattr(settings, "PREFETCH_AFTER_BLOCKDATA", True)
+    prefetched = []
+
+    async def record(app, requests, headers):
+        prefetched.append(headers)
+
+    monkeypatch.setattr(prefetch, "prefetch", record)
+    with TestClient(app) as client:
+        client.get("/api/blockdata/", params={"url": URL}, headers={"Accept": "application/json"})
+    assert prefetched == [{"Accept-Encoding": "identity", "Accept": "application/json"}]
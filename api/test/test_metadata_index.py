@@ -0,0 +1,85 @@
+"""
+
+"""
+
+import os
+from urllib.parse import urlparse
+import quantities as pq
+import neo
+import pytest
+from fastapi.testclient import TestClient
+from ..main import app
+from ..metadata_index import MetadataIndex, metadata_index
+from ..resources import v1
+from .. import settings, data_handler
+
+
+URL = "https://example.invalid/data/session.pkl"
+
+test_client = TestClient(app)
+
+
+@pytest.fixture
+def cached_file(write_cached_file):
+    block = neo.Block(name="session")
+    for i in range(2):
+        segment = neo.Segment(name=f"trial {i}")
+        segment.analogsignals.append(neo.AnalogSignal([[1.0], [2.0]], units="mV", sampling_rate=1 * pq.kHz))
+        block.segments.append(segment)
+    return write_cached_file(URL, block)
+
+
+def test_metadata_index(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "DOWNLOADED_FILE_CACHE_DIR", str(tmp_path))
+    index = MetadataIndex()
+    path = str(tmp_path / "abc" / "file.nix")
+    index.put(path, "v1", "NixIO", "blocks", b"{}")
+    assert index.get(path, "v1", "NixIO", "blocks") == b"{}"
+    assert index.get(path, "v2", "NixIO", "blocks") is None
+    assert index.get(path, "v1", "", "blocks") is None
+    # shared by all worker processes
+    assert MetadataIndex().get(path, "v1", "NixIO", "blocks") == b"{}"
+    index.discard(path)
+    assert index.get(path, "v1", "NixIO", "blocks") is None
+
+
+def test_metadata_is_returned_without_opening_file(cached_file, monkeypatch):
+    params = {"url": URL, "type": "PickleIO"}
+    blocks = test_client.get("/api/blockdata/", params=params).json()
+    assert [segment["name"] for segment in blocks["block"][0]["segments"]] == ["trial 0", "trial 1"]
+    segment = test_client.get("/api/segmentdata/", params=dict(params, segment_id=1)).json()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("the data file should not be opened")
+
+    monkeypatch.setattr(v1, "open_blocks", fail)
+    # a different Accept header gives a different ETag, so the response is not in the response cache
+    headers = {"Accept": "application/json"}
+    assert test_client.get("/api/blockdata/", params=params, headers=headers).json() == blocks
+    response = test_client.get("/api/segmentdata/", params=dict(params, segment_id=1), headers=headers)
+    assert response.json() == segment
+
+
+def test_metadata_is_discarded_with_file(cached_file):
+    params = {"url": URL, "type": "PickleIO"}
+    test_client.get("/api/blockdata/", params=params)
+    key = data_handler.get_index_key(URL)
+    assert metadata_index.get(*key, "PickleIO", f"blocks:{URL}") is not None
+    data_handler.io_cache.clear()
+    data_handler.invalidate(cached_file, cached_file)
+    assert metadata_index.get(*key, "PickleIO", f"blocks:{URL}") is None
+    assert not os.path.exists(cached_file)
+
+
+def test_metadata_contains_requested_url(cached_file, monkeypatch):
+    # e.g. a URL which redirects to the same file
+    other_url = "https://example.invalid/latest/session.pkl"
+    monkeypatch.setattr(data_handler, "resolve_url", lambda url: URL)
+    for url in (URL, other_url, URL):
+        block = test_client.get("/api/blockdata/", params={"url": url, "type": "PickleIO"}).json()["block"][0]
+        assert block["file_origin"] == url
+        assert block["file_name"] == urlparse(url).path
+        segment = test_client.get(
+            "/api/segmentdata/", params={"url": url, "type": "PickleIO", "segment_id": 0}
+        ).json()
+        assert segment["file_origin"] == url
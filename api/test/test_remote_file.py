@@ -0,0 +1,175 @@
+"""
+
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import gc
+import io
+import os
+import re
+import threading
+import h5py
+import neo
+import numpy as np
+import pytest
+import quantities as pq
+from .. import settings
+from ..data_handler import get_io, open_blocks, read_blocks
+from ..data_models import IOModule
+from ..remote_file import RemoteFile
+
+
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    content = b""
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.get("Range"))
+        if self.headers.get("If-Range", self.etag) != self.etag:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(self.content)))
+            self.send_header("ETag", self.etag)
+            self.end_headers()
+            self.wfile.write(self.content)
+            return
+        start, end = map(int, re.match(r"bytes=(\d+)-(\d+)", self.headers["Range"]).groups())
+        self.send_response(206)
+        self.send_header("Content-Length", str(end + 1 - start))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(self.content[start:end + 1])
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(self.content)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RangeRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    RangeRequestHandler.requests = []
+    RangeRequestHandler.etag = '"v1"'
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+
+
+def open_remote_file(url, tmp_path, content):
+    RangeRequestHandler.content = content
+    cache_path = str(tmp_path / "data.remote")
+    if not os.path.exists(cache_path):
+        RemoteFile.create(cache_path, len(content), {"ETag": RangeRequestHandler.etag})
+    return RemoteFile(url, cache_path)
+
+
+def test_remote_file_fetches_only_blocks_read(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "REMOTE_BLOCK_SIZE", 1000)
+    content = os.urandom(10_500)
+    with open_remote_file(f"{server}/data.h5", tmp_path, content) as fp:
+        assert fp.read(10) == content[:10]
+        fp.seek(2500)
+        assert fp.read(1000) == content[2500:3500]
+        assert fp.read(1000) == content[3500:4500]
+        fp.seek(-100, io.SEEK_END)
+        assert fp.read() == content[-100:]
+    # consecutive missing blocks are fetched together
+    assert RangeRequestHandler.requests == [
+        "bytes=0-999", "bytes=2000-3999", "bytes=4000-4999", "bytes=10000-10499"
+    ]
+    # blocks are shared with later readers
+    with open_remote_file(f"{server}/data.h5", tmp_path, content) as fp:
+        fp.seek(2000)
+        assert fp.read(3000) == content[2000:5000]
+    assert len(RangeRequestHandler.requests) == 4
+
+
+def test_read_hdf5_remotely(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "REMOTE_BLOCK_SIZE", 64 * 1024)
+    data = np.random.random_sample((100, 20_000))
+    local_path = tmp_path / "local.h5"
+    with h5py.File(local_path, "w") as f:
+        f.create_dataset("signals", data=data, chunks=(1, 20_000))
+    content = local_path.read_bytes()
+    with open_remote_file(f"{server}/data.h5", tmp_path, content) as fp:
+        with h5py.File(fp, "r") as f:
+            assert np.array_equal(f["signals"][42], data[42])
+    fetched = (tmp_path / "data.remote.blocks").read_bytes().count(1) * settings.REMOTE_BLOCK_SIZE
+    assert fetched < len(content) / 10
+
+
+def test_remote_file_detects_changed_file(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "REMOTE_BLOCK_SIZE", 1000)
+    content = os.urandom(5000)
+    with open_remote_file(f"{server}/data.h5", tmp_path, content) as fp:
+        assert fp.read(10) == content[:10]
+        RangeRequestHandler.etag = '"v2"'
+        RangeRequestHandler.content = os.urandom(5000)
+        fp.seek(3000)
+        with pytest.raises(OSError, match="has changed"):
+            fp.read(10)
+
+
+def write_maxwell_file(path, data):
+    """Write a file in the original Maxwell format, with one well."""
+    n_channels = data.shape[0]
+    mapping = np.zeros(n_channels, dtype=[("channel", "i4"), ("electrode", "i4")])
+    mapping["channel"] = np.arange(n_channels)
+    mapping["electrode"] = np.arange(100, 100 + n_channels)
+    with h5py.File(path, "w") as f:
+        f.create_dataset("version", data=np.array([b"20160704"]))
+        f.create_dataset("settings/lsb", data=np.array([6.3e-6]))
+        f.create_dataset("mapping", data=mapping)
+        f.create_dataset("sig", data=data, chunks=(n_channels, 1000))
+
+
+def test_open_maxwell_file_remotely(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "REMOTE_BLOCK_SIZE", 64 * 1024)
+    data = np.random.randint(0, 1024, size=(4, 200_000), dtype=np.uint16)
+    local_path = tmp_path / "local.raw.h5"
+    write_maxwell_file(local_path, data)
+    expected = neo.io.MaxwellIO(str(local_path)).read_block().segments[0].analogsignals[0]
+    content = local_path.read_bytes()
+    with open_remote_file(f"{server}/data.raw.h5", tmp_path, content) as fp:
+        io = get_io(fp, neo.io.MaxwellIO, "MaxwellIO")
+        assert io.filename == f"{server}/data.raw.h5"
+        signal = read_blocks(io)[0].segments[0].analogsignals[0].load(time_slice=None)
+        assert signal.shape == expected.shape
+        assert np.array_equal(signal.magnitude, expected.magnitude)
+        assert signal.sampling_rate == expected.sampling_rate
+
+
+def test_changed_remote_file_is_probed_again(server, offline_cache, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "REMOTE_BLOCK_SIZE", 64 * 1024)
+    monkeypatch.setattr(settings, "REMOTE_READING_MIN_SIZE", 0)
+    # h5py files left by earlier reads must not be garbage-collected in a server thread
+    # while h5py is waiting for that server, which would deadlock
+    gc.collect()
+    url = f"{server}/data.raw.h5"
+    contents, expected = [], []
+    for version in range(2):
+        local_path = tmp_path / f"v{version}.raw.h5"
+        write_maxwell_file(local_path, np.random.randint(0, 1024, size=(4, 200_000), dtype=np.uint16))
+        contents.append(local_path.read_bytes())
+        expected.append(neo.io.MaxwellIO(str(local_path)).read_block().segments[0].analogsignals[0])
+    RangeRequestHandler.content = contents[0]
+    with open_blocks(url, IOModule.MaxwellIO) as blocks:
+        signal = blocks[0].segments[0].analogsignals[0].load(time_slice=(0 * pq.s, 0.1 * pq.s))
+        assert np.array_equal(signal.magnitude, expected[0][:len(signal)].magnitude)
+    RangeRequestHandler.etag = '"v2"'
+    RangeRequestHandler.content = contents[1]
+    with pytest.raises(OSError):
+        with open_blocks(url, IOModule.MaxwellIO) as blocks:
+            blocks[0].segments[0].analogsignals[0].load(time_slice=None)
+    gc.collect()
+    # the block cache of the old version has been discarded, so the new version is read
+    with open_blocks(url, IOModule.MaxwellIO) as blocks:
+        signal = blocks[0].segments[0].analogsignals[0].load(time_slice=None)
+        assert np.array_equal(signal.magnitude, expected[1].magnitude)
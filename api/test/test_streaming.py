@@ -0,0 +1,68 @@
+"""
+
+"""
+
+import json
+import numpy as np
+import quantities as pq
+import neo
+from .. import settings
+from ..data_models import AnalogSignal, dump_json
+from ..streaming import iter_json, iter_ndjson
+
+
+def make_signal():
+    rng = np.random.default_rng(42)
+    return neo.AnalogSignal(
+        rng.uniform(-70, -50, size=(1000, 3)), units="mV", sampling_rate=1 * pq.kHz, name="sig"
+    )
+
+
+def test_iter_json_matches_non_streamed(monkeypatch):
+    monkeypatch.setattr(settings, "STREAMING_CHUNK_VALUES", 100)
+    for signal, kwargs in [
+        (make_signal(), {}),
+        (make_signal(), {"down_sample_factor": 7, "t_start": 0.1234, "t_stop": 0.9}),
+        (make_signal(), {"channels": "1"}),
+        (make_signal(), {"max_points": 50}),
+    ]:
+        args = (
+            kwargs.get("down_sample_factor", 1), kwargs.get("t_start"), kwargs.get("t_stop"),
+            kwargs.get("channels"), kwargs.get("max_points"),
+        )
+        expected = dump_json(AnalogSignal.from_data(AnalogSignal.data_from_neo(signal, *args)))
+        streamed = b"".join(iter_json(*AnalogSignal.chunks_from_neo(signal, *args)))
+        assert streamed == expected
+
+
+def test_iter_json_reads_signal_once(monkeypatch):
+    monkeypatch.setattr(settings, "STREAMING_CHUNK_VALUES", 300)
+    signal = make_signal()
+    data, n_channels, read_chunks = AnalogSignal.chunks_from_neo(signal, 1)
+    calls = []
+
+    def counting_read_chunks(channel=None):
+        calls.append(channel)
+        return read_chunks(channel)
+
+    streamed = b"".join(iter_json(data, n_channels, counting_read_chunks))
+    assert calls == [None]
+    assert json.loads(streamed)["values"] == signal.magnitude.T.tolist()
+
+
+def test_iter_ndjson(monkeypatch):
+    monkeypatch.setattr(settings, "STREAMING_CHUNK_VALUES", 300)
+    signal = make_signal()
+    lines = [json.loads(line) for line in iter_ndjson(*AnalogSignal.chunks_from_neo(signal, 1))]
+    assert lines[0]["n_channels"] == 3
+    assert lines[0]["t_stop"] == 1.0
+    assert [line["offset"] for line in lines[1:]] == list(range(0, 1000, 100))
+    values = np.concatenate([line["values"] for line in lines[1:]], axis=1)
+    np.testing.assert_array_equal(values, signal.magnitude.T)
+
+
+def test_iter_ndjson_reports_errors():
+    signal = make_signal()
+    signal[500, 1] = np.nan * pq.mV
+    lines = [json.loads(line) for line in iter_ndjson(*AnalogSignal.chunks_from_neo(signal, 1))]
+    assert lines[-1] == {"error": "Data contains NaN"}